@@ -194,6 +194,9 @@ doc_events = {
     "Cash Payment Voucher": {
         "on_submit": "importmanager.import_utils.on_submit_cash_payment_voucher",
         "on_cancel": "importmanager.import_utils.on_cancel_cash_payment_voucher"
+    },
+    "Company": {
+        "on_update": "importmanager.import_account_utils.clear_import_accounts_cache"
     }
 }
 
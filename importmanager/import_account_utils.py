@@ -0,0 +1,90 @@
+from dataclasses import dataclass, fields
+
+import frappe
+from frappe import _
+
+# Functions in this file resolve the import related accounts set on the Company.
+# They are cached per company and cleared when the Company is saved, so the hot paths
+# (GL posting, ImportDoc recompute, LCV taxes) don't load the Company document each time.
+
+IMPORT_ACCOUNTS_CACHE_KEY = "importmanager:import_accounts"
+
+
+@dataclass(frozen=True)
+class ImportAccounts:
+    """Import accounts of a Company, each attribute maps to the Company's custom_<attribute> field."""
+
+    company: str
+    unallocated_import_charges_account: str | None = None
+    default_import_charges_account: str | None = None
+    assessment_variance_account: str | None = None
+    default_import_assessment_charge_account: str | None = None
+    customs_duty_account: str | None = None
+    cess_account: str | None = None
+    sales_tax_input_account: str | None = None
+    default_gov_payable_account: str | None = None
+    advance_income_tax: str | None = None
+
+    # Accounts the charge allocation GL needs
+    REQUIRED = ("unallocated_import_charges_account", "default_import_charges_account")
+
+    def validate(self, required=REQUIRED):
+        """
+        Throw if any of the required accounts is not set.
+
+        :param required: (Optional) Attribute names of the accounts the caller uses.
+        """
+        missing = [
+            frappe.unscrub(account)
+            for account in required
+            if not getattr(self, account)
+        ]
+        if missing:
+            frappe.throw(
+                _("Please set {0} in Company {1}.").format(", ".join(missing), self.company),
+                title=_("Import Accounts Missing")
+            )
+
+
+def get_import_accounts(company, validate=True):
+    """
+    Import accounts of the company, from cache.
+
+    :param company: Company name.
+    :param validate: (Optional) Throw if an account of ImportAccounts.REQUIRED is not set.
+        Callers that use other accounts pass False and validate their own.
+    :return: ImportAccounts
+    """
+    if not company:
+        frappe.throw(_("Company is required"))
+
+    values = frappe.cache().hget(IMPORT_ACCOUNTS_CACHE_KEY, company, generator=lambda: load_import_accounts(company))
+    accounts = ImportAccounts(company=company, **values)
+    if validate:
+        accounts.validate()
+    return accounts
+
+
+def load_import_accounts(company):
+    company_doc = frappe.get_cached_doc("Company", company)
+    return {
+        field.name: company_doc.get(f"custom_{field.name}")
+        for field in fields(ImportAccounts)
+        if field.name != "company"
+    }
+
+
+def clear_import_accounts_cache(doc=None, method=None):
+    """
+    Company on_update hook. Clears the company's accounts now and once the save is committed,
+    in case another request cached the old accounts meanwhile.
+    """
+    if not doc:
+        frappe.cache().delete_value(IMPORT_ACCOUNTS_CACHE_KEY)
+        return
+
+    def clear_company_accounts():
+        frappe.cache().hdel(IMPORT_ACCOUNTS_CACHE_KEY, doc.name)
+
+    clear_company_accounts()
+    frappe.db.after_commit.add(clear_company_accounts)
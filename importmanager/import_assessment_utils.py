@@ -0,0 +1,151 @@
+# Customs assessment and duty engine for Landed Cost Vouchers.
+# Functions in this file run the duty cascade column-wise for a whole batch of items:
+#   assessed value -> CD/ACD -> sales tax base -> ST/AST -> IT base -> IT
+# They don't depend on Frappe, so they can be tested and benchmarked on their own.
+# All GD amounts are rounded with the builtin round(), same as the LCV has always done.
+
+LANDING_CHARGES_RATE = 0.01
+
+DUTY_COLUMNS = ('custom_cd', 'custom_acd', 'custom_ast', 'custom_stamnt', 'custom_it')
+
+
+def get_fixed_tax_amount(tax_rates, tax_category, quantity_unit_type, no_of_units):
+    """
+    Fixed tax of a category, charged per unit when the item is declared in the tax's UOM.
+
+    :param tax_rates: Parsed tax template, as returned by get_taxes_by_category.
+    :param tax_category: e.g. 'CD'.
+    :param quantity_unit_type: UOM the item is declared in.
+    :param no_of_units: Declared number of units.
+    """
+    fixed_tax = tax_rates.get('fixed_taxes', {}).get(tax_category, {})
+    # Ensure fixed_tax is a dictionary, not an integer
+    if not isinstance(fixed_tax, dict):
+        return 0
+
+    fixed_tax_amount = fixed_tax.get('custom_fixed_tax_amount')
+    if fixed_tax_amount is None or fixed_tax_amount <= 0:
+        return 0
+    if quantity_unit_type != fixed_tax.get('custom_fixed_tax_uom', 0):
+        return 0
+    return no_of_units * fixed_tax_amount
+
+
+def assess_values(assessed_value_per_unit, qty, insurance, exchange_rate):
+    """
+    Assessed value of each item: CFR value + 1% landing charges + insurance, then in base currency.
+
+    :return: dict of column name -> list of values.
+    """
+    columns = {
+        'custom_cfr_value': [],
+        'custom_landing_charges__1': [],
+        'custom_assessed_value': [],
+        'custom_base_assessed_value': []
+    }
+    for value_per_unit, item_qty, item_insurance, rate in zip(assessed_value_per_unit, qty, insurance, exchange_rate):
+        cfr_value = value_per_unit * item_qty
+        landing_charges = round((cfr_value + item_insurance) * LANDING_CHARGES_RATE, 2)
+        assessed_value = cfr_value + landing_charges + item_insurance
+
+        columns['custom_cfr_value'].append(cfr_value)
+        columns['custom_landing_charges__1'].append(landing_charges)
+        columns['custom_assessed_value'].append(assessed_value)
+        columns['custom_base_assessed_value'].append(round(assessed_value * rate))
+    return columns
+
+
+def assess_duties(base_assessed_value, tax_rates, quantity_unit_type, no_of_units, fixed_surcharge_ait):
+    """
+    Customs duty, sales tax and income tax of each item.
+
+    :param tax_rates: Parsed tax template per item (see get_taxes_by_category).
+    :return: dict of column name -> list of values.
+    """
+    columns = {column: [] for column in DUTY_COLUMNS}
+    for base_value, rates, unit_type, units, surcharge in zip(
+        base_assessed_value, tax_rates, quantity_unit_type, no_of_units, fixed_surcharge_ait
+    ):
+        cd = round((rates.get('CD', 0) / 100 * base_value) + get_fixed_tax_amount(rates, 'CD', unit_type, units), 0)
+        acd = round(rates.get('ACD', 0) / 100 * base_value, 0)
+
+        amount_for_sales_tax = round(base_value + cd + acd, 0)
+        ast = round(rates.get('AST', 0) / 100 * amount_for_sales_tax, 0)
+        stamnt = round(rates.get('Sales Tax', 0) / 100 * amount_for_sales_tax, 0)
+
+        amount_for_it = round(amount_for_sales_tax + ast + stamnt, 0) + surcharge
+        it = round(rates.get('IT', 0) / 100 * amount_for_it, 0)
+
+        columns['custom_cd'].append(cd)
+        columns['custom_acd'].append(acd)
+        columns['custom_ast'].append(ast)
+        columns['custom_stamnt'].append(stamnt)
+        columns['custom_it'].append(it)
+    return columns
+
+
+def assess_totals(duties, base_assessed_value, amount, valuation_basis):
+    """
+    Total duties and the charges applied to stock valuation of each item.
+
+    :param duties: dict of DUTY_COLUMNS -> list of values.
+    :param valuation_basis: Import Manager Settings imported_stock_valuation_basis. The assessment
+        difference only applies to "Custom Assessed Value".
+    :return: dict of column name -> list of values.
+    """
+    columns = {
+        'custom_total_duties_and_taxes': [],
+        'custom_base_assessment_difference': [],
+        'applicable_charges': []
+    }
+    for i, (base_value, item_amount) in enumerate(zip(base_assessed_value, amount)):
+        cd, acd, ast, stamnt, it = (duties[column][i] for column in DUTY_COLUMNS)
+        if valuation_basis == "Custom Assessed Value":
+            assessment_difference = base_value - item_amount
+        else:
+            assessment_difference = 0
+
+        columns['custom_total_duties_and_taxes'].append(cd + acd + stamnt + ast + it)
+        columns['custom_base_assessment_difference'].append(assessment_difference)
+        columns['applicable_charges'].append(assessment_difference + cd + acd)
+    return columns
+
+
+def assess_items(columns, valuation_basis, manual_data_entry=False):
+    """
+    Run the whole cascade for a batch of Landed Cost Items.
+
+    :param columns: dict of Landed Cost Item fieldname -> list of values, with 'qty' holding the
+        quantity used for assessment and 'tax_rates' the parsed tax template of each item
+        (None if no template matches the item).
+    :param valuation_basis: Import Manager Settings imported_stock_valuation_basis.
+    :param manual_data_entry: Duties were entered by hand, keep them and only compute totals.
+    :return: dict of computed column -> list of values. Items without a tax template keep
+        the duty and total columns given in `columns`.
+    """
+    result = assess_values(
+        columns['custom_assessed_value_per_unit'], columns['qty'],
+        columns['custom_insurance'], columns['custom_exchange_rate']
+    )
+    base_assessed_value = result['custom_base_assessed_value']
+    taxed = [i for i, rates in enumerate(columns['tax_rates']) if rates is not None]
+
+    def pick(values):
+        return [values[i] for i in taxed]
+
+    if manual_data_entry:
+        duties = {column: pick(columns[column]) for column in DUTY_COLUMNS}
+    else:
+        duties = assess_duties(
+            pick(base_assessed_value), pick(columns['tax_rates']), pick(columns['custom_quantity_unit_type']),
+            pick(columns['custom_no_of_units']), pick(columns['custom_fixed_surcharge_ait'])
+        )
+    totals = assess_totals(duties, pick(base_assessed_value), pick(columns['amount']), valuation_basis)
+
+    for computed in (duties, totals):
+        for column, values in computed.items():
+            merged = list(columns[column])
+            for i, value in zip(taxed, values):
+                merged[i] = value
+            result[column] = merged
+    return result
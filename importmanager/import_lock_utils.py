@@ -0,0 +1,153 @@
+import time
+
+import frappe
+from frappe.utils import flt, now
+from redis.exceptions import LockError
+
+# Functions in this file guard ImportDoc recomputes with a Redis lock.
+# The lock has an owner and a TTL, so a worker that dies while holding it
+# can't block the ImportDoc forever: the lock simply expires.
+
+# Seconds after which a lock of a dead holder expires
+IMPORT_DOC_LOCK_TTL = 900
+
+# Seconds a caller waits for the lock before giving up
+IMPORT_DOC_LOCK_WAIT = 10
+
+IMPORT_DOC_LOCK_METRICS_KEY = "importmanager:import_doc_lock_metrics"
+
+# Atomically keep the largest value seen in a hash field
+SET_MAX_SCRIPT = """
+local current = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > current then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+
+
+def get_import_doc_lock_key(import_doc_name):
+    return frappe.cache().make_key(f"importmanager:import_doc_lock:{import_doc_name}")
+
+
+class ImportDocLock:
+    """
+    Owned, expiring lock on a single ImportDoc.
+
+    Usage:
+        lock = ImportDocLock(import_doc_name)
+        if lock.acquire():
+            try:
+                ...
+            finally:
+                lock.release()
+    """
+
+    def __init__(self, import_doc_name, ttl=IMPORT_DOC_LOCK_TTL, wait=IMPORT_DOC_LOCK_WAIT):
+        self.import_doc_name = import_doc_name
+        self.ttl = ttl
+        self.wait = wait
+        self.owner = get_lock_owner()
+        self.acquired_at = None
+        self._lock = frappe.cache().lock(
+            get_import_doc_lock_key(import_doc_name),
+            timeout=ttl,
+            sleep=0.1,
+            thread_local=False
+        )
+
+    def acquire(self):
+        """
+        Wait up to `wait` seconds for the lock.
+
+        :return: True if the lock was acquired.
+        """
+        started = time.monotonic()
+        acquired = self._lock.acquire(blocking_timeout=self.wait, token=self.owner)
+        record_lock_metrics(wait=time.monotonic() - started, contended=not acquired)
+
+        if acquired:
+            self.acquired_at = time.monotonic()
+        else:
+            frappe.logger("importmanager").info(
+                f"ImportDoc {self.import_doc_name} is locked by {get_import_doc_lock_owner(self.import_doc_name)}"
+            )
+        return acquired
+
+    def release(self):
+        if self.acquired_at is None:
+            return
+
+        held = time.monotonic() - self.acquired_at
+        self.acquired_at = None
+        try:
+            self._lock.release()
+            record_lock_metrics(hold=held)
+        except LockError:
+            # The TTL ran out while we were still working, someone else may own the lock now
+            record_lock_metrics(hold=held, expired=True)
+            frappe.log_error(
+                message=f"Lock on ImportDoc {self.import_doc_name} expired after {held:.1f}s (TTL {self.ttl}s)",
+                title="ImportDoc Lock Expired"
+            )
+
+
+def get_lock_owner():
+    """
+    Identify the lock holder: site, user, background job (if any) and a random suffix
+    so that two holders are never mistaken for each other.
+    """
+    job = getattr(frappe.local, "job", None)
+    job_id = getattr(job, "job_id", None) or "request"
+    return f"{frappe.local.site}|{frappe.session.user}|{job_id}|{frappe.generate_hash(length=10)}"
+
+
+def get_import_doc_lock_owner(import_doc_name):
+    # Raw redis commands are used here and below: RedisWrapper's get/hash helpers pickle values
+    owner = frappe.cache().execute_command("GET", get_import_doc_lock_key(import_doc_name))
+    return owner.decode() if owner else None
+
+
+def record_lock_metrics(wait=None, hold=None, contended=False, expired=False):
+    """
+    Accumulate lock wait/hold times in Redis.
+    """
+    cache = frappe.cache()
+    key = cache.make_key(IMPORT_DOC_LOCK_METRICS_KEY)
+    pipeline = cache.pipeline()
+
+    if wait is not None:
+        pipeline.hincrby(key, "wait_count", 1)
+        pipeline.hincrbyfloat(key, "wait_total", wait)
+    if hold is not None:
+        pipeline.hincrby(key, "hold_count", 1)
+        pipeline.hincrbyfloat(key, "hold_total", hold)
+    if contended:
+        pipeline.hincrby(key, "contended_count", 1)
+    if expired:
+        pipeline.hincrby(key, "expired_count", 1)
+    for metric, value in (("wait_max", wait), ("hold_max", hold)):
+        if value is not None:
+            pipeline.eval(SET_MAX_SCRIPT, 1, key, metric, value)
+    pipeline.execute()
+
+
+@frappe.whitelist()
+def get_import_doc_lock_metrics(import_doc_name=None):
+    """
+    Return lock wait and hold time metrics for ImportDoc recomputes,
+    and the current lock owner if an ImportDoc is given.
+    """
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    raw = cache.execute_command("HGETALL", cache.make_key(IMPORT_DOC_LOCK_METRICS_KEY))
+    metrics = {key.decode(): flt(value.decode()) for key, value in raw.items()}
+
+    for metric in ("wait", "hold"):
+        count = metrics.get(f"{metric}_count")
+        metrics[f"{metric}_avg"] = metrics.get(f"{metric}_total", 0) / count if count else 0
+
+    metrics["as_on"] = now()
+    if import_doc_name:
+        metrics["owner"] = get_import_doc_lock_owner(import_doc_name)
+    return metrics
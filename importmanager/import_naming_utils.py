@@ -0,0 +1,62 @@
+import re
+
+import frappe
+from frappe.utils import cint
+
+# Functions in this file hand out names of the form base, base-1, base-2, ... for
+# documents named after a business key (GD number, purchase order, ...).
+# The last suffix of each base is kept in the Series table, so the next name costs one
+# locked row update instead of probing existing names, and concurrent inserts can't
+# pick the same name.
+
+
+def get_series_key(base_name):
+    return f"{base_name}-"
+
+
+def get_next_name(doctype, base_name):
+    """
+    Next free name for the base: the base itself first, then base-1, base-2, ...
+
+    :param doctype: Doctype being named, used to seed the counter from existing names.
+    :param base_name: Name without suffix.
+    :return: Name for the new document.
+    """
+    key = get_series_key(base_name)
+    while True:
+        count = get_next_count(doctype, base_name, key)
+        name = base_name if count == 1 else f"{base_name}-{count - 1}"
+        # Names given outside the counter (amendments, renames) are skipped
+        if not frappe.db.exists(doctype, name):
+            return name
+
+
+def get_next_count(doctype, base_name, key):
+    """
+    Increment the counter of the base, the Series row stays locked until the transaction ends.
+    """
+    current = frappe.db.sql("select `current` from `tabSeries` where `name` = %s for update", (key,))
+    if current and current[0][0] is not None:
+        frappe.db.sql("update `tabSeries` set `current` = `current` + 1 where `name` = %s", (key,))
+        return cint(current[0][0]) + 1
+
+    # First name of this base: start after the names already there
+    frappe.db.sql(
+        "insert ignore into `tabSeries` (`name`, `current`) values (%s, %s)",
+        (key, get_existing_count(doctype, base_name))
+    )
+    return get_next_count(doctype, base_name, key)
+
+
+def get_existing_count(doctype, base_name):
+    """
+    Counter value matching the existing names of the base: 0 if there are none,
+    1 for the base alone, n + 1 if base-n is the highest suffix.
+    """
+    pattern = re.compile(rf"^{re.escape(base_name)}(?:-(\d+))?$")
+    count = 0
+    for name in frappe.get_all(doctype, filters={"name": ["like", f"{base_name}%"]}, pluck="name"):
+        match = pattern.match(name)
+        if match:
+            count = max(count, cint(match.group(1)) + 1)
+    return count
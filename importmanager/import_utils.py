@@ -1,13 +1,20 @@
 import frappe
-from frappe.utils import nowdate,datetime
+from frappe import _
+from frappe.utils import flt,nowdate,datetime
 from erpnext.accounts.utils import get_fiscal_year as erp_get_fiscal_year
 from erpnext import get_default_cost_center
 from erpnext.controllers.taxes_and_totals import get_itemised_tax_breakup_data
-import time
+from functools import cached_property
 from frappe.exceptions import TimestampMismatchError
 from frappe.model.naming import make_autoname
-
-def create_journal_voucher(title, posting_date, accounts,import_document=None):
+from frappe.query_builder.functions import Coalesce, Sum
+from importmanager.import_account_utils import get_import_accounts
+from importmanager.import_assessment_utils import assess_items, get_fixed_tax_amount
+from importmanager.import_lock_utils import IMPORT_DOC_LOCK_TTL, ImportDocLock, get_import_doc_lock_owner
+from importmanager.import_naming_utils import get_next_name
+
+def create_journal_voucher(title, posting_date, accounts,import_document=None, company=None, idempotency_key=None,
+                           landed_cost_voucher=None):
     """
     Create a Journal Voucher (Journal Entry) in ERPNext.
 
@@ -19,21 +26,26 @@ def create_journal_voucher(title, posting_date, accounts,import_document=None):
                          {"account": "Debtors - CO", "debit": 1000, "credit": 0},
                          {"account": "Sales - CO", "debit": 0, "credit": 1000},
                      ]
+    :param import_document: (Optional) ImportDoc the entry belongs to.
+    :param company: (Optional) Company of the entry, looked up from the ImportDoc or accounts if not given.
+    :param idempotency_key: (Optional) Key of the entry, unique on Journal Entry. If an entry
+        with the same key exists nothing is posted.
+    :param landed_cost_voucher: (Optional) Landed Cost Voucher the entry is generated for,
+        the entry is cancelled with it.
     :return: Name of the created Journal Entry or an error message.
     """
+    if idempotency_key:
+        existing_jv = get_journal_voucher_by_idempotency_key(idempotency_key)
+        if existing_jv:
+            return existing_jv
+
     # Determine company from accounts or import_document
-    company = None
-    if import_document:
+    if not company and import_document:
         # Try to get company from ImportDoc or Landed Cost Voucher
-        try:
-            import_doc = frappe.get_doc("ImportDoc", import_document)
-            company = import_doc.company
-        except Exception:
-            try:
-                lcv_doc = frappe.get_doc("Landed Cost Voucher", import_document)
-                company = lcv_doc.company
-            except Exception:
-                pass
+        company = (
+            frappe.db.get_value("ImportDoc", import_document, "company")
+            or frappe.db.get_value("Landed Cost Voucher", import_document, "company")
+        )
     if not company and accounts:
         # Try to get company from account (first account's company)
         acc_name = accounts[0].get("account")
@@ -70,6 +82,10 @@ def create_journal_voucher(title, posting_date, accounts,import_document=None):
     jv.voucher_type = "Journal Entry" 
     if import_document is not None:
         jv.custom_import_document = import_document
+    if idempotency_key:
+        jv.custom_idempotency_key = idempotency_key
+    if landed_cost_voucher:
+        jv.custom_landed_cost_voucher = landed_cost_voucher
 
     # Add accounts to the Journal Entry
     for acc in accounts:
@@ -83,11 +99,40 @@ def create_journal_voucher(title, posting_date, accounts,import_document=None):
         })
 
     # Validate and save the document
-    jv.insert()
+    try:
+        jv.insert()
+    except frappe.UniqueValidationError:
+        # custom_idempotency_key is unique: another run may have posted this entry meanwhile.
+        # The locking read sees rows committed after this transaction's snapshot.
+        existing_jv = idempotency_key and get_journal_voucher_by_idempotency_key(idempotency_key, for_update=True)
+        if not existing_jv:
+            raise
+        return existing_jv
     jv.submit()
     
     return f"Journal Entry '{jv.name}' created successfully."
 
+def get_journal_voucher_by_idempotency_key(idempotency_key, for_update=False):
+    """
+    Journal Entry already made with the key, if any. A draft left behind by an
+    interrupted run is submitted, so the entry is posted exactly once.
+
+    :param for_update: (Optional) Lock the entry, reading its latest committed version.
+    :return: Message of create_journal_voucher, or None if there is no entry with the key.
+    """
+    existing_jv = frappe.db.get_value(
+        "Journal Entry",
+        {"custom_idempotency_key": idempotency_key},
+        ["name", "docstatus"],
+        as_dict=True,
+        for_update=for_update
+    )
+    if not existing_jv:
+        return None
+    if existing_jv.docstatus == 0:
+        frappe.get_doc("Journal Entry", existing_jv.name).submit()
+    return f"Journal Entry '{existing_jv.name}' created successfully."
+
 
 def create_gl_entries(posting_date, accounts, company):
     """
@@ -138,160 +183,161 @@ def create_gl_entries(posting_date, accounts, company):
 
     
 
-def get_sales_tax_entries(lcv_item,company):
+def get_sales_tax_entries(lcv_item,accounts):
     accounts_list = []
-    debit_dict = {'account':company.custom_sales_tax_input_account,'debit':lcv_item.custom_stamnt,'credit':0}
-    credit_dict = {'account':company.custom_default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_stamnt}
+    debit_dict = {'account':accounts.sales_tax_input_account,'debit':lcv_item.custom_stamnt,'credit':0}
+    credit_dict = {'account':accounts.default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_stamnt}
     accounts_list.append(debit_dict)
     accounts_list.append(credit_dict)
     return accounts_list
 
-def get_additional_sales_tax_entries(lcv_item,company):
+def get_additional_sales_tax_entries(lcv_item,accounts):
     accounts_list = []
-    debit_dict = {'account':company.custom_sales_tax_input_account,'debit':lcv_item.custom_ast,'credit':0}
-    credit_dict = {'account':company.custom_default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_ast}
+    debit_dict = {'account':accounts.sales_tax_input_account,'debit':lcv_item.custom_ast,'credit':0}
+    credit_dict = {'account':accounts.default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_ast}
     accounts_list.append(debit_dict)
     accounts_list.append(credit_dict)
     return accounts_list
 
-def get_advance_income_tax_entries(lcv_item,company):
+def get_advance_income_tax_entries(lcv_item,accounts):
     accounts_list = []
-    debit_dict = {'account':company.custom_advance_income_tax,'debit':lcv_item.custom_it,'credit':0}
-    credit_dict = {'account':company.custom_default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_it}
+    debit_dict = {'account':accounts.advance_income_tax,'debit':lcv_item.custom_it,'credit':0}
+    credit_dict = {'account':accounts.default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_it}
     accounts_list.append(debit_dict)
     accounts_list.append(credit_dict)
     return accounts_list
 
-def get_custom_duty_entries(lcv_item,company):
+def get_custom_duty_entries(lcv_item,accounts):
     accounts_list = []
-    debit_dict = {'account':company.custom_unallocated_import_charges_account,'debit':lcv_item.custom_cd,'credit':0}
-    credit_dict = {'account':company.custom_default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_cd}
+    debit_dict = {'account':accounts.unallocated_import_charges_account,'debit':lcv_item.custom_cd,'credit':0}
+    credit_dict = {'account':accounts.default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_cd}
     accounts_list.append(debit_dict)
     accounts_list.append(credit_dict)
     return accounts_list
 
-def get_additional_custom_duty_entries(lcv_item,company):
+def get_additional_custom_duty_entries(lcv_item,accounts):
     accounts_list = []
-    debit_dict = {'account':company.custom_unallocated_import_charges_account,'debit':lcv_item.custom_acd,'credit':0}
-    credit_dict = {'account':company.custom_default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_acd}
+    debit_dict = {'account':accounts.unallocated_import_charges_account,'debit':lcv_item.custom_acd,'credit':0}
+    credit_dict = {'account':accounts.default_gov_payable_account,'party_type':'Government','party':'Pakistan Customs','debit':0,'credit':lcv_item.custom_acd}
     accounts_list.append(debit_dict)
     accounts_list.append(credit_dict)
     return accounts_list
 
-def get_cess_amount_entries(lcv_item,company):
+def get_cess_amount_entries(lcv_item,accounts):
     accounts_list = []
-    debit_dict = {'account':company.custom_cess_account,'debit':lcv_item.custom_cess_amount,'credit':0}
-    credit_dict = {'account':company.custom_default_gov_payable_account,'party_type':'Government','party':'Sindh Excise and Taxation','debit':0,'credit':lcv_item.custom_cess_amount}
+    debit_dict = {'account':accounts.cess_account,'debit':lcv_item.custom_cess_amount,'credit':0}
+    credit_dict = {'account':accounts.default_gov_payable_account,'party_type':'Government','party':'Sindh Excise and Taxation','debit':0,'credit':lcv_item.custom_cess_amount}
     accounts_list.append(debit_dict)
     accounts_list.append(credit_dict)
     return accounts_list
 
-def get_assessment_variance_transfer_entry(lcv_item,company):
+def get_assessment_variance_transfer_entry(lcv_item,accounts):
     accounts_list = []
-    debit_dict = {'account':company.custom_unallocated_import_charges_account,'debit':lcv_item.custom_base_assessment_difference,'credit':0}
-    credit_dict = {'account':company.custom_default_import_assessment_charge_account,'debit':0,'credit':lcv_item.custom_base_assessment_difference}
+    debit_dict = {'account':accounts.unallocated_import_charges_account,'debit':lcv_item.custom_base_assessment_difference,'credit':0}
+    credit_dict = {'account':accounts.default_import_assessment_charge_account,'debit':0,'credit':lcv_item.custom_base_assessment_difference}
     accounts_list.append(debit_dict)
     accounts_list.append(credit_dict)
     return accounts_list
 
+# Tax legs of the consolidated import taxes JV: (Landed Cost Item field, debit account, payable party)
+IMPORT_TAX_LEGS = (
+    ("custom_stamnt", "sales_tax_input_account", "Pakistan Customs"),
+    ("custom_ast", "sales_tax_input_account", "Pakistan Customs"),
+    ("custom_it", "advance_income_tax", "Pakistan Customs"),
+    ("custom_cd", "unallocated_import_charges_account", "Pakistan Customs"),
+    ("custom_acd", "unallocated_import_charges_account", "Pakistan Customs"),
+    ("custom_cess_amount", "cess_account", "Sindh Excise and Taxation"),
+)
+
+def add_jv_leg(entries, account, debit=0, credit=0, party_type=None, party=None):
+    """
+    Add to the JV row of the account and party, creating it on first use.
+    """
+    entry = entries.setdefault(
+        (account, party_type or "", party or ""),
+        {"account": account, "debit": 0, "credit": 0, "party_type": party_type, "party": party}
+    )
+    entry["debit"] += debit
+    entry["credit"] += credit
+
+def get_consolidated_import_tax_entries(lcv_doc, accounts):
+    """
+    JV rows of the import taxes of a Landed Cost Voucher, built in one pass over its items
+    with a row per account and party.
+
+    :param lcv_doc: Landed Cost Voucher document.
+    :param accounts: ImportAccounts of the company.
+    :return: (regular tax rows, assessment variance rows)
+    """
+    tax_entries = {}
+    assessment_entries = {}
+
+    for item in lcv_doc.get("items"):
+        assessment_difference = flt(item.custom_base_assessment_difference)
+        if assessment_difference > 0:
+            add_jv_leg(assessment_entries, accounts.unallocated_import_charges_account, debit=assessment_difference)
+            add_jv_leg(assessment_entries, accounts.default_import_assessment_charge_account, credit=assessment_difference)
+
+        for fieldname, account, party in IMPORT_TAX_LEGS:
+            amount = flt(item.get(fieldname))
+            if amount > 0:
+                add_jv_leg(tax_entries, getattr(accounts, account), debit=amount)
+                add_jv_leg(tax_entries, accounts.default_gov_payable_account, credit=amount,
+                           party_type="Government", party=party)
+
+    return list(tax_entries.values()), list(assessment_entries.values())
+
 def create_consolidated_import_taxes_jv(landed_cost_voucher):
     """
     Creates consolidated journal entries for import taxes from landed cost voucher.
     Creates one JV for assessment variance and one JV for all other tax entries.
-    Includes GD number in JV titles.
+    Includes GD number in JV titles. Each JV carries a key made of the LCV name, so
+    running it again for the same LCV doesn't post twice.
     
     Args:
-        landed_cost_voucher: Name of the Landed Cost Voucher
+        landed_cost_voucher: Landed Cost Voucher document (or name)
     """
-    lcv_doc = frappe.get_doc("Landed Cost Voucher", landed_cost_voucher)
-    company = frappe.get_cached_doc("Company", lcv_doc.company)
+    lcv_doc = landed_cost_voucher
+    if isinstance(landed_cost_voucher, str):
+        lcv_doc = frappe.get_doc("Landed Cost Voucher", landed_cost_voucher)
+    accounts = get_import_accounts(lcv_doc.company, validate=False)
     
     # Get GD number from ImportDoc
-    import_doc = frappe.get_doc("ImportDoc", lcv_doc.custom_import_document)
-    gd_no = import_doc.gd_no if import_doc.gd_no else "NO-GD"
-    
-    # Initialize lists for different types of entries
-    regular_tax_entries = []
-    assessment_entries = []
-    
-    for item in lcv_doc.get("items"):
-        try:
-            # Collect assessment variance entries
-            if item.custom_base_assessment_difference > 0:
-                assessment_entries.extend(get_assessment_variance_transfer_entry(item, company))
-            
-            # Collect all other tax entries
-            if item.custom_stamnt > 0:
-                regular_tax_entries.extend(get_sales_tax_entries(item, company))
-            if item.custom_ast > 0:
-                regular_tax_entries.extend(get_additional_sales_tax_entries(item, company))
-            if item.custom_it > 0:
-                regular_tax_entries.extend(get_advance_income_tax_entries(item, company))
-            if item.custom_cd > 0:
-                regular_tax_entries.extend(get_custom_duty_entries(item, company))
-            if item.custom_acd > 0:
-                regular_tax_entries.extend(get_additional_custom_duty_entries(item, company))
-            if item.custom_cess_amount > 0:
-                regular_tax_entries.extend(get_cess_amount_entries(item, company))
-                
-        except Exception as e:
-            frappe.log_error(message=f"{str(e)}", title="Error Creating Import Tax JVs")
-            frappe.throw("Error Creating Import Tax JVs. Please Contact Support")
+    gd_no = frappe.db.get_value("ImportDoc", lcv_doc.custom_import_document, "gd_no") or "NO-GD"
 
-    # Create separate JV for assessment variance
-    
+    try:
+        regular_tax_entries, assessment_entries = get_consolidated_import_tax_entries(lcv_doc, accounts)
+    except Exception as e:
+        frappe.log_error(message=f"{str(e)}", title="Error Creating Import Tax JVs")
+        frappe.throw("Error Creating Import Tax JVs. Please Contact Support")
 
+    # Create separate JV for assessment variance
     if assessment_entries:
         create_journal_voucher(
             f"Assessment Variance Transfer - GD-{gd_no}",
             lcv_doc.posting_date,
             assessment_entries,
-            import_document=lcv_doc.custom_import_document
+            import_document=lcv_doc.custom_import_document,
+            company=lcv_doc.company,
+            idempotency_key=f"{lcv_doc.name}:assessment-variance",
+            landed_cost_voucher=lcv_doc.name
         )
-    
 
-    # Create consolidated JV for all other tax entries
+    # Create single JV for all tax entries
     if regular_tax_entries:
-        # Group entries by account, party_type, and party
-        consolidated_entries = {}
-        
-        for entry in regular_tax_entries:
-            # Create unique key for grouping
-            key = (
-                entry["account"],
-                entry.get("party_type", ""),
-                entry.get("party", "")
-            )
-            
-            if key in consolidated_entries:
-                # Add to existing entry
-                consolidated_entries[key]["debit"] += entry.get("debit", 0)
-                consolidated_entries[key]["credit"] += entry.get("credit", 0)
-            else:
-                # Create new entry
-                consolidated_entries[key] = {
-                    "account": entry["account"],
-                    "debit": entry.get("debit", 0),
-                    "credit": entry.get("credit", 0),
-                    "party_type": entry.get("party_type"),
-                    "party": entry.get("party")
-                }
-        
-        # Convert consolidated entries to list
-        final_entries = list(consolidated_entries.values())
-        frappe.log_error(message=f"{final_entries}",title="final entries")
-        
-        # Create single JV for all tax entries
         create_journal_voucher(
             f"Consolidated Import Taxes - GD-{gd_no}",
             lcv_doc.posting_date,
-            final_entries,
-            import_document=lcv_doc.custom_import_document
+            regular_tax_entries,
+            import_document=lcv_doc.custom_import_document,
+            company=lcv_doc.company,
+            idempotency_key=f"{lcv_doc.name}:import-taxes",
+            landed_cost_voucher=lcv_doc.name
         )
 
 def create_import_taxes_jv(landed_cost_voucher):
     lcv_doc = frappe.get_doc("Landed Cost Voucher",landed_cost_voucher)
-    company = frappe.get_cached_doc("Company",lcv_doc.company)
+    accounts = get_import_accounts(lcv_doc.company, validate=False)
     # Loop over LCV items
     
     
@@ -300,100 +346,189 @@ def create_import_taxes_jv(landed_cost_voucher):
         try:
             if item.custom_stamnt > 0:
                 
-                create_journal_voucher("ST PakistanCustoms",lcv_doc.posting_date,get_sales_tax_entries(item,company),
-                                    import_document=lcv_doc.custom_import_document)
+                create_journal_voucher("ST PakistanCustoms",lcv_doc.posting_date,get_sales_tax_entries(item,accounts),
+                                    import_document=lcv_doc.custom_import_document,landed_cost_voucher=lcv_doc.name)
             
             if item.custom_ast > 0:
                 
-                create_journal_voucher("AST PakistanCustoms",lcv_doc.posting_date,get_additional_sales_tax_entries(item,company),
-                                    import_document=lcv_doc.custom_import_document)
+                create_journal_voucher("AST PakistanCustoms",lcv_doc.posting_date,get_additional_sales_tax_entries(item,accounts),
+                                    import_document=lcv_doc.custom_import_document,landed_cost_voucher=lcv_doc.name)
             
             if item.custom_it > 0:
-                create_journal_voucher("IT PakistanCustoms",lcv_doc.posting_date,get_advance_income_tax_entries(item,company),
-                                    import_document=lcv_doc.custom_import_document)
+                create_journal_voucher("IT PakistanCustoms",lcv_doc.posting_date,get_advance_income_tax_entries(item,accounts),
+                                    import_document=lcv_doc.custom_import_document,landed_cost_voucher=lcv_doc.name)
             
             if item.custom_cd > 0:
-                create_journal_voucher("CD PakistanCustoms",lcv_doc.posting_date,get_custom_duty_entries(item,company),
-                                    import_document=lcv_doc.custom_import_document)
+                create_journal_voucher("CD PakistanCustoms",lcv_doc.posting_date,get_custom_duty_entries(item,accounts),
+                                    import_document=lcv_doc.custom_import_document,landed_cost_voucher=lcv_doc.name)
             
             if item.custom_acd > 0:
-                create_journal_voucher("ACD PakistanCustoms",lcv_doc.posting_date,get_additional_custom_duty_entries(item,company),
-                                    import_document=lcv_doc.custom_import_document)
+                create_journal_voucher("ACD PakistanCustoms",lcv_doc.posting_date,get_additional_custom_duty_entries(item,accounts),
+                                    import_document=lcv_doc.custom_import_document,landed_cost_voucher=lcv_doc.name)
             
             if item.custom_cess_amount > 0:
-                create_journal_voucher("Cess Sindh Excise and Taxation",lcv_doc.posting_date,get_cess_amount_entries(item,company),
-                                    import_document=lcv_doc.custom_import_document)
+                create_journal_voucher("Cess Sindh Excise and Taxation",lcv_doc.posting_date,get_cess_amount_entries(item,accounts),
+                                    import_document=lcv_doc.custom_import_document,landed_cost_voucher=lcv_doc.name)
             
             if item.custom_base_assessment_difference > 0:
-                create_journal_voucher("Assessment Variance Transfer",lcv_doc.posting_date,get_assessment_variance_transfer_entry(item,company),
-                                    import_document=lcv_doc.custom_import_document)
+                create_journal_voucher("Assessment Variance Transfer",lcv_doc.posting_date,get_assessment_variance_transfer_entry(item,accounts),
+                                    import_document=lcv_doc.custom_import_document,landed_cost_voucher=lcv_doc.name)
             
         
         except Exception as e:
             frappe.log_error(message=f"{str(e)}",title="Error Creating Import Jvs")
             frappe.throw("Error Creating Import JVs. Please Contact Support")
 
-def get_item_qty_for_assessment(lcv_doc_item):
-    import_settings = frappe.get_single("Import Manager Settings")
+def get_item_qty_for_assessment(lcv_doc_item, import_settings=None):
+    import_settings = import_settings or frappe.get_single("Import Manager Settings")
     if import_settings.item_qty_source_for_assessment == "Purchase Invoice":
         return lcv_doc_item.qty
     else:
         return lcv_doc_item.custom_no_of_units
 
-def calculate_assessed_value(lcv_doc_item):
-    
-    try:
-        incoterm = frappe.get_doc(lcv_doc_item.receipt_document_type,lcv_doc_item.receipt_document).incoterm 
-        
-        if incoterm is None:
-            incoterm = "Cost and Freight"
-        
-        ex_assess_value = lcv_doc_item.custom_assessed_value_per_unit * get_item_qty_for_assessment(lcv_doc_item)
-        custom_cfr_value = ex_assess_value
-        frappe.db.set_value("Landed Cost Item", lcv_doc_item.name, 'custom_cfr_value', custom_cfr_value)
-        lcv_doc_item.custom_cfr_value = custom_cfr_value
+# Landed Cost Item fields computed by the assessment engine
+LCV_ASSESSMENT_FIELDS = [
+    'custom_cfr_value',
+    'custom_landing_charges__1',
+    'custom_assessed_value',
+    'custom_base_assessed_value',
+    'custom_cd',
+    'custom_acd',
+    'custom_ast',
+    'custom_stamnt',
+    'custom_it',
+    'custom_total_duties_and_taxes',
+    'custom_base_assessment_difference',
+    'applicable_charges'
+]
+
+# Landed Cost Item fields read by the assessment engine
+LCV_ASSESSMENT_INPUT_FIELDS = [
+    'custom_assessed_value_per_unit',
+    'custom_insurance',
+    'custom_exchange_rate',
+    'custom_quantity_unit_type',
+    'custom_no_of_units',
+    'custom_fixed_surcharge_ait',
+    'amount'
+]
+
+def bulk_set_values(doctype, values_by_name, fields, update_modified=True, chunk_size=None):
+    """
+    Set several fields on many documents with one multi-row UPDATE
+    (`field = CASE name WHEN ... THEN ... END`), instead of a set_value per field and row.
+
+    :param doctype: Doctype (or child doctype) to update.
+    :param values_by_name: dict of name -> {fieldname: value}.
+    :param fields: Fields to update, each must be present in every values dict.
+    :param update_modified: (Optional) Also set modified / modified_by, as set_value does.
+    :param chunk_size: (Optional) Rows per UPDATE, keeps statements within the packet size
+        for large updates.
+    """
+    if not values_by_name or not fields:
+        return
 
+    names = list(values_by_name)
+    chunk_size = chunk_size or len(names)
+    for start in range(0, len(names), chunk_size):
+        _bulk_set_values(doctype, values_by_name, names[start:start + chunk_size], fields, update_modified)
+
+def _bulk_set_values(doctype, values_by_name, names, fields, update_modified):
+    set_clauses = []
+    values = []
+    for field in fields:
+        set_clauses.append(f"`{field}` = CASE `name` {' '.join(['WHEN %s THEN %s'] * len(names))} END")
+        for name in names:
+            values.extend([name, values_by_name[name][field]])
+
+    if update_modified:
+        set_clauses.append("`modified` = %s, `modified_by` = %s")
+        values.extend([frappe.utils.now(), frappe.session.user])
+
+    values.extend(names)
+    frappe.db.sql(
+        f"""update `tab{doctype}` set {', '.join(set_clauses)}
+        where `name` in ({', '.join(['%s'] * len(names))})""",
+        values
+    )
 
+TARIFF_TAX_RATES_CACHE_KEY = "importmanager:tariff_tax_rates"
 
-        custom_landing_charges__1 = round((ex_assess_value + lcv_doc_item.custom_insurance) * 0.01,2)
-        frappe.db.set_value("Landed Cost Item", lcv_doc_item.name, 'custom_landing_charges__1', custom_landing_charges__1)
-        lcv_doc_item.custom_landing_charges__1 = custom_landing_charges__1
+def get_tariff_tax_rates(customs_tariff_number, country_of_origin):
+    """
+    Parsed Item Tax Template for a customs tariff number and country of origin.
+    Results are cached in Redis (and memoized for the request) until an Item Tax Template changes,
+    see clear_tariff_tax_rates_cache.
 
-        
-        custom_assessed_value = lcv_doc_item.custom_cfr_value + lcv_doc_item.custom_landing_charges__1 + lcv_doc_item.custom_insurance
-        frappe.db.set_value("Landed Cost Item", lcv_doc_item.name, 'custom_assessed_value',custom_assessed_value)
-        lcv_doc_item.custom_assessed_value = custom_assessed_value
-        
-        custom_base_assessed_value = round(lcv_doc_item.custom_assessed_value * lcv_doc_item.custom_exchange_rate)
-        frappe.db.set_value("Landed Cost Item", lcv_doc_item.name, 'custom_base_assessed_value', custom_base_assessed_value)
-        lcv_doc_item.custom_base_assessed_value = custom_base_assessed_value
+    :return: Tax dict (see get_taxes_by_category), or None if no template matches.
+    """
+    def resolve_tariff_tax_rates():
+        tax_list = frappe.get_list("Item Tax Template",filters={'custom_customs_tariff_number':customs_tariff_number,
+                                                                'custom_country_of_origin':country_of_origin},
+                                   fields=['name'],pluck='name')
+        if len(tax_list) == 0:
+            return None
+        return get_taxes_by_category(tax_list[0])
+
+    return frappe.cache().hget(
+        TARIFF_TAX_RATES_CACHE_KEY,
+        f"{customs_tariff_number}::{country_of_origin}",
+        generator=resolve_tariff_tax_rates
+    )
 
+def clear_tariff_tax_rates_cache():
+    frappe.cache().delete_value(TARIFF_TAX_RATES_CACHE_KEY)
 
+def calculate_import_assessment(lcv_doc):
+    """
+    Calculate assessed values, duties and taxes of all LCV items in one pass of the assessment
+    engine, then write them with a single UPDATE. Nothing is committed here, the caller's
+    transaction covers the write.
+    """
+    print(f"lcv doc items are {lcv_doc.items}")
+    if not lcv_doc.items:
+        return
+    import_settings = frappe.get_single("Import Manager Settings")
+    valuation_basis = import_settings.imported_stock_valuation_basis
+
+    # All GD taxes will be rounded off, we are forcing it from backend,
+    # but I think it should be avoided, will be dealt later on
+    columns = {field: [item.get(field) for item in lcv_doc.items] for field in LCV_ASSESSMENT_INPUT_FIELDS + LCV_ASSESSMENT_FIELDS}
+    columns['qty'] = [get_item_qty_for_assessment(item, import_settings) for item in lcv_doc.items]
+    tariff_numbers = dict(frappe.get_all("Item",
+        filters={'name': ['in', list({item.item_code for item in lcv_doc.items})]},
+        fields=['name', 'customs_tariff_number'],
+        as_list=True
+    ))
+    columns['tax_rates'] = [
+        get_tariff_tax_rates(tariff_numbers.get(item.item_code), lcv_doc.custom_country_of_origin)
+        for item in lcv_doc.items
+    ]
 
+    try:
+        assessment = assess_items(columns, valuation_basis, manual_data_entry=lcv_doc.custom_manual_data_entry == 1)
     except Exception as e:
-        frappe.log_error(message=f"{e}",title="Error in calcualte assessed alue")
-
-
-
+        frappe.log_error(message=f"{e}",title="Error in calculate import assessment")
+        raise
 
+    for i, item in enumerate(lcv_doc.items):
+        for field in LCV_ASSESSMENT_FIELDS:
+            item.set(field, assessment[field][i])
+        # Following assertion not required for IAS2 Inventory
+        if columns['tax_rates'][i] is not None and valuation_basis == "Custom Assessed Value":
+            assert(item.amount + item.custom_base_assessment_difference == item.custom_base_assessed_value)
 
-def calculate_import_assessment(lcv_doc):
-    print(f"lcv doc items are {lcv_doc.items}")
-    for item in lcv_doc.items:
-        
-        calculate_assessed_value(item)
-        frappe.db.commit()
-        
-        calculate_import_taxes(item)
-        #lcv_doc.save()
-        #frappe.db.commit()
-    #frappe.db.commit()
+    bulk_set_values(
+        "Landed Cost Item",
+        {item.name: {field: item.get(field) for field in LCV_ASSESSMENT_FIELDS} for item in lcv_doc.items},
+        LCV_ASSESSMENT_FIELDS
+    )
 
 def get_taxes_by_category(tax_template_name):
     query = """
-            select custom_tax_category,tax_rate,custom_fixed_tax_amount,custom_fixed_tax_basis,custom_fixed_tax_uom from `tabItem Tax Template Detail` where parent = '{tax_template_name}';
-            """.format(tax_template_name=tax_template_name)
-    result = frappe.db.sql(query,as_dict=1)
+            select custom_tax_category,tax_rate,custom_fixed_tax_amount,custom_fixed_tax_basis,custom_fixed_tax_uom from `tabItem Tax Template Detail` where parent = %s
+            """
+    result = frappe.db.sql(query,(tax_template_name,),as_dict=1)
     taxes_dict = {}
     fixed_taxes = {}
     for item in result:
@@ -413,200 +548,154 @@ def get_taxes_by_category(tax_template_name):
     return taxes_dict
 
 def get_fixed_tax_amount_by_category(tax_dict,tax_category,lcv_item):
-    fixed_taxes = tax_dict.get('fixed_taxes',{})
-    fixed_tax_dict = fixed_taxes.get(tax_category,{})
-    
-    # Ensure fixed_tax_dict is a dictionary, not an integer
-    if not isinstance(fixed_tax_dict, dict):
-        return 0
-    
-    fixed_tax_amount = fixed_tax_dict.get('custom_fixed_tax_amount')
-    # Check if fixed_tax_amount is None or <= 0
-    if fixed_tax_amount is None or fixed_tax_amount <= 0:
-        return 0
-    
-    fixed_tax_basis = fixed_tax_dict.get('custom_fixed_tax_basis',0)
-    fixed_tax_uom = fixed_tax_dict.get('custom_fixed_tax_uom',0)
-    if lcv_item.custom_quantity_unit_type != fixed_tax_uom:
-        return 0
-    
-    final_fixed_tax_calculation = lcv_item.custom_no_of_units * fixed_tax_amount
-
-    return final_fixed_tax_calculation
-
-def get_fixed_tax_amount(lcv_item):
-    pass
-
-# Original problematic line:
-# lcv_item.custom_cd = round((tax_dict.get('CD',0)/100 *lcv_item.custom_base_assessed_value)+get_fixed_tax_amount_by_category(tax_dict,'CD',lcv_item),0)
-
-
-
-def calculate_import_taxes(lcv_item):
-    import_settings = frappe.get_single("Import Manager Settings")
-    imported_stock_valuation_basis = import_settings.imported_stock_valuation_basis
-    lcv_doc = frappe.get_doc("Landed Cost Voucher",lcv_item.parent)
-    item = frappe.get_doc("Item",lcv_item.item_code)
-    tax_list = frappe.get_list("Item Tax Template",filters={'custom_customs_tariff_number':item.customs_tariff_number,
-                                                            'custom_country_of_origin':lcv_doc.custom_country_of_origin},
-                               fields=['name'],pluck='name')
-    if len(tax_list) > 0:
-        # get taxes here
-        """
-        All GD taxes will be rounded off, we are forcing it from backend,
-        but I think it should be avoided, will be dealt later on
-        """
-        if lcv_doc.custom_manual_data_entry != 1:
-            tax_dict = get_taxes_by_category(tax_list[0])
-            
-            #lcv_item.custom_cd = 46512
-            #lcv_item.custom_custom_duty = 
-            custom_cd = round((tax_dict.get('CD',0)/100 *lcv_item.custom_base_assessed_value)+get_fixed_tax_amount_by_category(tax_dict,'CD',lcv_item),0)
-            #frappe.log_error(message=f"DEBUG taxdic.get {tax_dict.get('CD',0)/100}",title="tax dict debugging")
-            
-            frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_cd', custom_cd)
-            lcv_item.custom_cd = custom_cd
-
-            custom_acd = round(tax_dict.get('ACD',0)/100 * lcv_item.custom_base_assessed_value,0)
-            frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_acd', custom_acd)
-            lcv_item.custom_acd = custom_acd
-            
+    return get_fixed_tax_amount(tax_dict, tax_category, lcv_item.custom_quantity_unit_type, lcv_item.custom_no_of_units)
 
-            amount_for_sales_tax = round(lcv_item.custom_base_assessed_value + custom_cd + custom_acd,0)
-            
-            custom_ast = round(tax_dict.get('AST',0)/100 * amount_for_sales_tax,0)
-            custom_stamnt = round(tax_dict.get('Sales Tax',0)/100 * amount_for_sales_tax,0)
-            frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_ast', custom_ast)
-            lcv_item.custom_ast = custom_ast
-
-            frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_stamnt', custom_stamnt)
-            lcv_item.custom_stamnt = custom_stamnt
+class ImportDocContext:
+    """
+    Data shared by the stages of a single ImportDoc recompute.
+    Each lookup is done once, on first use, and reused by every stage that needs it.
+    """
 
+    def __init__(self, import_doc):
+        self.import_doc_name = import_doc.name
+        self.company = import_doc.company
+
+    @cached_property
+    def import_purchase_invoices(self):
+        # fetch_from values of linked_purchase_invoices are read here, as the totals
+        # are computed before the ImportDoc is saved
+        return frappe.get_list("Purchase Invoice",
+            filters={
+                'docstatus': 1,
+                'custom_purchase_invoice_type': 'Import',
+                'custom_import_document': self.import_doc_name
+            },
+            fields=['name', 'rounded_total', 'base_rounded_total', 'party_account_currency'],
+            ignore_permissions=True
+        )
 
-            amount_for_it = round(amount_for_sales_tax + custom_ast + custom_stamnt,0) + lcv_item.custom_fixed_surcharge_ait
-            custom_it = round(tax_dict.get('IT',0)/100 * amount_for_it,0)
-            frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_it', custom_it)
-            lcv_item.custom_it = custom_it
-        
-        custom_total_duties_and_taxes = lcv_item.custom_cd+lcv_item.custom_acd+lcv_item.custom_stamnt + lcv_item.custom_ast+lcv_item.custom_it
-        frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_total_duties_and_taxes', custom_total_duties_and_taxes)
-        lcv_item.custom_total_duties_and_taxes = custom_total_duties_and_taxes
-
-        # If imported stock valuation basis is Custom Assessed Value, then calculate base assessment difference
-        # Assessment difference is not applicable for IAS2 Inventory
-        if import_settings.imported_stock_valuation_basis == "Custom Assessed Value":
-            custom_base_assessment_difference = lcv_item.custom_base_assessed_value - lcv_item.amount
-            frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_base_assessment_difference', custom_base_assessment_difference)
-            lcv_item.custom_base_assessment_difference = custom_base_assessment_difference
-        else:
-            custom_base_assessment_difference = 0
-            frappe.db.set_value("Landed Cost Item", lcv_item.name, 'custom_base_assessment_difference', custom_base_assessment_difference)
-            lcv_item.custom_base_assessment_difference = custom_base_assessment_difference
+    @cached_property
+    def service_purchase_invoices(self):
+        return frappe.get_list("Purchase Invoice",filters={'docstatus':1,"custom_purchase_invoice_type":"Import Service Charges",
+                                                           "custom_import_document":self.import_doc_name},fields=['name'],pluck='name',ignore_permissions=True)
 
-        lcv_item.applicable_charges = lcv_item.custom_base_assessment_difference + lcv_item.custom_cd + lcv_item.custom_acd
-        frappe.db.set_value("Landed Cost Item", lcv_item.name, 'applicable_charges', lcv_item.applicable_charges)
-        # Following assertion not required for IAS2 Inventory
-        if imported_stock_valuation_basis == "Custom Assessed Value":
-            assert(lcv_item.amount + lcv_item.custom_base_assessment_difference == lcv_item.custom_base_assessed_value)
-        
-        
+    @cached_property
+    def customs_duty(self):
+        return get_customs_duty(self.import_doc_name)
 
-def update_import_charges_in_import(doc):
-    # This function will accumualte import charges in ImportDoc from Individual Doc
-    import_charges = []
-    data_dict = {}
-    import_doc = frappe.get_doc("ImportDoc",doc.custom_import_document)
+def get_import_charge_rows(doc):
+    """
+    Build linked_import_charges rows for a submitted Import Service Charges Purchase Invoice.
+    """
+    rows = []
     for item in doc.items:
-        data_dict['document_type'] = "Purchase Invoice"
-        data_dict['doc_name'] = doc.name
-        #data_dict['charge_item'] = item.item_name
-        data_dict['import_charge_type'] = item.item_name
-        data_dict['paid_to'] = doc.supplier
-        data_dict['amount'] = item.amount
-        data_dict['total_st'] = item.custom_st
-        data_dict['total_incl_tax'] = item.custom_total_incl_tax
-        #data_dict['purchase_invoice_item'] = item.name
-        import_doc.append("linked_import_charges",data_dict)
-    
-    import_doc.save()
+        rows.append({
+            'document_type': "Purchase Invoice",
+            'doc_name': doc.name,
+            'import_charge_type': item.item_name,
+            'paid_to': doc.supplier,
+            'amount': item.amount,
+            'total_st': item.custom_st,
+            'total_incl_tax': item.custom_total_incl_tax
+        })
+    return rows
 
-def update_line_items(import_doc_name):
-    linked_items = []
-    linked_pi = frappe.get_list("Purchase Invoice",filters={'docstatus':1,"custom_purchase_invoice_type":"Import",
-                                                               "custom_import_document":import_doc_name},fields=['name'],pluck='name',ignore_permissions=True)
-    
-    linked_items = frappe.get_list('Purchase Invoice Item',filters={'parent':['in',linked_pi]},fields=['name'],pluck='name',ignore_permissions=True)
-    print(linked_items)
-    import_doc = frappe.get_doc("ImportDoc",import_doc_name)
-    data_dict = {}
-    import_doc.items = []
-    for item in linked_items:
-        pi_item = frappe.get_doc("Purchase Invoice Item",item,ignore_permissions=True)
-        data_dict['purchase_invoice'] = pi_item.parent
-        data_dict['item_code'] = pi_item.item_code
-        data_dict['item_name'] = pi_item.item_name
-        data_dict['uom'] = pi_item.uom
-        data_dict['qty'] = pi_item.qty
-        data_dict['amount'] = pi_item.base_amount
-        data_dict['purchase_receipt_item']  = pi_item.name
-        import_doc.append("items",data_dict)
-    
-    import_doc.save()
+def get_line_item_rows(purchase_invoices):
+    """
+    Build ImportDoc items rows from the items of the given Import Purchase Invoices.
+    All items are read in a single query, whatever the number of invoices or lines.
+    """
+    if not purchase_invoices:
+        return []
+    pi = frappe.qb.DocType("Purchase Invoice")
+    pi_item = frappe.qb.DocType("Purchase Invoice Item")
+    return (
+        frappe.qb.from_(pi_item)
+        .inner_join(pi).on(pi.name == pi_item.parent)
+        .select(
+            pi_item.parent.as_("purchase_invoice"),
+            pi_item.item_code,
+            pi_item.item_name,
+            pi_item.uom,
+            pi_item.qty,
+            pi_item.base_amount.as_("amount"),
+            pi_item.name.as_("purchase_receipt_item")
+        )
+        .where(
+            (pi.name.isin(purchase_invoices))
+            & (pi.docstatus == 1)
+            & (pi_item.parenttype == "Purchase Invoice")
+        )
+        .orderby(pi.name)
+        .orderby(pi_item.idx)
+    ).run(as_dict=True)
+
+def update_line_items(import_doc, ctx):
+    linked_pi = [pi.name for pi in ctx.import_purchase_invoices]
+    import_doc.extend("items", get_line_item_rows(linked_pi))
+
+CUSTOMS_DUTY_FIELDS = {
+    'custom_duty': 'custom_cd',
+    'acd': 'custom_acd',
+    'cess': 'custom_cess_amount',
+    'stamnt': 'custom_stamnt',
+    'ast': 'custom_ast',
+    'it': 'custom_it'
+}
 
 def get_customs_duty(import_doc_name):
-    lcv = frappe.get_list("Landed Cost Voucher",filters={'custom_import_document':import_doc_name, 'docstatus':1},fields=['name'],pluck='name',ignore_permissions=True)
-    custom_duty = 0
-    acd = 0
-    cess = 0
-    stamnt = 0
-    ast = 0
-    it = 0
+    """
+    Total the duties of all submitted Landed Cost Vouchers of the ImportDoc, overall and by item code.
+    The sums are done in one grouped query over Landed Cost Item; the ImportDocContext keeps the
+    result for the rest of the recompute. LCVs without items still count, with zero duties.
+
+    :param import_doc_name: Name of the ImportDoc.
+    :return: dict with 'landed_cost_voucher_name' (latest LCV), 'item_wise_duty' and 'total'.
+    """
+    lcv = frappe.qb.DocType("Landed Cost Voucher")
+    lcv_item = frappe.qb.DocType("Landed Cost Item")
+    duty_rows = (
+        frappe.qb.from_(lcv)
+        .left_join(lcv_item).on(
+            (lcv_item.parent == lcv.name) & (lcv_item.parenttype == "Landed Cost Voucher")
+        )
+        .select(
+            lcv.name.as_("landed_cost_voucher"),
+            lcv_item.item_code,
+            *[Sum(Coalesce(lcv_item[field], 0)).as_(key) for key, field in CUSTOMS_DUTY_FIELDS.items()]
+        )
+        .where(
+            (lcv.custom_import_document == import_doc_name)
+            & (lcv.docstatus == 1)
+        )
+        .groupby(lcv.name, lcv_item.item_code)
+        .orderby(lcv.modified, order=frappe.qb.desc)
+    ).run(as_dict=True)
+
+    total = dict.fromkeys(CUSTOMS_DUTY_FIELDS, 0)
     item_wise_duty = {}
-    print(f"lcv is {lcv}")
-    
-    # Check if lcv list is empty
-    if not lcv:
-        return {
-            'landed_cost_voucher_name': None,
-            'item_wise_duty': item_wise_duty,
-            'total': {
-                'custom_duty': custom_duty,
-                'acd': acd,
-                'cess': cess,
-                'stamnt': stamnt,
-                'ast': ast,
-                'it': it
-            }
-        }
-    
-    for item in lcv:
-        lcv_doc = frappe.get_doc("Landed Cost Voucher",item,ignore_permissions=True)
-        for lcv_item in lcv_doc.items:
-            custom_duty += lcv_item.custom_cd
-            acd += lcv_item.custom_acd
-            cess += lcv_item.custom_cess_amount
-            stamnt += lcv_item.custom_stamnt
-            ast += lcv_item.custom_ast
-            it += lcv_item.custom_it
-            if lcv_item.item_code not in item_wise_duty:
-                item_wise_duty[lcv_item.item_code] = {'custom_duty':lcv_item.custom_cd,'acd':lcv_item.custom_acd,'cess':
-                lcv_item.custom_cess_amount,'stamnt':lcv_item.custom_stamnt,'ast':lcv_item.custom_ast,'it':lcv_item.custom_it}
-            elif lcv_item.item_code in item_wise_duty:
-                item_wise_duty[lcv_item.item_code]['custom_duty'] += lcv_item.custom_cd
-                item_wise_duty[lcv_item.item_code]['acd'] += lcv_item.custom_acd
-                item_wise_duty[lcv_item.item_code]['cess'] += lcv_item.custom_cess_amount
-                item_wise_duty[lcv_item.item_code]['stamnt'] += lcv_item.custom_stamnt
-                item_wise_duty[lcv_item.item_code]['ast'] += lcv_item.custom_ast
-                item_wise_duty[lcv_item.item_code]['it'] += lcv_item.custom_it
-        
-    return {'landed_cost_voucher_name':lcv[0],'item_wise_duty':item_wise_duty,'total':{'custom_duty':custom_duty,'acd':acd,'cess':cess,'stamnt':stamnt,'ast':ast,'it':it}}
+    for row in duty_rows:
+        # An LCV without items has one row with no item code
+        if row.item_code is None:
+            continue
+        item_duty = item_wise_duty.setdefault(row.item_code, dict.fromkeys(CUSTOMS_DUTY_FIELDS, 0))
+        for key in CUSTOMS_DUTY_FIELDS:
+            item_duty[key] += row[key]
+            total[key] += row[key]
+
+    return {
+        'landed_cost_voucher_name': duty_rows[0].landed_cost_voucher if duty_rows else None,
+        'item_wise_duty': item_wise_duty,
+        'total': total
+    }
 
     
-def update_misc_import_charges(import_doc_name):
+def update_misc_import_charges(import_doc, ctx):
     # This function will fetch all charges not covered in service invoices
     # For now it ll deal with LC Charges/ Any Exchange Gains/Losses
-    import_doc = frappe.get_doc("ImportDoc",import_doc_name)
-    lc_settlements = frappe.get_list("LC Settlement",filters={'import_document':import_doc_name,'docstatus':1},fields=['name','lc_charges','letter_of_credit_to_settle'],ignore_permissions=True
+    if not import_doc.linked_purchase_invoices:
+        return
+    lc_settlements = frappe.get_list("LC Settlement",filters={'import_document':ctx.import_doc_name,'docstatus':1},fields=['name','lc_charges','letter_of_credit_to_settle'],ignore_permissions=True
     )
     print(lc_settlements)
     if len(lc_settlements) > 0:
@@ -621,51 +710,48 @@ def update_misc_import_charges(import_doc_name):
             data_dict['amount'] = item['lc_charges']
             import_doc.append("linked_misc_import_charges",data_dict)
 
-    lcv_data = get_customs_duty(import_doc_name)
- 
+    for row in get_customs_duty_rows(ctx.customs_duty):
+        import_doc.append("linked_misc_import_charges", row)
+
+def get_customs_duty_rows(lcv_data):
+    """
+    Build the Customs Duty / Cess linked_misc_import_charges rows from get_customs_duty output.
+    """
+    rows = []
     custom_data = lcv_data['total']
-    
+
     total_customs_duty = custom_data['custom_duty'] + custom_data['acd']
     total_cess = custom_data['cess']
     lcv_doc = lcv_data['landed_cost_voucher_name']
-    
-    print(f"lcv data is {lcv_data}")
-    print(f"Total Custom Duty is {total_customs_duty}")
+
     # Only add customs duty entries if there are actual LCV documents
     if total_customs_duty >= 0 and lcv_doc:
-        import_doc.append("linked_misc_import_charges", {'import_charge_type':'Customs Duty',
+        rows.append({'import_charge_type':'Customs Duty',
         'amount':total_customs_duty,'document_type':'Landed Cost Voucher','document_name':lcv_doc,
         'paid_to':'Pakistan Customs'})
-        print('appended row')
-    
+
     if total_cess > 0 and lcv_doc:
-        import_doc.append("linked_misc_import_charges", {'import_charge_type':'Cess',
+        rows.append({'import_charge_type':'Cess',
         'amount':total_cess,'document_type':'Landed Cost Voucher','document_name':lcv_doc,
         'paid_to':'Sindh Excise and Taxation'})
-    
-    
 
-    import_doc.save()
+    return rows
 
-def update_unallocated_misc_charges_jv(import_doc_name):
+def update_unallocated_misc_charges_jv(import_doc, ctx):
     """
     Update the ImportDoc's misc import charges based on related Journal Entries.
 
-    :param import_doc_name: Name of the ImportDoc to update.
+    :param import_doc: ImportDoc being recomputed.
+    :param ctx: ImportDocContext of the recompute.
     """
-    import_doc = frappe.get_doc("ImportDoc", import_doc_name)
     
-    # Get the default unallocated import charges account from the Company document
-    company = frappe.get_doc("Company", import_doc.company)
-    unallocated_import_charges_account = company.custom_unallocated_import_charges_account
-
-    if not unallocated_import_charges_account:
-        frappe.throw(f"Please set 'Default Unallocated Import Charges Account' in the Company {import_doc.company}.")
+    # The unallocated import charges account must be set on the Company
+    get_import_accounts(import_doc.company, validate=False).validate(required=("unallocated_import_charges_account",))
 
     # Fetch submitted Journal Entries related to the ImportDoc
     journal_entries = frappe.get_list(
         "Journal Entry",
-        filters={"custom_import_document": import_doc_name, "docstatus": 1,'is_system_generated':0},ignore_permissions=True,
+        filters={"custom_import_document": ctx.import_doc_name, "docstatus": 1,'is_system_generated':0},ignore_permissions=True,
         fields=["name"]
     )
     
@@ -676,41 +762,45 @@ def update_unallocated_misc_charges_jv(import_doc_name):
     # Process each Journal Entry and update misc import charges
     for je in journal_entries:
         je_doc = frappe.get_doc("Journal Entry", je["name"],ignore_permissions=True)
-        for account in je_doc.accounts:
-            if account.debit_in_account_currency > 0:
-                # Prepare misc charges entry
-                misc_charge = {
-                    "import_charge_type": je_doc.custom_import_charge_type,
-                    #"amount": account.debit_in_account_currency - account.credit_in_account_currency,
-                    "amount":account.debit_in_account_currency,
-                    "document_type": "Journal Entry",
-                    "document_name": je_doc.name
-                }
-                
-                # Include party information if available
-                if account.party:
-                    misc_charge["paid_to"] = account.party
+        for misc_charge in get_journal_entry_misc_charge_rows(je_doc):
+            import_doc.append("linked_misc_import_charges", misc_charge)
 
-                # Append the charge to ImportDoc
-                import_doc.append("linked_misc_import_charges", misc_charge)
+def get_journal_entry_misc_charge_rows(je_doc):
+    """
+    Build linked_misc_import_charges rows from the debit lines of a manual Journal Entry.
+    """
+    rows = []
+    for account in je_doc.accounts:
+        if account.debit_in_account_currency > 0:
+            # Prepare misc charges entry
+            misc_charge = {
+                "import_charge_type": je_doc.custom_import_charge_type,
+                #"amount": account.debit_in_account_currency - account.credit_in_account_currency,
+                "amount":account.debit_in_account_currency,
+                "document_type": "Journal Entry",
+                "document_name": je_doc.name
+            }
 
-    # Save the updated ImportDoc
-    import_doc.save()
-    #frappe.msgprint(f"Misc import charges updated for ImportDoc {import_doc_name}.")
+            # Include party information if available
+            if account.party:
+                misc_charge["paid_to"] = account.party
+
+            rows.append(misc_charge)
+    return rows
 
 
-def update_cash_payment_vouchers(import_doc_name):
+def update_cash_payment_vouchers(import_doc, ctx):
     """
     Update the ImportDoc's misc import charges based on related Cash Payment Vouchers.
 
-    :param import_doc_name: Name of the ImportDoc to update.
+    :param import_doc: ImportDoc being recomputed.
+    :param ctx: ImportDocContext of the recompute.
     """
-    import_doc = frappe.get_doc("ImportDoc", import_doc_name)
     
     # Fetch submitted Cash Payment Vouchers related to the ImportDoc
     cash_payment_vouchers = frappe.get_list(
         "Cash Payment Voucher",
-        filters={"import_document": import_doc_name, "docstatus": 1},
+        filters={"import_document": ctx.import_doc_name, "docstatus": 1},
         fields=["name"],
         ignore_permissions=True
     )
@@ -721,50 +811,38 @@ def update_cash_payment_vouchers(import_doc_name):
     # Process each Cash Payment Voucher and update misc import charges
     for cpv in cash_payment_vouchers:
         cpv_doc = frappe.get_doc("Cash Payment Voucher", cpv["name"], ignore_permissions=True)
-        
-        # Prepare misc charges entry
-        misc_charge = {
-            "import_charge_type": cpv_doc.import_charge_type,
-            "amount": cpv_doc.total_payment,
-            "document_type": "Cash Payment Voucher",
-            "document_name": cpv_doc.name
-        }
-        
-        # Include paid_to information if available
-        if cpv_doc.paid_to:
-            misc_charge["paid_to"] = cpv_doc.paid_to
 
         # Append the charge to ImportDoc
-        import_doc.append("linked_misc_import_charges", misc_charge)
-
-    # Save the updated ImportDoc
-    import_doc.save()
-
-
-def bulk_update_import_charges(import_doc_name):
-    linked_pi = frappe.get_list("Purchase Invoice",filters={'docstatus':1,"custom_purchase_invoice_type":"Import Service Charges",
-                                                               "custom_import_document":import_doc_name},fields=['name'],pluck='name',ignore_permissions=True)
-
-    
-
-    for item in linked_pi:
-        
-        update_import_charges_in_import(frappe.get_doc("Purchase Invoice",item,ignore_permissions=True))
-
+        import_doc.append("linked_misc_import_charges", get_cash_payment_voucher_misc_charge_row(cpv_doc))
 
-    #frappe.db.commit()
+def get_cash_payment_voucher_misc_charge_row(cpv_doc):
+    """
+    Build the linked_misc_import_charges row for a Cash Payment Voucher.
+    """
+    misc_charge = {
+        "import_charge_type": cpv_doc.import_charge_type,
+        "amount": cpv_doc.total_payment,
+        "document_type": "Cash Payment Voucher",
+        "document_name": cpv_doc.name
+    }
 
+    # Include paid_to information if available
+    if cpv_doc.paid_to:
+        misc_charge["paid_to"] = cpv_doc.paid_to
 
-    
+    return misc_charge
 
 
+def bulk_update_import_charges(import_doc, ctx):
+    # This function will accumualte import charges in ImportDoc from the Import Service Charges invoices
+    for item in ctx.service_purchase_invoices:
+        pi_doc = frappe.get_doc("Purchase Invoice",item,ignore_permissions=True)
+        for row in get_import_charge_rows(pi_doc):
+            import_doc.append("linked_import_charges",row)
 
-
-def calculate_total_import_charges(import_doc_name):
+def calculate_total_import_charges(import_doc, ctx):
     # this function will loop over all ex tax import charges and accumualte them for
     # allocating to item
-    import_doc = frappe.get_doc("ImportDoc",import_doc_name)
-    
     total_import_charges = sum(row.amount for row in import_doc.linked_import_charges) or 0
     total_service_sales_tax = sum(row.total_st for row in import_doc.linked_import_charges) or 0
     total_misc_import_charges = sum(row.amount for row in import_doc.linked_misc_import_charges) or 0
@@ -777,9 +855,6 @@ def calculate_total_import_charges(import_doc_name):
     import_doc.total_customs_duty = total_customs_duty
     import_doc.sales_tax_on_services = total_service_sales_tax
 
-
-    import_doc.save()
-
 def get_landed_cost_item(import_doc_name,purchase_receipt_item,ignore_permissions=False):
     """
     This function will return the appropirately landed cost item for PR/PI Item if avialable, to 
@@ -793,15 +868,35 @@ def get_landed_cost_item(import_doc_name,purchase_receipt_item,ignore_permission
         return None
     return frappe.get_doc("Landed Cost Item",lcv_item[0],ignore_permissions=True)
 
-def allocate_import_charges(import_doc_name):
+def get_landed_cost_items(purchase_receipt_items):
+    """
+    Batch version of get_landed_cost_item: fetch the submitted Landed Cost Items of all
+    the given PR/PI Items in one query.
+
+    :param purchase_receipt_items: List of Purchase Receipt/Invoice Item names.
+    :return: dict of purchase_receipt_item -> Landed Cost Item row (latest one if there are several).
+    """
+    if not purchase_receipt_items:
+        return {}
+    lcv_items = frappe.get_list("Landed Cost Item",
+        filters={'purchase_receipt_item': ['in', list(purchase_receipt_items)], 'docstatus': 1},
+        fields=['purchase_receipt_item', 'custom_base_assessed_value', 'custom_base_assessment_difference', 'custom_it'],
+        order_by='modified desc',
+        ignore_permissions=True
+    )
+    landed_cost_items = {}
+    for lcv_item in lcv_items:
+        landed_cost_items.setdefault(lcv_item.purchase_receipt_item, lcv_item)
+    return landed_cost_items
+
+def allocate_import_charges(import_doc, ctx):
     # Import Charges Will be allocated proporitanlly as per item amount
     #TODO: This function should striclty be tested for ImportDoc where multiple Items are added
-    # TODO: This function shoudl be optimzied the way it pulls the import charges from LCV. 
-    
-    time.sleep(3)
+    if not import_doc.linked_purchase_invoices:
+        return
+
     print('allocate import charges executed')
-    import_doc = frappe.get_doc("ImportDoc",import_doc_name)
-    import_taxes_data = get_customs_duty(import_doc_name)
+    import_taxes_data = ctx.customs_duty
     item_wise_total_duty = import_taxes_data['item_wise_duty']
     print(f"Item Wise Total Duty {item_wise_total_duty}")
     # Update Totals In Import Doc
@@ -814,10 +909,11 @@ def allocate_import_charges(import_doc_name):
     print(f"ImportDOc Total Import Charges {import_doc.total_import_charges}")
     if import_doc.total_import_charges >= 0:
         total_items_amount = sum(row.amount for row in import_doc.items)
+        landed_cost_items = get_landed_cost_items([item.purchase_receipt_item for item in import_doc.items])
         for item in import_doc.items:
             item_customs_duty = 0
             item_sales_tax = 0
-            lcv_item = get_landed_cost_item(import_doc_name,item.purchase_receipt_item,ignore_permissions=True)
+            lcv_item = landed_cost_items.get(item.purchase_receipt_item)
 
 
             
@@ -846,9 +942,7 @@ def allocate_import_charges(import_doc_name):
         import_doc.sales_tax_on_import = import_taxes_data['total']['stamnt']+import_taxes_data['total']['ast']
         import_doc.total_income_tax = import_taxes_data['total']['it']
         import_doc.total_import_value = import_doc.total_cost + import_doc.sales_tax_on_import+import_doc.sales_tax_on_services + import_doc.total_income_tax
-        import_doc.save()
 
-    
 
 
 
@@ -878,86 +972,330 @@ def set_expense_head(doc, method):
         # Indicate that the document has been modified
         doc.flags.ignore_validate_update_after_submit = True
 
-def update_purchase_invoices(import_doc_name):
+def get_linked_purchase_invoice_row(pi):
+    """
+    Build the linked_purchase_invoices row for an Import Purchase Invoice.
+    The fetch_from fields are filled in here as the totals are computed before the ImportDoc is saved.
+    """
+    return {
+        "purchase_invoice": pi.name,
+        "total_value": pi.rounded_total,
+        "total_base_value": pi.base_rounded_total,
+        "party_account_currency": pi.party_account_currency
+    }
+
+def update_purchase_invoices(import_doc, ctx):
     """
     Update the ImportDoc's linked_purchase_invoices table with related Purchase Invoices.
     Only includes Purchase Invoices that are submitted and of type 'Import'.
 
-    :param import_doc_name: Name of the ImportDoc to update
+    :param import_doc: ImportDoc being recomputed.
+    :param ctx: ImportDocContext of the recompute.
     """
-    # Get list of submitted Import Purchase Invoices linked to this ImportDoc
-    linked_pi = frappe.get_list("Purchase Invoice",
-        filters={
-            'docstatus': 1,
-            'custom_purchase_invoice_type': 'Import',
-            'custom_import_document': import_doc_name
-        },
-        fields=['name']
-    )
-    
-    # Get the ImportDoc
-    import_doc = frappe.get_doc("ImportDoc", import_doc_name)
-    
-    # Clear existing linked purchase invoices
+    for pi in ctx.import_purchase_invoices:
+        import_doc.append("linked_purchase_invoices", get_linked_purchase_invoice_row(pi))
+
+# Stages of a full ImportDoc rebuild, in order. Each stage works on the in-memory
+# ImportDoc and the shared ImportDocContext, the ImportDoc is saved once at the end.
+IMPORT_DOC_REBUILD_STAGES = (
+    update_purchase_invoices,
+    update_line_items,
+    bulk_update_import_charges,
+    update_misc_import_charges,
+    update_unallocated_misc_charges_jv,
+    update_cash_payment_vouchers,
+    calculate_total_import_charges,
+    allocate_import_charges,
+)
+
+# Stages re-run after an incremental patch of the linked tables
+IMPORT_DOC_TOTALS_STAGES = (
+    calculate_total_import_charges,
+    allocate_import_charges,
+)
+
+# Past this many vouchers in one recompute a full rebuild is cheaper than patching
+MAX_INCREMENTAL_VOUCHERS = 25
+
+# Pending recompute marker for a full rebuild (e.g. "Update Import Data")
+FULL_REBUILD = "__full_rebuild__"
+
+def run_import_doc_pipeline(import_doc, stages, ctx=None):
+    """
+    Run the given stages against the in-memory ImportDoc and save it once.
 
-    
-    # Add each Purchase Invoice to the table
-    for pi in linked_pi:
-        import_doc.append("linked_purchase_invoices", {
-            "purchase_invoice": pi.name
-            # Other fields (total_value, total_base_value, party_account_currency)
-            # will be auto-fetched due to fetch_from properties in the DocType
-        })
-    
-    # Save the ImportDoc
+    :param import_doc: ImportDoc document.
+    :param stages: Iterable of stage functions taking (import_doc, ctx).
+    :param ctx: (Optional) ImportDocContext to reuse.
+    """
+    ctx = ctx or ImportDocContext(import_doc)
+    for stage in stages:
+        stage(import_doc, ctx)
     import_doc.save()
 
+def remove_import_doc_rows(import_doc, parentfield, condition):
+    """
+    Drop the child rows of `parentfield` matching `condition` and renumber the rest.
+    """
+    rows = [row for row in import_doc.get(parentfield) if not condition(row)]
+    for idx, row in enumerate(rows, start=1):
+        row.idx = idx
+    import_doc.set(parentfield, rows)
+
+def patch_import_doc_for_voucher(import_doc, ctx, voucher_type, voucher_no, action):
+    """
+    Replace, in memory, only the ImportDoc child rows that come from a single voucher.
+
+    :param import_doc: ImportDoc being recomputed.
+    :param ctx: ImportDocContext of the recompute.
+    :param voucher_type: Doctype of the triggering voucher.
+    :param voucher_no: Name of the triggering voucher.
+    :param action: 'submit' or 'cancel'.
+    :return: False if the voucher can't be applied incrementally.
+    """
+    if action not in ("submit", "cancel"):
+        return False
+
+    voucher = frappe.get_doc(voucher_type, voucher_no)
+    # Rows are only added back for vouchers which are still submitted
+    is_submit = action == "submit" and voucher.docstatus == 1
+
+    if voucher_type == "Purchase Invoice":
+        if voucher.custom_purchase_invoice_type == "Import Service Charges":
+            remove_import_doc_rows(import_doc, "linked_import_charges", lambda row: row.doc_name == voucher_no)
+            if is_submit:
+                for row in get_import_charge_rows(voucher):
+                    import_doc.append("linked_import_charges", row)
+
+        elif voucher.custom_purchase_invoice_type == "Import":
+            remove_import_doc_rows(import_doc, "linked_purchase_invoices", lambda row: row.purchase_invoice == voucher_no)
+            remove_import_doc_rows(import_doc, "items", lambda row: row.purchase_invoice == voucher_no)
+            if is_submit:
+                import_doc.append("linked_purchase_invoices", get_linked_purchase_invoice_row(voucher))
+                import_doc.extend("items", get_line_item_rows([voucher_no]))
+
+        # Other invoice types don't contribute to the ImportDoc
+
+    elif voucher_type == "Journal Entry":
+        remove_import_doc_rows(import_doc, "linked_misc_import_charges",
+            lambda row: row.document_type == "Journal Entry" and row.document_name == voucher_no)
+        if is_submit and not voucher.is_system_generated:
+            for row in get_journal_entry_misc_charge_rows(voucher):
+                import_doc.append("linked_misc_import_charges", row)
+
+    elif voucher_type == "Cash Payment Voucher":
+        remove_import_doc_rows(import_doc, "linked_misc_import_charges",
+            lambda row: row.document_type == "Cash Payment Voucher" and row.document_name == voucher_no)
+        if is_submit:
+            import_doc.append("linked_misc_import_charges", get_cash_payment_voucher_misc_charge_row(voucher))
+
+    elif voucher_type == "Landed Cost Voucher":
+        # Customs rows are consolidated over all LCVs, so they are rebuilt as a whole
+        remove_import_doc_rows(import_doc, "linked_misc_import_charges",
+            lambda row: row.document_type == "Landed Cost Voucher")
+        if import_doc.linked_purchase_invoices:
+            for row in get_customs_duty_rows(ctx.customs_duty):
+                import_doc.append("linked_misc_import_charges", row)
+
+    else:
+        return False
+
+    return True
+
+def refresh_import_doc_for_vouchers(import_doc_name, vouchers):
+    """
+    Incrementally patch the ImportDoc for a set of submitted or cancelled vouchers.
+    Only the child rows coming from those vouchers are replaced, then totals and
+    allocation are recomputed and the ImportDoc is saved once.
+
+    :param import_doc_name: Name of the ImportDoc to update.
+    :param vouchers: List of (voucher_type, voucher_no, action) tuples.
+    :return: False if the vouchers can't be applied incrementally and a full rebuild is required.
+    """
+    if len(vouchers) > MAX_INCREMENTAL_VOUCHERS:
+        return False
+
+    import_doc = frappe.get_doc("ImportDoc", import_doc_name)
+    ctx = ImportDocContext(import_doc)
+    had_purchase_invoices = bool(import_doc.linked_purchase_invoices)
+
+    for voucher_type, voucher_no, action in vouchers:
+        if not patch_import_doc_for_voucher(import_doc, ctx, voucher_type, voucher_no, action):
+            return False
+
+    # LC Settlement and customs rows only exist while import invoices are linked
+    if bool(import_doc.linked_purchase_invoices) != had_purchase_invoices:
+        return False
+
+    run_import_doc_pipeline(import_doc, IMPORT_DOC_TOTALS_STAGES, ctx)
+    return True
+
+def rebuild_import_doc(import_doc_name):
+    """
+    Full refresh of the ImportDoc: clear all linked tables and rebuild them from scratch.
+    """
+    import_doc = frappe.get_doc("ImportDoc", import_doc_name)
+    import_doc.items = []
+    import_doc.linked_import_charges = []
+    import_doc.linked_misc_import_charges = []
+    import_doc.linked_purchase_invoices = []
+    run_import_doc_pipeline(import_doc, IMPORT_DOC_REBUILD_STAGES)
+
 @frappe.whitelist()
-def update_data_in_import_doc(import_doc_name):
-    # Prevent concurrent updates
-    updating_status = frappe.db.get_value("ImportDoc", import_doc_name, "custom_updating")
-    if updating_status == 1:  # Explicitly check for 1, not truthy
-        print("Already updating, skip")
-        frappe.log_error(f"ImportDoc {import_doc_name} already being updated", "Duplicate Update Prevented")
-        return
-    
-    # Set updating flag
-    frappe.db.set_value("ImportDoc", import_doc_name, "custom_updating", 1)
-    frappe.db.commit()
-    
+def update_data_in_import_doc(import_doc_name, voucher_type=None, voucher_no=None, action=None):
+    """
+    Refresh the ImportDoc data. When the triggering voucher is given, only the rows
+    affected by it are patched; otherwise (or if patching isn't possible) the whole
+    ImportDoc is rebuilt.
+    If another update holds the ImportDoc, the refresh is queued to run after it.
+
+    :param import_doc_name: Name of the ImportDoc to update.
+    :param voucher_type: (Optional) Doctype of the voucher that triggered the update.
+    :param voucher_no: (Optional) Name of the voucher that triggered the update.
+    :param action: (Optional) 'submit' or 'cancel'.
+    """
+    vouchers = [(voucher_type, voucher_no, action)] if voucher_type and voucher_no else None
+    if not recompute_import_doc(import_doc_name, vouchers):
+        enqueue_import_doc_recompute(import_doc_name, voucher_type, voucher_no, action)
+        frappe.msgprint(
+            _("ImportDoc {0} is being updated by another process. Your update has been queued and will run after it.").format(import_doc_name),
+            alert=True
+        )
+
+def recompute_import_doc(import_doc_name, vouchers=None):
+    """
+    Recompute the ImportDoc, incrementally for the given vouchers if possible,
+    otherwise with a full rebuild. Runs under the ImportDoc lock and commits before
+    releasing it.
+
+    :param import_doc_name: Name of the ImportDoc to update.
+    :param vouchers: (Optional) List of (voucher_type, voucher_no, action) tuples.
+    :return: False if the lock couldn't be acquired within IMPORT_DOC_LOCK_WAIT seconds.
+    """
+    lock = ImportDocLock(import_doc_name)
+    if not lock.acquire():
+        return False
+
     try:
         print("Updating Import Doc")
-        doc = frappe.get_doc("ImportDoc", import_doc_name)
-        doc.items = []
-        doc.linked_import_charges = []
-        doc.linked_misc_import_charges = []
-        doc.linked_purchase_invoices = []
-        doc.save()
-        print("Updated Import Doc")
-        update_purchase_invoices(import_doc_name)
-        update_line_items(import_doc_name)
-        bulk_update_import_charges(import_doc_name)
-        print("Updated Import Charges")
-        doc.reload()
-        if doc.linked_purchase_invoices:
-            update_misc_import_charges(import_doc_name)
-        print("Updated Misc Import Charges")
-        update_unallocated_misc_charges_jv(import_doc_name)
-        update_cash_payment_vouchers(import_doc_name)
-        print("Updated Cash Payment Vouchers")
-        calculate_total_import_charges(import_doc_name)
-        print("Updated Total Import Charges")
-        if doc.linked_purchase_invoices:
-            allocate_import_charges(import_doc_name)
-        print("Updated Allocate Import Charges")
+        if not (vouchers and refresh_import_doc_for_vouchers(import_doc_name, vouchers)):
+            rebuild_import_doc(import_doc_name)
+        frappe.db.commit()
     except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(f"ImportDoc update failed: {str(e)}", f"ImportDoc {import_doc_name}")
         raise
     finally:
-        # Clear updating flag
-        frappe.db.set_value("ImportDoc", import_doc_name, "custom_updating", 0)
-        frappe.db.commit()
+        lock.release()
+        # Updates that gave up waiting for us are picked up now that the lock is free
+        if frappe.cache().hgetall(get_pending_recompute_key(import_doc_name)):
+            schedule_import_doc_recompute(import_doc_name)
     print("Import Doc updated")
+    return True
+
+def get_pending_recompute_key(import_doc_name):
+    return f"importmanager:import_doc_recompute:{import_doc_name}"
+
+def get_scheduled_recompute_key(import_doc_name):
+    return f"importmanager:import_doc_recompute_scheduled:{import_doc_name}"
+
+def publish_import_doc_recompute_status(import_doc_name, status, message=None):
+    """
+    Let open ImportDoc forms know about the state of the background recompute.
+    """
+    frappe.publish_realtime(
+        "import_doc_recompute",
+        {"import_doc": import_doc_name, "status": status, "message": message},
+        doctype="ImportDoc",
+        docname=import_doc_name
+    )
+
+def enqueue_import_doc_recompute(import_doc_name, voucher_type=None, voucher_no=None, action=None):
+    """
+    Queue a background recompute of the ImportDoc.
+    Vouchers are collected per ImportDoc and at most one job is scheduled at a time,
+    so a burst of vouchers for the same shipment is applied in a single recompute.
+
+    :param import_doc_name: Name of the ImportDoc to update.
+    :param voucher_type: (Optional) Doctype of the voucher that triggered the update.
+    :param voucher_no: (Optional) Name of the voucher that triggered the update.
+    :param action: (Optional) 'submit' or 'cancel'.
+    """
+    if voucher_type and voucher_no:
+        pending_voucher = f"{voucher_type}::{voucher_no}"
+    else:
+        pending_voucher = FULL_REBUILD
+    # Only the last action of a voucher matters
+    frappe.cache().hset(get_pending_recompute_key(import_doc_name), pending_voucher, action)
+
+    schedule_import_doc_recompute(import_doc_name)
+    publish_import_doc_recompute_status(import_doc_name, "Queued")
+
+def schedule_import_doc_recompute(import_doc_name):
+    """
+    Enqueue the recompute job unless one is already scheduled and hasn't started draining yet.
+    The flag expires with the lock TTL so a lost job can't block scheduling for good.
+    """
+    cache = frappe.cache()
+    if cache.set(cache.make_key(get_scheduled_recompute_key(import_doc_name)), 1, nx=True, ex=IMPORT_DOC_LOCK_TTL):
+        frappe.enqueue(
+            "importmanager.import_utils.process_import_doc_recompute",
+            queue="default",
+            import_doc_name=import_doc_name
+        )
+
+def process_import_doc_recompute(import_doc_name):
+    """
+    Background job: apply every pending voucher of the ImportDoc in one recompute.
+    Vouchers queued while the job is running are picked up before it exits.
+    """
+    cache = frappe.cache()
+    key = get_pending_recompute_key(import_doc_name)
+    pending = {}
+    publish_import_doc_recompute_status(import_doc_name, "Running")
+    try:
+        while True:
+            # Clear the flag before reading, so a voucher queued after this point schedules a new job
+            cache.delete_value(get_scheduled_recompute_key(import_doc_name))
+            pending = cache.hgetall(key)
+            if not pending:
+                break
+
+            for pending_voucher in pending:
+                cache.hdel(key, pending_voucher)
+
+            if FULL_REBUILD in pending:
+                vouchers = None
+            else:
+                vouchers = [(*pending_voucher.split("::", 1), action) for pending_voucher, action in pending.items()]
+
+            if not recompute_import_doc(import_doc_name, vouchers):
+                # Keep the vouchers, the lock holder schedules a new run when it releases the lock
+                restore_pending_vouchers(import_doc_name, pending)
+                # The holder may have released the lock before the vouchers were put back
+                if not get_import_doc_lock_owner(import_doc_name):
+                    schedule_import_doc_recompute(import_doc_name)
+                publish_import_doc_recompute_status(import_doc_name, "Waiting", "Another update of this ImportDoc is running")
+                return
+    except Exception as e:
+        # Keep the vouchers of the failed run, so the ImportDoc is brought up to date by the next run
+        # instead of silently staying stale. Not rescheduled here, to not retry a failing update in a loop.
+        restore_pending_vouchers(import_doc_name, pending)
+        publish_import_doc_recompute_status(import_doc_name, "Failed", str(e))
+        raise
+
+    publish_import_doc_recompute_status(import_doc_name, "Completed")
+
+def restore_pending_vouchers(import_doc_name, pending):
+    """
+    Put back vouchers taken from the pending hash, unless they were queued again meanwhile
+    (the newer action wins).
+    """
+    cache = frappe.cache()
+    key = get_pending_recompute_key(import_doc_name)
+    for pending_voucher, action in pending.items():
+        if cache.hget(key, pending_voucher) is None:
+            cache.hset(key, pending_voucher, action)
 
 
 def generate_outstanding_payments_report():
@@ -1006,25 +1344,25 @@ def generate_outstanding_payments_report():
 def on_submit_purchase_invoice(doc, method):
     if doc.custom_import_document:
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.custom_import_document)
+            lambda: enqueue_import_doc_recompute(doc.custom_import_document, doc.doctype, doc.name, "submit")
         )
 
 def on_cancel_purchase_invoice(doc, method):
     if doc.custom_import_document:
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.custom_import_document)
+            lambda: enqueue_import_doc_recompute(doc.custom_import_document, doc.doctype, doc.name, "cancel")
         )
 
 def on_submit_journal_entry(doc, method):
     if doc.custom_import_document:
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.custom_import_document)
+            lambda: enqueue_import_doc_recompute(doc.custom_import_document, doc.doctype, doc.name, "submit")
         )
 
 def on_cancel_journal_entry(doc, method):
     if doc.custom_import_document:
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.custom_import_document)
+            lambda: enqueue_import_doc_recompute(doc.custom_import_document, doc.doctype, doc.name, "cancel")
         )
 
 def on_submit_landed_cost_voucher(doc, method):
@@ -1037,25 +1375,25 @@ def on_submit_landed_cost_voucher(doc, method):
         #create_import_taxes_jv(doc.name)
         
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.custom_import_document)
+            lambda: enqueue_import_doc_recompute(doc.custom_import_document, doc.doctype, doc.name, "submit")
         )
 
 def on_cancel_landed_cost_voucher(doc, method):
     if doc.custom_import_document:
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.custom_import_document)
+            lambda: enqueue_import_doc_recompute(doc.custom_import_document, doc.doctype, doc.name, "cancel")
         )
 
 def on_submit_cash_payment_voucher(doc, method):
     if doc.import_document:
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.import_document)
+            lambda: enqueue_import_doc_recompute(doc.import_document, doc.doctype, doc.name, "submit")
         )
 
 def on_cancel_cash_payment_voucher(doc, method):
     if doc.import_document:
         frappe.db.after_commit.add(
-            lambda: update_data_in_import_doc(doc.import_document)
+            lambda: enqueue_import_doc_recompute(doc.import_document, doc.doctype, doc.name, "cancel")
         )
 
 
@@ -1067,14 +1405,6 @@ def autoname_purchase_invoice(doc, method):
     Autoname Purchase Invoice using fiscal year based on document date.
     Uses existing naming logic, replacing current year with fiscal year name.
     """
-    def ensure_unique_name(doctype, base_name):
-        """Append -1/-2/... if name exists."""
-        candidate = base_name
-        counter = 1
-        while frappe.db.exists(doctype, candidate):
-            candidate = f"{base_name}-{counter}"
-            counter += 1
-        return candidate
     # Determine fiscal year based on posting_date and company
     fiscal_year_name = None
     try:
@@ -1100,7 +1430,7 @@ def autoname_purchase_invoice(doc, method):
             import_doc = frappe.get_doc("ImportDoc", doc.custom_import_document)
             if getattr(import_doc, 'gd_no', None):
                 base_name = f"{company_abbr}-IPI-{fiscal_year_name}-{import_doc.gd_no}"
-                doc.name = ensure_unique_name("Purchase Invoice", base_name)
+                doc.name = get_next_name("Purchase Invoice", base_name)
 
     elif doc.custom_purchase_invoice_type == "Local Purchase":
         if doc.is_return:
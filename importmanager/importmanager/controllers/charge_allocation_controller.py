@@ -3,9 +3,101 @@ This controller will provide various utility functions to
 handle allocation charges
 """
 import frappe
-from frappe.utils import flt, nowdate, nowtime
-from importmanager.import_utils import create_gl_entries
-import time
+from frappe.query_builder.functions import IfNull
+from frappe.utils import flt, now, nowdate, nowtime
+from erpnext import get_default_cost_center
+from erpnext.accounts.general_ledger import make_gl_entries
+from importmanager.import_account_utils import get_import_accounts
+from importmanager.import_utils import bulk_set_values
+from importmanager.importmanager.doctype.charge_allocation_balance.charge_allocation_balance import (
+    update_charge_allocation_balance
+)
+from importmanager.importmanager.controllers.fifo_layers import (
+    get_layer_deltas,
+    merge_layer_deltas,
+    plan_fifo_consumption,
+    plan_return
+)
+
+def get_charge_allocation_gl_legs(company, charge_type, charges, is_return):
+    """
+    Debit and credit legs of an allocation of charges on a Sales Invoice.
+    For returns, debit and credit are swapped.
+
+    :param company: Company of the Sales Invoice.
+    :param charge_type: Type of charge ('Import Charges' or 'Assessment Variance').
+    :param charges: Allocated charges (absolute value).
+    :param is_return: Whether the Sales Invoice is a return.
+    :return: List of dicts with account, debit, credit and against.
+    """
+    # Import accounts of the Company, required ones are validated by the resolver
+    accounts = get_import_accounts(company)
+    unallocated_import_charges_account = accounts.unallocated_import_charges_account
+    default_import_charges_account = accounts.default_import_charges_account
+    default_import_assessment_account = accounts.assessment_variance_account
+    assessment_variance_charges_account = accounts.default_import_assessment_charge_account
+
+    if charge_type == "Import Charges":
+        debit_account = unallocated_import_charges_account if is_return else default_import_charges_account
+        credit_account = default_import_charges_account if is_return else unallocated_import_charges_account
+    elif charge_type == "Assessment Variance":
+        debit_account = assessment_variance_charges_account if is_return else default_import_assessment_account
+        credit_account = default_import_assessment_account if is_return else assessment_variance_charges_account
+
+    return [
+        {"account": debit_account, "debit": charges, "credit": 0, "against": credit_account},
+        {"account": credit_account, "debit": 0, "credit": charges, "against": debit_account}
+    ]
+
+def merge_gl_legs(legs):
+    """
+    Merge legs by account, netting debits and credits, so the number of GL Entries
+    depends on the accounts used rather than on the number of invoice lines.
+    """
+    merged = {}
+    for leg in legs:
+        account = merged.setdefault(leg["account"], {"account": leg["account"], "balance": 0, "against": set()})
+        account["balance"] += flt(leg["debit"]) - flt(leg["credit"])
+        account["against"].add(leg["against"])
+
+    return [
+        {
+            "account": account["account"],
+            "debit": account["balance"] if account["balance"] > 0 else 0,
+            "credit": -account["balance"] if account["balance"] < 0 else 0,
+            "against": ", ".join(sorted(account["against"]))
+        }
+        for account in merged.values()
+        if account["balance"]
+    ]
+
+def make_charge_allocation_gl_entries(sales_invoice, legs, posting_date=None):
+    """
+    Post the allocation legs of a Sales Invoice with ERPNext's make_gl_entries, in one call.
+
+    :param sales_invoice: Sales Invoice document.
+    :param legs: Legs from get_charge_allocation_gl_legs.
+    :param posting_date: (Optional) Posting date, defaults to the invoice's.
+    """
+    cost_center = get_default_cost_center(sales_invoice.company)
+    gl_map = []
+    for leg in merge_gl_legs(legs):
+        args = {
+            "account": leg["account"],
+            "against": leg["against"],
+            "debit": leg["debit"],
+            "credit": leg["credit"],
+            "debit_in_account_currency": leg["debit"],
+            "credit_in_account_currency": leg["credit"],
+            "cost_center": cost_center
+        }
+        if posting_date:
+            # Passed to get_gl_dict so the fiscal year is taken from this date, not the invoice's
+            args["posting_date"] = posting_date
+        gl_map.append(sales_invoice.get_gl_dict(args, item=None))
+
+    if gl_map:
+        make_gl_entries(gl_map, merge_entries=False, update_outstanding="No")
 
 def create_charge_allocation_gl(posting_date, charges, reference_doc_name, charge_type):
     """
@@ -17,91 +109,16 @@ def create_charge_allocation_gl(posting_date, charges, reference_doc_name, charg
     :param reference_doc_name: The name of the Sales Invoice (reference for the GL).
     :param charge_type: Type of charge ('Import Charges' or 'Assessment Variance').
     """
-    # Fetch the Sales Invoice to check if it's a return
     sales_invoice = frappe.get_doc("Sales Invoice", reference_doc_name)
-    is_return = sales_invoice.is_return
-
-    # Fetch the Company linked to the Sales Invoice
-    company = sales_invoice.company
-
-    # Fetch the default accounts from the Company document
-    company_doc = frappe.get_doc("Company", company)
-    unallocated_import_charges_account = company_doc.custom_unallocated_import_charges_account
-    default_import_charges_account = company_doc.custom_default_import_charges_account
-    default_import_assessment_account = company_doc.custom_assessment_variance_account
-    assessment_variance_charges_account = company_doc.custom_default_import_assessment_charge_account
-
-    # Validate if accounts are found
-    if not unallocated_import_charges_account or not default_import_charges_account:
-        frappe.throw("Required accounts not found in the Company document.")
-
-    if charge_type == "Import Charges":
-        # For returns, swap debit and credit
-        debit_account = unallocated_import_charges_account if is_return else default_import_charges_account
-        credit_account = default_import_charges_account if is_return else unallocated_import_charges_account
-        
-        accounts = [
-            {
-                "account": debit_account,
-                "debit": charges,
-                "credit": 0,
-                "party_type": None,
-                "party": None,
-                "voucher_type": "Sales Invoice",
-                "voucher_subtype": "Sales Invoice",
-                "against": credit_account,
-                "voucher_no": reference_doc_name
-            },
-            {
-                "account": credit_account,
-                "debit": 0,
-                "credit": charges,
-                "party_type": None,
-                "party": None,
-                "voucher_type": "Sales Invoice",
-                "voucher_subtype": "Sales Invoice",
-                "against": debit_account,
-                "voucher_no": reference_doc_name
-            }
-        ]
+    legs = get_charge_allocation_gl_legs(sales_invoice.company, charge_type, charges, sales_invoice.is_return)
+    make_charge_allocation_gl_entries(sales_invoice, legs, posting_date)
 
-    elif charge_type == "Assessment Variance":
-        # For returns, swap debit and credit
-        debit_account = assessment_variance_charges_account if is_return else default_import_assessment_account
-        credit_account = default_import_assessment_account if is_return else assessment_variance_charges_account
-        
-        accounts = [
-            {
-                "account": debit_account,
-                "debit": charges,
-                "credit": 0,
-                "party_type": None,
-                "party": None,
-                "voucher_type": "Sales Invoice",
-                "voucher_subtype": "Sales Invoice",
-                "against": credit_account,
-                "voucher_no": reference_doc_name
-            },
-            {
-                "account": credit_account,
-                "debit": 0,
-                "credit": charges,
-                "party_type": None,
-                "party": None,
-                "voucher_type": "Sales Invoice",
-                "voucher_subtype": "Sales Invoice",
-                "against": debit_account,
-                "voucher_no": reference_doc_name
-            }
-        ]
-
-    try:
-        create_gl_entries(posting_date, accounts, company)
-        frappe.msgprint(f"GL Entries created for Sales Invoice: {reference_doc_name}")
-    except Exception as e:
-        frappe.log_error(message=str(e), title="GL Entries Error")
-        frappe.msgprint(f"Failed to create GL entries for Sales Invoice: {reference_doc_name}. Error: {str(e)}", alert=True)
 
+# Sales Invoice Item field holding the allocated charges of each charge type
+ALLOCATED_CHARGES_FIELDS = {
+    "Import Charges": "custom_allocated_charges",
+    "Assessment Variance": "custom_assessment_charges"
+}
 
 def update_allocated_charges(sales_invoice_name, item_code, charges,charge_type):
     """
@@ -128,10 +145,7 @@ def update_allocated_charges(sales_invoice_name, item_code, charges,charge_type)
                 "custom_assessment_charges",
                 charges
             )
-        
-        frappe.db.commit()
-        time.sleep(1) # to handle 
-        
+
     except Exception as e:
         frappe.log_error(message=str(e), title="Error Updating Allocated Charges")
         raise
@@ -252,33 +266,380 @@ def create_charge_allocation_entry_backup(entry_type, charge_type, item_code, qt
 # For cancellation:
 def cancel_allocation(reference_doc_name):
     """
-    Marks all allocation entries for the given reference_doc_name as canceled.
+    Marks all allocation and return entries for the given reference_doc_name as canceled,
+    and undoes what they did to the layers: allocations give their open quantity back,
+    returns take back what they restored and reopen the allocation rows they returned.
 
     :param reference_doc_name: Name of the reference document.
     """
-    allocations = frappe.get_all(
+    entries = frappe.get_all(
         "Charge Allocation Ledger",
         filters={
             "reference_doc_name": reference_doc_name,
-            "entry_type": "Allocation",
+            "entry_type": ["in", ["Allocation", "Return"]],
             "is_cancelled": 0
         },
-        fields=["name"]
+        fields=["name"],
+        for_update=True
+    )
+
+    layer_deltas = []
+    returned_qty_by_row = {}
+    for entry in entries:
+        entry_doc = frappe.get_doc("Charge Allocation Ledger", entry["name"])
+        entry_doc.is_cancelled = 1
+        entry_doc.save()
+
+        if entry_doc.entry_type == "Return":
+            layer_deltas.extend(get_return_cancellation_deltas(entry_doc, returned_qty_by_row))
+        else:
+            layer_deltas.extend(get_allocation_cancellation_deltas(entry_doc))
+
+    validate_layer_deltas(layer_deltas)
+    update_layer_balances(layer_deltas)
+    add_returned_qty(returned_qty_by_row)
+
+def get_allocation_cancellation_deltas(allocation_doc):
+    """
+    Layer changes undoing an Allocation entry. Quantities already given back by returns
+    are not restored twice. Charge revision adjustments only give back charges, their qty
+    is that of the allocations they adjusted.
+    """
+    layer_deltas = []
+    for source_ref in allocation_doc.source_references:
+        open_qty = flt(source_ref.allocated_qty) - flt(source_ref.returned_qty)
+        if open_qty <= 0:
+            continue
+        layer_deltas.append({
+            "source_entry": source_ref.source_entry,
+            "qty": 0 if allocation_doc.adjustment_for else open_qty,
+            "charges": flt(source_ref.allocated_charges) * open_qty / flt(source_ref.allocated_qty)
+        })
+    if allocation_doc.adjustment_for and not allocation_doc.source_references:
+        # Adjustment posted without source rows: its charges go back to the revised layer
+        layer = frappe.db.get_value("Charge Allocation Ledger", allocation_doc.adjustment_for, "adjustment_for")
+        if layer:
+            layer_deltas.append({"source_entry": layer, "qty": 0, "charges": flt(allocation_doc.charges)})
+    return layer_deltas
+
+def get_return_cancellation_deltas(return_doc, returned_qty_by_row):
+    """
+    Layer changes undoing a Return entry: the quantity and charges it restored are taken
+    back from the layers, and the allocation rows it returned are reopened.
+
+    :param return_doc: Return entry being cancelled.
+    :param returned_qty_by_row: dict of Charge Allocation Source name -> returned qty change, updated in place.
+    """
+    adjustment_rows = get_adjustment_source_rows(
+        [source_ref.allocation_source for source_ref in return_doc.source_references if source_ref.allocation_source]
+    )
+    layer_deltas = []
+    for source_ref in return_doc.source_references:
+        layer_deltas.append({
+            "source_entry": source_ref.source_entry,
+            # Revision charges returned with the units didn't restore any qty
+            "qty": 0 if source_ref.allocation_source in adjustment_rows else -flt(source_ref.allocated_qty),
+            "charges": -flt(source_ref.allocated_charges)
+        })
+        # Returns made before allocation_source was recorded can't reopen their rows
+        if source_ref.allocation_source:
+            returned_qty_by_row[source_ref.allocation_source] = (
+                returned_qty_by_row.get(source_ref.allocation_source, 0) - flt(source_ref.allocated_qty)
+            )
+    return layer_deltas
+
+def get_adjustment_source_rows(rows):
+    """
+    The Charge Allocation Source rows, among `rows`, that belong to charge revision adjustments.
+    """
+    if not rows:
+        return set()
+    ledger = frappe.qb.DocType("Charge Allocation Ledger")
+    source = frappe.qb.DocType("Charge Allocation Source")
+    return set(
+        (
+            frappe.qb.from_(source)
+            .inner_join(ledger).on(ledger.name == source.parent)
+            .select(source.name)
+            .where(
+                (source.name.isin(rows))
+                & (source.parenttype == "Charge Allocation Ledger")
+                & (IfNull(ledger.adjustment_for, "") != "")
+            )
+        ).run(pluck=True)
+    )
+
+def validate_layer_deltas(layer_deltas):
+    """
+    Throw if a layer would be left with a negative remaining qty, e.g. when the quantity
+    a return gave back has been allocated again. The layers stay locked until the
+    transaction ends.
+    """
+    takes = [delta for delta in merge_layer_deltas(layer_deltas) if delta["qty"] < 0]
+    if not takes:
+        return
+
+    layers = frappe.get_all(
+        "Charge Allocation Ledger",
+        filters={"name": ["in", [delta["source_entry"] for delta in takes]]},
+        fields=["name", "item_code", "remaining_qty"],
+        for_update=True
+    )
+    layers = {layer.name: layer for layer in layers}
+    for delta in takes:
+        layer = layers.get(delta["source_entry"])
+        if layer and flt(flt(layer.remaining_qty) + delta["qty"], 6) < 0:
+            frappe.throw(
+                f"Cannot cancel: {abs(delta['qty'])} units of item {layer.item_code} were given back to "
+                f"{layer.name}, but only {flt(layer.remaining_qty)} are left unallocated."
+            )
+
+
+def get_open_layers(item_code, charge_type, for_update=False):
+    """
+    Unexhausted Addition entries of an item, oldest first (FIFO).
+    Uses the open_layers_index of Charge Allocation Ledger, so the lookup doesn't
+    depend on the size of the ledger.
+
+    :param item_code: Item to allocate.
+    :param charge_type: 'Import Charges' or 'Assessment Variance'.
+    :param for_update: Lock the layers (SELECT ... FOR UPDATE) until the transaction ends.
+    :return: List of dicts with name, remaining_qty and remaining_charges.
+    """
+    return frappe.get_all(
+        "Charge Allocation Ledger",
+        filters={
+            "is_open": 1,
+            "item_code": item_code,
+            "charge_type": charge_type
+        },
+        fields=["name", "remaining_qty", "remaining_charges"],
+        order_by="posting_datetime asc, creation asc",
+        for_update=for_update
+    )
+
+def update_layer_balances(layer_deltas):
+    """
+    Add qty and charges to the remaining balance of layers in one relative UPDATE, so that
+    concurrent changes to the same layer can't overwrite each other. is_open follows
+    the new remaining_qty and the changes are posted to the Charge Allocation Balance.
+
+    :param layer_deltas: List of dicts with source_entry, qty and charges (negative to consume).
+    """
+    layer_deltas = merge_layer_deltas(layer_deltas)
+    if not layer_deltas:
+        return
+
+    case = f"case name {' '.join(['when %s then %s'] * len(layer_deltas))} end"
+
+    values = []
+    for column in ("qty", "qty", "charges"):
+        for delta in layer_deltas:
+            values.extend([delta["source_entry"], delta[column]])
+    values.extend([now(), frappe.session.user])
+    values.extend(delta["source_entry"] for delta in layer_deltas)
+
+    # is_open is set first, from the current remaining_qty, as MariaDB applies SET clauses in order
+    frappe.db.sql(
+        f"""
+        update `tabCharge Allocation Ledger`
+        set is_open = if(entry_type = 'Addition' and is_cancelled = 0 and remaining_qty + {case} > 0, 1, 0),
+            remaining_qty = remaining_qty + {case},
+            remaining_charges = remaining_charges + {case},
+            modified = %s,
+            modified_by = %s
+        where name in ({', '.join(['%s'] * len(layer_deltas))})
+        """,
+        values
+    )
+
+    # Keep the daily balance of the unallocated charges in step with the layers
+    layers = frappe.get_all(
+        "Charge Allocation Ledger",
+        filters={"name": ["in", [delta["source_entry"] for delta in layer_deltas]]},
+        fields=["name", "item_code", "charge_type"]
+    )
+    layers = {layer.name: layer for layer in layers}
+    update_charge_allocation_balance([
+        {
+            "item_code": layers[delta["source_entry"]].item_code,
+            "charge_type": layers[delta["source_entry"]].charge_type,
+            "qty": delta["qty"],
+            "charges": delta["charges"]
+        }
+        for delta in layer_deltas
+        if delta["source_entry"] in layers
+    ])
+
+def add_allocated_charges(charges_by_row, charge_type):
+    """
+    Add to the allocated charges of Sales Invoice Item rows, in one relative UPDATE.
+
+    :param charges_by_row: dict of Sales Invoice Item name -> charges to add.
+    :param charge_type: 'Import Charges' or 'Assessment Variance'.
+    """
+    if not charges_by_row:
+        return
+    fieldname = ALLOCATED_CHARGES_FIELDS[charge_type]
+    rows = list(charges_by_row)
+    values = []
+    for row in rows:
+        values.extend([row, charges_by_row[row]])
+    values.extend(rows)
+    frappe.db.sql(
+        f"""
+        update `tabSales Invoice Item`
+        set `{fieldname}` = ifnull(`{fieldname}`, 0) + case name {' '.join(['when %s then %s'] * len(rows))} end
+        where name in ({', '.join(['%s'] * len(rows))})
+        """,
+        values
     )
 
-    for allocation in allocations:
-        allocation_doc = frappe.get_doc("Charge Allocation Ledger", allocation["name"])
-        allocation_doc.is_cancelled = 1
-        allocation_doc.save()
+def add_returned_qty(returned_qty_by_row):
+    """
+    Add to returned_qty of Charge Allocation Source rows, in one relative UPDATE.
 
-        # Recalculate remaining quantities and charges in source entries
-        if allocation_doc.source_references:
-            for source_ref in allocation_doc.source_references:
-                source_doc = frappe.get_doc("Charge Allocation Ledger", source_ref["source_entry"])
-                source_doc.remaining_qty += source_ref["allocated_qty"]
-                source_doc.remaining_charges += source_ref["allocated_charges"]
-                source_doc.save()
+    :param returned_qty_by_row: dict of Charge Allocation Source name -> returned qty
+        (negative when a return is cancelled).
+    """
+    if not returned_qty_by_row:
+        return
+    rows = list(returned_qty_by_row)
+    values = []
+    for row in rows:
+        values.extend([row, returned_qty_by_row[row]])
+    values.extend(rows)
+    frappe.db.sql(
+        f"""
+        update `tabCharge Allocation Source`
+        set returned_qty = returned_qty + case name {' '.join(['when %s then %s'] * len(rows))} end
+        where name in ({', '.join(['%s'] * len(rows))})
+        """,
+        values
+    )
 
+def get_returnable_allocation_sources(item_code, charge_type, return_against=None, for_update=False, page_length=100):
+    """
+    Source rows of the item's Allocation entries that still have quantity to return.
+    Allocations of the returned invoice come first, then the others, latest first, and
+    within an allocation the last consumed layer first. Rows are read page by page
+    through the item/charge type index, only as far as the caller consumes them.
+    Charge revision adjustments are not included, see get_revision_returns.
+
+    :param item_code: Returned item.
+    :param charge_type: 'Import Charges' or 'Assessment Variance'.
+    :param return_against: (Optional) Sales Invoice being returned.
+    :param for_update: Lock the rows read (SELECT ... FOR UPDATE).
+    """
+    ledger = frappe.qb.DocType("Charge Allocation Ledger")
+    source = frappe.qb.DocType("Charge Allocation Source")
+    query = (
+        frappe.qb.from_(source)
+        .inner_join(ledger).on(ledger.name == source.parent)
+        .select(
+            source.name,
+            source.source_entry,
+            source.allocated_qty,
+            source.allocated_charges,
+            source.returned_qty,
+            ledger.reference_doc_name
+        )
+        .where(
+            (source.parenttype == "Charge Allocation Ledger")
+            & (ledger.item_code == item_code)
+            & (ledger.charge_type == charge_type)
+            & (ledger.entry_type == "Allocation")
+            & (IfNull(ledger.adjustment_for, "") == "")
+            & (ledger.is_cancelled == 0)
+            & (source.allocated_qty > source.returned_qty)
+        )
+        .orderby(ledger.posting_datetime, order=frappe.qb.desc)
+        .orderby(ledger.creation, order=frappe.qb.desc)
+        .orderby(source.idx, order=frappe.qb.desc)
+    )
+    if for_update:
+        query = query.for_update()
+
+    queries = [query]
+    if return_against:
+        queries = [
+            query.where(ledger.reference_doc_name == return_against),
+            query.where(ledger.reference_doc_name != return_against)
+        ]
+
+    for query in queries:
+        start = 0
+        while True:
+            rows = query.limit(page_length).offset(start).run(as_dict=True)
+            yield from rows
+            if len(rows) < page_length:
+                break
+            start += page_length
+
+def get_revision_returns(item_code, charge_type, restorations, returned_sources, for_update=False):
+    """
+    Revision charges given back with returned units. Each restored allocation row takes
+    along, for the same qty, the charge revision adjustments posted on its invoice for
+    the same layer.
+
+    :param restorations: Restorations of plan_return, over rows of get_returnable_allocation_sources.
+    :param returned_sources: dict of Charge Allocation Source name -> row, the rows the restorations came from.
+    :param for_update: Lock the rows read (SELECT ... FOR UPDATE).
+    :return: List of dicts with source_row, source_entry (the layer), returned_qty and returned_charges.
+    """
+    if not restorations:
+        return []
+
+    layers = list({restoration["source_entry"] for restoration in restorations})
+    invoices = list({returned_sources[restoration["source_row"]].reference_doc_name for restoration in restorations})
+
+    ledger = frappe.qb.DocType("Charge Allocation Ledger")
+    source = frappe.qb.DocType("Charge Allocation Source")
+    query = (
+        frappe.qb.from_(source)
+        .inner_join(ledger).on(ledger.name == source.parent)
+        .select(
+            source.name,
+            source.source_entry,
+            source.allocated_qty,
+            source.allocated_charges,
+            source.returned_qty,
+            ledger.reference_doc_name
+        )
+        .where(
+            (source.parenttype == "Charge Allocation Ledger")
+            & (source.source_entry.isin(layers))
+            & (ledger.reference_doc_name.isin(invoices))
+            & (ledger.item_code == item_code)
+            & (ledger.charge_type == charge_type)
+            & (ledger.entry_type == "Allocation")
+            & (IfNull(ledger.adjustment_for, "") != "")
+            & (ledger.is_cancelled == 0)
+            & (source.allocated_qty > source.returned_qty)
+        )
+        .orderby(ledger.creation, order=frappe.qb.desc)
+    )
+    if for_update:
+        query = query.for_update()
+
+    rows = query.run(as_dict=True)
+    rows_by_name = {row.name: row for row in rows}
+    rows_by_invoice_and_layer = {}
+    for row in rows:
+        rows_by_invoice_and_layer.setdefault((row.reference_doc_name, row.source_entry), []).append(row)
+
+    revision_returns = []
+    for restoration in restorations:
+        invoice = returned_sources[restoration["source_row"]].reference_doc_name
+        adjustment_rows = rows_by_invoice_and_layer.get((invoice, restoration["source_entry"]))
+        if not adjustment_rows:
+            continue
+        returns = plan_return(adjustment_rows, restoration["returned_qty"])[0]
+        for revision_return in returns:
+            # A row can cover units of several restorations
+            rows_by_name[revision_return["source_row"]].returned_qty += revision_return["returned_qty"]
+        revision_returns.extend(returns)
+    return revision_returns
 
 def get_last_allocation(item_code,charge_type):
     last_allocation_entry = frappe.get_all(
@@ -294,6 +655,96 @@ def get_last_allocation(item_code,charge_type):
             fields=["charges", "qty", "source_references"]
         )
 
+def plan_charge_allocation(item_code, qty, charge_type, entry_type="Allocation", for_update=False, return_against=None):
+    """
+    Walk the ledger once and work out an allocation (or return) without writing anything.
+    The same plan is then used for the ledger entry, the GL and the Sales Invoice Item,
+    so they can't disagree.
+    Plans that will be applied must be made with for_update, which locks the open layers
+    until the transaction ends, so parallel submits consume them one after the other.
+
+    :param item_code: Item to allocate.
+    :param qty: Quantity to allocate (negative for returns).
+    :param charge_type: 'Import Charges' or 'Assessment Variance'.
+    :param entry_type: 'Allocation' or 'Return'.
+    :param for_update: Lock the layers read (SELECT ... FOR UPDATE).
+    :param return_against: (Optional) For returns, the invoice being returned, its allocations
+        are given back first.
+    :return: frappe._dict with charges (negative for returns), allocated_qty,
+        source_references (rows of the entry), layer_deltas (changes to apply to
+        remaining_qty/remaining_charges of the source layers) and, for returns,
+        returned_sources (returned qty per Charge Allocation Source row).
+    """
+    plan = frappe._dict({
+        "entry_type": entry_type,
+        "charge_type": charge_type,
+        "item_code": item_code,
+        "qty": qty,
+        "charges": 0,
+        "allocated_qty": 0,
+        "source_references": [],
+        "layer_deltas": [],
+        "returned_sources": {}
+    })
+
+    if entry_type == "Return":
+        returned_sources = {}
+
+        def track_returned_sources(sources):
+            for source in sources:
+                returned_sources[source.name] = source
+                yield source
+
+        restorations, plan.allocated_qty, returned_charges = plan_return(
+            track_returned_sources(
+                get_returnable_allocation_sources(item_code, charge_type, return_against, for_update=for_update)
+            ),
+            abs(qty)  # Work with absolute value for calculations
+        )
+
+        if not restorations:
+            frappe.throw(f"No previous allocation entries found for item {item_code}.")
+        if plan.allocated_qty < abs(qty):
+            frappe.throw(f"Cannot find enough allocation entries to return {qty} units of item {item_code}")
+
+        # Revision charges of the returned units go back with them, without adding to the qty
+        revision_returns = get_revision_returns(item_code, charge_type, restorations, returned_sources, for_update)
+        returned_charges += sum(revision_return["returned_charges"] for revision_return in revision_returns)
+
+        # Make the total charges negative since this is a return
+        plan.charges = -1 * returned_charges
+        plan.source_references = [
+            {
+                "source_entry": restoration["source_entry"],
+                "allocated_qty": restoration["returned_qty"],
+                "allocated_charges": restoration["returned_charges"],
+                "allocation_source": restoration["source_row"],
+                "charge_type": charge_type
+            }
+            for restoration in restorations + revision_returns
+        ]
+        plan.layer_deltas = [
+            {"source_entry": restoration["source_entry"], "qty": restoration["returned_qty"], "charges": restoration["returned_charges"]}
+            for restoration in restorations
+        ] + [
+            {"source_entry": revision_return["source_entry"], "qty": 0, "charges": revision_return["returned_charges"]}
+            for revision_return in revision_returns
+        ]
+        plan.returned_sources = {}
+        for restoration in restorations + revision_returns:
+            plan.returned_sources[restoration["source_row"]] = (
+                plan.returned_sources.get(restoration["source_row"], 0) + restoration["returned_qty"]
+            )
+        return plan
+
+    # For allocations, walk the open Addition layers, oldest first (FIFO)
+    consumptions, plan.allocated_qty, plan.charges = plan_fifo_consumption(
+        get_open_layers(item_code, charge_type, for_update=for_update), qty
+    )
+    plan.source_references = [dict(consumption, charge_type=charge_type) for consumption in consumptions]
+    plan.layer_deltas = get_layer_deltas(consumptions)
+    return plan
+
 def calculate_allocation_charges(item_code, qty, charge_type, entry_type="Allocation"):
     """
     Calculate allocation charges for an item, handling both allocations and returns.
@@ -308,100 +759,9 @@ def calculate_allocation_charges(item_code, qty, charge_type, entry_type="Alloca
         float: The calculated allocation charges
     """
     try:
-        if entry_type == "Return":
-            # Fetch all relevant allocation entries for the item
-            allocation_entries = frappe.get_all(
-                "Charge Allocation Ledger",
-                filters={
-                    "entry_type": "Allocation",
-                    "charge_type": charge_type,
-                    "item_code": item_code,
-                    "is_cancelled": 0
-                },
-                order_by="posting_datetime desc",  # Most recent first
-                fields=["name", "charges", "qty"]
-            )
-
-            if not allocation_entries:
-                frappe.throw(f"No previous allocation entries found for item {item_code}.")
-
-            remaining_return_qty = abs(qty)  # Work with absolute value for calculations
-            total_return_charges = 0
-
-            for allocation in allocation_entries:
-                if remaining_return_qty <= 0:
-                    break
-
-                alloc_doc = frappe.get_doc("Charge Allocation Ledger", allocation.name)
-                per_unit_charge = alloc_doc.charges / alloc_doc.qty if alloc_doc.qty > 0 else 0
-                
-                # Calculate how much quantity we can return from this allocation
-                returnable_qty = min(remaining_return_qty, alloc_doc.qty)
-                return_charges = per_unit_charge * returnable_qty
-                
-                total_return_charges += return_charges
-                remaining_return_qty -= returnable_qty
-
-            if remaining_return_qty > 0:
-                frappe.throw(f"Cannot find enough allocation entries to return {qty} units of item {item_code}")
-
-            # Make the total charges negative since this is a return
-            total_return_charges = -1 * total_return_charges
-            return total_return_charges
-        
-        else:
-            # For allocations, fetch from Addition entries
-            allocation_sources = frappe.get_all(
-                "Charge Allocation Ledger",
-                filters={
-                    "entry_type": "Addition",
-                    "charge_type": charge_type,
-                    "item_code": item_code,
-                    "remaining_qty": [">", 0],
-                    "is_cancelled": 0
-                },
-                fields=["name", "remaining_qty", "remaining_charges"],
-                order_by="posting_datetime asc"  # Oldest additions first for FIFO
-            )
-
-        if not allocation_sources:
-            frappe.log_error(
-                message=f"No {entry_type.lower()} sources found for {item_code} with {charge_type}",
-                title="Charge Allocation Warning"
-            )
-            return 0
-
-        allocated_qty = 0
-        allocated_charges = 0
-
-        for source in allocation_sources:
-            if allocated_qty >= qty:
-                break
-            
-            allocatable_qty = min(source["remaining_qty"], qty - allocated_qty)
-            charges_per_unit = source["remaining_charges"] / source["remaining_qty"]
-            allocatable_charges = flt(charges_per_unit * allocatable_qty)
-
-            allocated_qty += allocatable_qty
-            allocated_charges += allocatable_charges
-
-        if allocated_qty < qty:
-            frappe.log_error(
-                message=(
-                    f"Partial {entry_type.lower()} for {item_code}:\n"
-                    f"Requested Qty: {qty}\n"
-                    f"Allocated Qty: {allocated_qty}\n"
-                    f"Charge Type: {charge_type}\n"
-                    f"Allocated Charges: {allocated_charges}"
-                ),
-                title=f"Partial Charge {entry_type} Warning"
-            )
-
-        # For returns, the charges should be negative
-        if entry_type == "Return":
-            allocated_charges = -1 * allocated_charges
-
-        return allocated_charges
+        plan = plan_charge_allocation(item_code, qty, charge_type, entry_type)
+        log_partial_allocation(plan)
+        return plan.charges
 
     except Exception as e:
         frappe.log_error(
@@ -410,6 +770,59 @@ def calculate_allocation_charges(item_code, qty, charge_type, entry_type="Alloca
         )
         raise
 
+def log_partial_allocation(plan):
+    if plan.entry_type != "Allocation":
+        return
+
+    if not plan.source_references:
+        frappe.log_error(
+            message=f"No allocation sources found for {plan.item_code} with {plan.charge_type}",
+            title="Charge Allocation Warning"
+        )
+    elif plan.allocated_qty < plan.qty:
+        frappe.log_error(
+            message=(
+                f"Partial allocation for {plan.item_code}:\n"
+                f"Requested Qty: {plan.qty}\n"
+                f"Allocated Qty: {plan.allocated_qty}\n"
+                f"Charge Type: {plan.charge_type}\n"
+                f"Allocated Charges: {plan.charges}"
+            ),
+            title="Partial Charge Allocation Warning"
+        )
+
+def apply_charge_allocation_plan(plan, reference_doc, reference_doc_name):
+    """
+    Write a plan from plan_charge_allocation: the Allocation/Return entry and the
+    changes to its source layers.
+
+    :param plan: Plan returned by plan_charge_allocation.
+    :param reference_doc: Reference document causing the ledger update.
+    :param reference_doc_name: Reference document name.
+    """
+    if plan.entry_type == "Allocation" and plan.allocated_qty < plan.qty:
+        frappe.throw(f"Insufficient quantity to allocate {plan.qty} for item {plan.item_code}.")
+
+    entry = {
+        "doctype": "Charge Allocation Ledger",
+        "entry_type": plan.entry_type,
+        "charge_type": plan.charge_type,
+        "posting_date": nowdate(),
+        "posting_time": nowtime(),
+        "posting_datetime": f"{nowdate()} {nowtime()}",
+        "item_code": plan.item_code,
+        "charges": plan.charges,
+        "reference_doc": reference_doc,
+        "reference_doc_name": reference_doc_name,
+        "is_cancelled": 0
+    }
+    entry["qty"] = plan.qty if plan.entry_type == "Return" else plan.allocated_qty  # Negative quantity for return
+    entry["source_references"] = plan.source_references
+    frappe.get_doc(entry).insert(ignore_permissions=True)
+
+    update_layer_balances(plan.layer_deltas)
+    add_returned_qty(plan.returned_sources)
+
 def create_charge_allocation_entry(entry_type, charge_type, item_code, qty, charges, reference_doc, reference_doc_name):
     """
     Creates an entry in the Charge Allocation Ledger.
@@ -418,77 +831,15 @@ def create_charge_allocation_entry(entry_type, charge_type, item_code, qty, char
     :param charge_type: Type of charge ('Import' or 'Assessment').
     :param item_code: Item for which the entry is being made.
     :param qty: Quantity involved.
-    :param charges: Charges to be added/allocated.
+    :param charges: Charges to be added (Allocation and Return charges come from the ledger).
     :param reference_doc: Reference document causing the ledger update.
     :param reference_doc_name: Reference document name.
     """
-    print('called allocation function')
-
     print(f"entry type is {entry_type}")
     if entry_type not in ["Addition", "Allocation", "Return"]:
         frappe.throw("Invalid entry type. Must be 'Addition', 'Allocation', or 'Return'.")
 
-    if entry_type == "Return":
-        # Fetch the last Allocation entry for the same item code
-        last_allocation_entry = frappe.get_all(
-            "Charge Allocation Ledger",
-            filters={
-                "entry_type": "Allocation",
-                "charge_type":charge_type,
-                "item_code": item_code,
-                "is_cancelled": 0
-            },
-            order_by="posting_datetime desc",
-            limit=1,
-            fields=["name","charges", "qty", "source_references"]
-        )
-
-        if not last_allocation_entry:
-            print(f"no allocation entry foud for {charge_type}")
-            frappe.throw(f"No previous allocation entry found for item {item_code}.")
-
-        last_entry = last_allocation_entry[0]
-        print(f"Last allocation entry is {last_entry}")
-        last_entry = frappe.get_doc("Charge Allocation Ledger",last_entry['name'])
-        print(f"last entry references is {last_entry.source_references}")
-        per_unit_charge = last_entry.charges / last_entry.qty if last_entry.qty > 0 else 0
-        print(f"per unit charge is {per_unit_charge}")
-        total_return_charges = per_unit_charge * qty
-        frappe.log_error(message=f"total return charges are {total_return_charges}",title="total return charges")
-        # Handle 'Return' entry
-        frappe.get_doc({
-            "doctype": "Charge Allocation Ledger",
-            "entry_type": entry_type,
-            "charge_type": charge_type,
-            "posting_date": nowdate(),
-            "posting_time": nowtime(),
-            "posting_datetime": f"{nowdate()} {nowtime()}",
-            "item_code": item_code,
-            "qty": qty,  # Negative quantity for return
-            "charges": total_return_charges,  # Negative charges for return
-            "reference_doc": reference_doc,
-            "reference_doc_name": reference_doc_name
-        }).insert(ignore_permissions=True)
-
-        # Update the Sales Invoice Item for return
-        #update_allocated_charges(reference_doc_name, item_code, -total_return_charges, charge_type)  # Deduct charges
-        
-        # Increase the source document's remaining quantity and charges
-        if len(last_entry.source_references)>0:
-            
-            
-            # Get the first source reference
-            source_reference = last_entry.source_references[0]
-            
-            source_doc = frappe.get_doc("Charge Allocation Ledger", source_reference.source_entry)
-            source_doc.remaining_qty += abs(qty)  # Increase remaining quantity
-            source_doc.remaining_charges += abs(total_return_charges)  # Increase remaining charges
-            source_doc.save()
-        else:
-            frappe.log_error(message=f"No source references found in the last allocation entry for item {item_code}.", title="Return Allocation Warning")
-
-    elif entry_type == "Addition":
-        # Existing logic for Addition
+    if entry_type == "Addition":
         frappe.get_doc({
             "doctype": "Charge Allocation Ledger",
             "entry_type": entry_type,
@@ -504,82 +855,9 @@ def create_charge_allocation_entry(entry_type, charge_type, item_code, qty, char
             "reference_doc": reference_doc,
             "reference_doc_name": reference_doc_name
         }).insert(ignore_permissions=True)
-
-    elif entry_type == "Allocation":
-        # Existing logic for Allocation
-        print("allocation section called")
-        # Fetch non-canceled allocation sources
-        allocation_sources = frappe.get_all(
-            "Charge Allocation Ledger",
-            filters={
-                "entry_type": "Addition",
-                "charge_type": charge_type,
-                "item_code": item_code,
-                "remaining_qty": [">", 0],
-                "is_cancelled": 0
-            },
-            fields=["name", "remaining_qty", "remaining_charges"],
-            order_by="posting_datetime asc"
-        )
-    
-        if not allocation_sources:
-            pass # Most likely all allocated charges are exhausted now.
-
-        allocated_qty = 0
-        allocated_charges = 0
-        source_references = []
-
-        print(f"Allocation sources are {allocation_sources}")
-        for source in allocation_sources:
-            print(f"Current Source is {source}")
-            if allocated_qty >= qty:
-                break
-            
-            allocatable_qty = min(source["remaining_qty"], qty - allocated_qty)
-            print(f"allocatable_qty is {allocatable_qty} qty = {qty} allocated_qty={allocated_qty}")
-            charges_per_unit = source["remaining_charges"] / source["remaining_qty"]
-            allocatable_charges = flt(charges_per_unit * allocatable_qty)
-            source_references.append({
-                "source_entry": source["name"],
-                "allocated_qty": allocatable_qty,
-                "allocated_charges": allocatable_charges,
-                "charge_type": charge_type
-            })
-
-            allocated_qty += allocatable_qty
-            allocated_charges += allocatable_charges
-
-        if allocated_qty < qty:
-            frappe.throw(f"Insufficient quantity to allocate {qty} for item {item_code}.")
-
-        # Create Allocation Entry
-        allocation_entry = frappe.get_doc({
-            "doctype": "Charge Allocation Ledger",
-            "entry_type": entry_type,
-            "charge_type": charge_type,
-            "posting_date": nowdate(),
-            "posting_time": nowtime(),
-            "posting_datetime": f"{nowdate()} {nowtime()}",
-            "item_code": item_code,
-            "qty": allocated_qty,
-            "charges": allocated_charges,
-            "source_references": source_references,  # Storing source references
-            "reference_doc": reference_doc,
-            "reference_doc_name": reference_doc_name,
-            "is_cancelled": 0
-        })
-        allocation_entry.insert(ignore_permissions=True)
-
-        # Mark allocation for cancellation if needed
-        for source_ref in source_references:
-            source_doc = frappe.get_doc("Charge Allocation Ledger", source_ref["source_entry"])
-            source_doc.remaining_qty -= source_ref["allocated_qty"]
-            source_doc.remaining_charges -= source_ref["allocated_charges"]
-            source_doc.save()
-
-        print("going to update sales invoice")
-        # Update the Sales Invoice Item
-        #update_allocated_charges(reference_doc_name, item_code, allocated_charges, charge_type)
+    else:
+        plan = plan_charge_allocation(item_code, qty, charge_type, entry_type, for_update=True)
+        apply_charge_allocation_plan(plan, reference_doc, reference_doc_name)
         
 
 def create_line_wise_charge_entry(import_doc):
@@ -597,71 +875,45 @@ def create_line_wise_charge_entry(import_doc):
 def on_submit_create_allocation_entries(doc, method):
     """
     Hook function triggered on the 'on_submit' event of a Sales Invoice.
+    Each item is planned once per charge type, the plan is used for the ledger entry,
+    the GL and the Sales Invoice Item.
     """
     entry_type = "Return" if doc.is_return == 1 else "Allocation"
+    allocated_charges = {}
+    gl_legs = []
     
     for item in doc.items:
         try:
-            # Calculate charges first
-            import_charges = calculate_allocation_charges(
-                item_code=item.item_code,
-                qty=item.qty,
-                charge_type="Import Charges",
-                entry_type=entry_type  # Pass the entry type to handle returns properly
-            )
-            
-            assessment_charges = calculate_allocation_charges(
-                item_code=item.item_code,
-                qty=item.qty,
-                charge_type="Assessment Variance",
-                entry_type=entry_type  # Pass the entry type to handle returns properly
-            )
-            
-            # Process import charges (both positive and negative)
-            if import_charges != 0:  # Changed from > 0 to != 0
-                create_charge_allocation_entry(
-                    entry_type=entry_type,
-                    charge_type="Import Charges",
-                    item_code=item.item_code,
-                    qty=item.qty,
-                    charges=import_charges,
-                    reference_doc="Sales Invoice",
-                    reference_doc_name=doc.name
-                )
-                create_charge_allocation_gl(
-                    posting_date=doc.posting_date,
-                    charges=abs(import_charges),  # Use absolute value for GL
-                    reference_doc_name=doc.name,
-                    charge_type="Import Charges"
-                )
-            
-            # Process assessment charges (both positive and negative)
-            if assessment_charges != 0:  # Changed from > 0 to != 0
-                create_charge_allocation_entry(
-                    entry_type=entry_type,
-                    charge_type="Assessment Variance",
+            for charge_type, fieldname in ALLOCATED_CHARGES_FIELDS.items():
+                plan = plan_charge_allocation(
                     item_code=item.item_code,
                     qty=item.qty,
-                    charges=assessment_charges,
-                    reference_doc="Sales Invoice",
-                    reference_doc_name=doc.name
-                )
-                create_charge_allocation_gl(
-                    posting_date=doc.posting_date,
-                    charges=abs(assessment_charges),  # Use absolute value for GL
-                    reference_doc_name=doc.name,
-                    charge_type="Assessment Variance"
+                    charge_type=charge_type,
+                    entry_type=entry_type,  # Pass the entry type to handle returns properly
+                    for_update=True,
+                    return_against=doc.return_against
                 )
-            
-            # Update Sales Invoice Item after everything else is done
-            # For returns, the charges are already negative from calculate_allocation_charges
-            update_allocated_charges(doc.name, item.item_code, import_charges, "Import Charges")
-            update_allocated_charges(doc.name, item.item_code, assessment_charges, "Assessment Variance")
+                log_partial_allocation(plan)
+
+                # Process charges (both positive and negative)
+                if plan.charges != 0:
+                    apply_charge_allocation_plan(plan, "Sales Invoice", doc.name)
+                    # Use absolute value for GL, returns swap debit and credit
+                    gl_legs.extend(get_charge_allocation_gl_legs(doc.company, charge_type, abs(plan.charges), doc.is_return))
+
+                # For returns, the planned charges are already negative
+                item.set(fieldname, plan.charges)
+                allocated_charges.setdefault(item.name, {})[fieldname] = plan.charges
             
         except Exception as e:
             frappe.log_error(message=str(e), title=f"Allocation Error - {item.item_code}")
             frappe.throw(f"Failed to process item {item.item_code}: {str(e)}")
 
+    # Write back the charges of all lines at once, within the submit transaction
+    bulk_set_values("Sales Invoice Item", allocated_charges, list(ALLOCATED_CHARGES_FIELDS.values()))
+    # One GL posting for the whole invoice, merged by account
+    make_charge_allocation_gl_entries(doc, gl_legs)
+
 
 def on_submit_import_doc(doc, method):
     """
@@ -718,127 +970,305 @@ def on_submit_import_doc(doc, method):
             )
 
 
-def repost_import_charges(import_doc_name, item_code, new_charges):
+def get_allocations_of_layer(source_entry, created_before=None):
     """
-    Handles changes in allocated_charges_ex_cd after ImportDoc submission.
-    Creates new allocation entries based on the difference in charges.
-    
-    :param import_doc_name: Name of the ImportDoc
-    :param item_code: Item code for which charges are being adjusted
-    :param new_charges: New total charges amount
+    Allocations that consumed an Addition entry, found through the source_entry index of
+    Charge Allocation Source instead of scanning every Allocation entry.
+
+    :param source_entry: Name of the Addition entry.
+    :param created_before: (Optional) Only allocations created before this datetime.
+    :return: List of dicts with name, qty (allocated and not returned), charges,
+        reference_doc and reference_doc_name.
+    """
+    ledger = frappe.qb.DocType("Charge Allocation Ledger")
+    source = frappe.qb.DocType("Charge Allocation Source")
+    query = (
+        frappe.qb.from_(source)
+        .inner_join(ledger).on(ledger.name == source.parent)
+        .select(
+            ledger.name,
+            source.allocated_qty,
+            source.allocated_charges,
+            source.returned_qty,
+            ledger.reference_doc,
+            ledger.reference_doc_name
+        )
+        .where(
+            (source.source_entry == source_entry)
+            & (source.parenttype == "Charge Allocation Ledger")
+            & (ledger.entry_type == "Allocation")
+            & (IfNull(ledger.adjustment_for, "") == "")
+            & (ledger.is_cancelled == 0)
+        )
+        .orderby(ledger.posting_datetime)
+    )
+    if created_before:
+        query = query.where(ledger.creation < created_before)
+    rows = query.run(as_dict=True)
+
+    allocations = []
+    for row in rows:
+        # Units given back by returns don't take part in the adjustment
+        qty = flt(row.allocated_qty) - flt(row.returned_qty)
+        if qty <= 0:
+            continue
+        allocations.append({
+            "name": row.name,
+            "qty": qty,
+            "charges": flt(row.allocated_charges) * qty / flt(row.allocated_qty),
+            "reference_doc": row.reference_doc,
+            "reference_doc_name": row.reference_doc_name
+        })
+    return allocations
+
+# Sales Invoices adjusted per transaction by repost_import_doc_charges
+REPOST_BATCH_SIZE = 100
+
+@frappe.whitelist()
+def enqueue_import_doc_charges_repost(import_doc_name):
+    """
+    Queue repost_import_doc_charges for an ImportDoc, at most one job per ImportDoc.
+
+    :param import_doc_name: Name of the ImportDoc whose charges were revised.
+    """
+    frappe.has_permission("ImportDoc", "write", import_doc_name, throw=True)
+    frappe.enqueue(
+        "importmanager.importmanager.controllers.charge_allocation_controller.repost_import_doc_charges",
+        queue="long",
+        timeout=3600,
+        job_id=f"repost_import_doc_charges::{import_doc_name}",
+        deduplicate=True,
+        import_doc_name=import_doc_name
+    )
+    frappe.msgprint(f"Repost of import charges for {import_doc_name} has been queued.", alert=True)
+
+def repost_import_doc_charges(import_doc_name, batch_size=REPOST_BATCH_SIZE):
+    """
+    Background job: apply the revised allocated_charges_ex_cd of a locked ImportDoc,
+    for all its items at once.
+
+    Each increase is recorded as a revision (an Addition entry with adjustment_for set to
+    the original layer). The unsold part of the increase goes to the layer's remaining
+    charges, the sold part to the invoices that consumed the layer: one adjustment
+    Allocation entry per invoice and item, one relative update of the Sales Invoice Items
+    and one GL posting per invoice, committed every `batch_size` invoices.
+    Invoices already adjusted for a revision are skipped, so a failed job can simply be run again.
+
+    :param import_doc_name: Name of the ImportDoc whose charges were revised.
+    :param batch_size: (Optional) Sales Invoices per transaction.
     """
-    # Get original Addition entry
-    original_addition = frappe.get_all(
+    import_doc = frappe.get_doc("ImportDoc", import_doc_name)
+    create_import_charge_revisions(import_doc)
+    frappe.db.commit()
+
+    adjustments_by_invoice = {}
+    for adjustment in get_pending_charge_adjustments(import_doc_name):
+        adjustments_by_invoice.setdefault(adjustment.sales_invoice, []).append(adjustment)
+
+    invoices = list(adjustments_by_invoice)
+    for start in range(0, len(invoices), batch_size):
+        batch = invoices[start:start + batch_size]
+        try:
+            post_charge_adjustments({invoice: adjustments_by_invoice[invoice] for invoice in batch})
+            frappe.db.commit()
+        except Exception as e:
+            frappe.db.rollback()
+            frappe.log_error(message=str(e), title=f"Import Charges Repost Error - {import_doc_name}")
+            raise
+
+        done = start + len(batch)
+        frappe.publish_progress(
+            done * 100 / len(invoices),
+            title="Reposting Import Charges",
+            doctype="ImportDoc",
+            docname=import_doc_name,
+            description=f"{done} of {len(invoices)} Sales Invoices adjusted"
+        )
+
+def create_import_charge_revisions(import_doc):
+    """
+    Record the increase of each item's Import Charges since the last repost.
+    Decreases are left alone.
+
+    :param import_doc: ImportDoc document.
+    """
+    new_charges = {}
+    for item in import_doc.items:
+        new_charges[item.item_code] = new_charges.get(item.item_code, 0) + flt(item.allocated_charges_ex_cd)
+
+    entries = frappe.get_all(
         "Charge Allocation Ledger",
         filters={
             "reference_doc": "ImportDoc",
-            "reference_doc_name": import_doc_name,
-            "item_code": item_code,
+            "reference_doc_name": import_doc.name,
             "entry_type": "Addition",
             "charge_type": "Import Charges",
             "is_cancelled": 0
         },
-        fields=["name", "charges", "qty"],
-        limit=1
+        fields=["name", "item_code", "qty", "charges", "remaining_qty", "adjustment_for"],
+        order_by="creation asc",
+        for_update=True
     )
 
-    if not original_addition:
-        frappe.throw(f"No original Addition entry found for {item_code} in ImportDoc {import_doc_name}")
-
-    original_entry = original_addition[0]
-    charge_difference = new_charges - original_entry.charges
+    current_charges = {}
+    layers_by_item = {}
+    for entry in entries:
+        current_charges[entry.item_code] = current_charges.get(entry.item_code, 0) + flt(entry.charges)
+        if not entry.adjustment_for:
+            layers_by_item.setdefault(entry.item_code, []).append(entry)
+
+    layer_deltas = []
+    for item_code, charges in new_charges.items():
+        layers = layers_by_item.get(item_code)
+        difference = flt(charges - current_charges.get(item_code, 0), 2)
+        total_qty = sum(flt(layer.qty) for layer in layers or [])
+        if not layers or difference <= 0 or total_qty <= 0:
+            continue
+
+        charges_per_unit = difference / total_qty
+        for layer in layers:
+            frappe.get_doc({
+                "doctype": "Charge Allocation Ledger",
+                "entry_type": "Addition",
+                "charge_type": "Import Charges",
+                "posting_date": nowdate(),
+                "posting_time": nowtime(),
+                "posting_datetime": f"{nowdate()} {nowtime()}",
+                "item_code": item_code,
+                "qty": 0,  # The quantity stays on the original layer
+                "charges": charges_per_unit * flt(layer.qty),
+                "remaining_qty": 0,
+                "remaining_charges": 0,
+                "reference_doc": "ImportDoc",
+                "reference_doc_name": import_doc.name,
+                "adjustment_for": layer.name
+            }).insert(ignore_permissions=True)
+            layer_deltas.append({
+                "source_entry": layer.name,
+                "qty": 0,
+                "charges": charges_per_unit * flt(layer.remaining_qty)
+            })
 
-    if charge_difference <= 0:
-        # If there is no increase in charges, no action is needed
-        return
+    update_layer_balances(layer_deltas)
 
-    # Create a new Addition entry for the increased charges
-    create_charge_allocation_entry(
-        entry_type="Addition",
-        charge_type="Import Charges",
-        item_code=item_code,
-        qty=original_entry.qty,
-        charges=charge_difference,
-        reference_doc="ImportDoc",
-        reference_doc_name=import_doc_name
-    )
+def get_pending_charge_adjustments(import_doc_name):
+    """
+    Charges still to be posted on Sales Invoices for the revisions of an ImportDoc.
+    Only allocations made before a revision take part in it, later ones were made
+    at the revised rate.
 
-    # Get all allocation entries that have this Addition entry as a source
-    allocation_entries = frappe.get_all(
+    :param import_doc_name: Name of the ImportDoc.
+    :return: List of frappe._dict with revision, layer, item_code, sales_invoice, qty and charges.
+    """
+    revisions = frappe.get_all(
         "Charge Allocation Ledger",
         filters={
-            "entry_type": "Allocation",
+            "reference_doc": "ImportDoc",
+            "reference_doc_name": import_doc_name,
+            "entry_type": "Addition",
             "charge_type": "Import Charges",
+            "adjustment_for": ["is", "set"],
             "is_cancelled": 0
         },
-        fields=["name"]
+        fields=["name", "item_code", "charges", "adjustment_for", "creation"],
+        order_by="creation asc"
     )
+    if not revisions:
+        return []
 
-    # Filter allocations that use our specific Addition entry as source
-    existing_allocations = []
-    for alloc in allocation_entries:
-        allocation_doc = frappe.get_doc("Charge Allocation Ledger", alloc.name)
-        for source_ref in allocation_doc.source_references:
-            if source_ref.source_entry == original_addition[0].name:
-                existing_allocations.append({
-                    "name": allocation_doc.name,
-                    "qty": source_ref.allocated_qty,
-                    "charges": source_ref.allocated_charges,
-                    "reference_doc": allocation_doc.reference_doc,
-                    "reference_doc_name": allocation_doc.reference_doc_name,
-                    "source_reference": source_ref
-                })
-                break
-
-    if not existing_allocations:
-        # If no allocations exist, we are done after creating the addition entry
-        return
-
-    # Use the original quantity from the ImportDoc for calculating additional charge per unit
-    total_original_qty = original_entry.qty  # This is the original quantity from the Addition entry
-
-    # Calculate the additional charge per unit
-    additional_charge_per_unit = charge_difference / total_original_qty if total_original_qty > 0 else 0
-
-    # Allocate the additional charges to existing allocations
-    for allocation in existing_allocations:
-        # Create new allocation entry for the additional charge per unit
-        create_charge_allocation_entry(
-            entry_type="Allocation",
-            charge_type="Import Charges",
-            item_code=item_code,
-            qty=allocation["qty"],
-            charges=additional_charge_per_unit * allocation["qty"],
-            reference_doc=allocation["reference_doc"],
-            reference_doc_name=allocation["reference_doc_name"]
+    layer_qty = dict(frappe.get_all(
+        "Charge Allocation Ledger",
+        filters={"name": ["in", list({revision.adjustment_for for revision in revisions})]},
+        fields=["name", "qty"],
+        as_list=True
+    ))
+
+    adjusted = set(
+        (entry.adjustment_for, entry.reference_doc_name)
+        for entry in frappe.get_all(
+            "Charge Allocation Ledger",
+            filters={
+                "entry_type": "Allocation",
+                "adjustment_for": ["in", [revision.name for revision in revisions]],
+                "is_cancelled": 0
+            },
+            fields=["adjustment_for", "reference_doc_name"]
         )
+    )
 
-        # Update allocated charges in the reference document (e.g., Sales Invoice)
-        if allocation["reference_doc"] == "Sales Invoice":
-            current_charges = frappe.db.get_value(
-                "Sales Invoice Item",
-                {"parent": allocation["reference_doc_name"], "item_code": item_code},
-                "custom_allocated_charges"
-            ) or 0
-            
-            update_allocated_charges(
-                allocation["reference_doc_name"],
-                item_code,
-                current_charges + (additional_charge_per_unit * allocation["qty"]),
-                "Import Charges"
+    adjustments = {}
+    for revision in revisions:
+        if not flt(layer_qty.get(revision.adjustment_for)):
+            continue
+        charges_per_unit = flt(revision.charges) / flt(layer_qty[revision.adjustment_for])
+
+        for allocation in get_allocations_of_layer(revision.adjustment_for, created_before=revision.creation):
+            if allocation["reference_doc"] != "Sales Invoice":
+                continue
+            if (revision.name, allocation["reference_doc_name"]) in adjusted:
+                continue
+
+            adjustment = adjustments.setdefault(
+                (revision.name, allocation["reference_doc_name"]),
+                frappe._dict({
+                    "revision": revision.name,
+                    "layer": revision.adjustment_for,
+                    "item_code": revision.item_code,
+                    "sales_invoice": allocation["reference_doc_name"],
+                    "qty": 0,
+                    "charges": 0
+                })
             )
+            adjustment.qty += allocation["qty"]
+            adjustment.charges += charges_per_unit * allocation["qty"]
 
-            # Create GL entries for the additional charges
-            create_charge_allocation_gl(
-                posting_date=nowdate(),
-                charges=(additional_charge_per_unit * allocation["qty"]),
-                reference_doc_name=allocation["reference_doc_name"],
-                charge_type="Import Charges"
-            )
+    return list(adjustments.values())
 
+def post_charge_adjustments(adjustments_by_invoice):
+    """
+    Post revision adjustments on Sales Invoices: the adjustment Allocation entries (with the
+    revised layer as their source, for returns), the Sales Invoice Items (split over the item's rows by qty) and one GL posting per invoice.
 
+    :param adjustments_by_invoice: dict of Sales Invoice name -> adjustments from get_pending_charge_adjustments.
+    """
+    charges_by_row = {}
+    for invoice, adjustments in adjustments_by_invoice.items():
+        sales_invoice = frappe.get_doc("Sales Invoice", invoice)
+        gl_legs = []
+        for adjustment in adjustments:
+            if not adjustment.charges:
+                continue
+
+            frappe.get_doc({
+                "doctype": "Charge Allocation Ledger",
+                "entry_type": "Allocation",
+                "charge_type": "Import Charges",
+                "posting_date": nowdate(),
+                "posting_time": nowtime(),
+                "posting_datetime": f"{nowdate()} {nowtime()}",
+                "item_code": adjustment.item_code,
+                "qty": adjustment.qty,
+                "charges": adjustment.charges,
+                "reference_doc": "Sales Invoice",
+                "reference_doc_name": invoice,
+                "adjustment_for": adjustment.revision,
+                # The adjusted units of the layer, so returns of them give the revision charges back
+                "source_references": [{
+                    "source_entry": adjustment.layer,
+                    "allocated_qty": adjustment.qty,
+                    "allocated_charges": adjustment.charges,
+                    "charge_type": "Import Charges"
+                }],
+                "is_cancelled": 0
+            }).insert(ignore_permissions=True)
+            gl_legs.extend(get_charge_allocation_gl_legs(sales_invoice.company, "Import Charges", adjustment.charges, 0))
 
-    
-    
+            item_rows = [row for row in sales_invoice.items if row.item_code == adjustment.item_code]
+            total_qty = sum(flt(row.qty) for row in item_rows)
+            for row in item_rows:
+                share = flt(row.qty) / total_qty if total_qty else 1 / len(item_rows)
+                charges_by_row[row.name] = charges_by_row.get(row.name, 0) + adjustment.charges * share
 
+        make_charge_allocation_gl_entries(sales_invoice, gl_legs, posting_date=nowdate())
 
+    add_allocated_charges(charges_by_row, "Import Charges")
@@ -0,0 +1,106 @@
+"""
+FIFO consumption of charge layers (Addition entries of the Charge Allocation Ledger).
+Pure functions without Frappe dependency, the controller does the locking and the writes.
+"""
+
+
+def plan_fifo_consumption(layers, qty):
+    """
+    Consume `qty` from the layers, oldest first. Each layer gives its charges pro rata
+    of the quantity taken from it.
+
+    :param layers: Open layers, oldest first. Mappings with name, remaining_qty and remaining_charges.
+    :param qty: Quantity to allocate.
+    :return: (consumptions, allocated_qty, allocated_charges), consumptions being a list of
+        dicts with source_entry, allocated_qty and allocated_charges.
+    """
+    consumptions = []
+    allocated_qty = 0
+    allocated_charges = 0
+
+    for layer in layers:
+        if allocated_qty >= qty:
+            break
+        if layer["remaining_qty"] <= 0:
+            continue
+
+        allocatable_qty = min(layer["remaining_qty"], qty - allocated_qty)
+        charges_per_unit = layer["remaining_charges"] / layer["remaining_qty"]
+        allocatable_charges = float(charges_per_unit * allocatable_qty)
+
+        consumptions.append({
+            "source_entry": layer["name"],
+            "allocated_qty": allocatable_qty,
+            "allocated_charges": allocatable_charges
+        })
+        allocated_qty += allocatable_qty
+        allocated_charges += allocatable_charges
+
+    return consumptions, allocated_qty, allocated_charges
+
+
+def get_layer_deltas(consumptions):
+    """
+    Changes to apply to remaining_qty / remaining_charges of the consumed layers.
+    """
+    return [
+        {
+            "source_entry": consumption["source_entry"],
+            "qty": -consumption["allocated_qty"],
+            "charges": -consumption["allocated_charges"]
+        }
+        for consumption in consumptions
+    ]
+
+
+def plan_return(allocation_sources, qty):
+    """
+    Give `qty` back to the layers it was allocated from. Sources are walked in the given
+    order (the caller puts the returned invoice's allocations first, then the latest ones)
+    and each gives back at the charge rate it was allocated at.
+
+    :param allocation_sources: Iterable of source rows of Allocation entries, mappings with
+        name, source_entry, allocated_qty, allocated_charges and returned_qty. May be lazy,
+        it is only consumed as far as needed.
+    :param qty: Quantity returned (absolute value).
+    :return: (restorations, returned_qty, returned_charges), restorations being a list of
+        dicts with source_row, source_entry, returned_qty and returned_charges.
+    """
+    restorations = []
+    returned_qty = 0
+    returned_charges = 0
+    if qty <= 0:
+        return restorations, returned_qty, returned_charges
+
+    for source in allocation_sources:
+        returnable_qty = min(source["allocated_qty"] - source["returned_qty"], qty - returned_qty)
+        if returnable_qty <= 0:
+            continue
+        charges_per_unit = source["allocated_charges"] / source["allocated_qty"]
+        returnable_charges = float(charges_per_unit * returnable_qty)
+
+        restorations.append({
+            "source_row": source["name"],
+            "source_entry": source["source_entry"],
+            "returned_qty": returnable_qty,
+            "returned_charges": returnable_charges
+        })
+        returned_qty += returnable_qty
+        returned_charges += returnable_charges
+        if returned_qty >= qty:
+            # Stop before reading further sources
+            break
+
+    return restorations, returned_qty, returned_charges
+
+
+def merge_layer_deltas(deltas):
+    """
+    Sum the deltas of each layer, so every layer is written once.
+    """
+    merged = {}
+    for delta in deltas:
+        layer = merged.setdefault(delta["source_entry"], {"source_entry": delta["source_entry"], "qty": 0, "charges": 0})
+        layer["qty"] += delta["qty"]
+        layer["charges"] += delta["charges"]
+    return list(merged.values())
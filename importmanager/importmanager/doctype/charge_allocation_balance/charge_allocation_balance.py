@@ -0,0 +1,117 @@
+# Copyright (c) 2026, SpotLedger and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt, getdate, now, nowdate
+
+
+class ChargeAllocationBalance(Document):
+	pass
+
+
+def on_doctype_update():
+	# One row per item, charge type and day, also used for the point-in-time lookups
+	frappe.db.add_unique(
+		"Charge Allocation Balance",
+		["item_code", "charge_type", "posting_date"],
+		constraint_name="item_charge_date"
+	)
+
+
+def update_charge_allocation_balance(deltas, posting_date=None):
+	"""
+	Apply changes of the unallocated qty and charges (the remaining balance of the Addition
+	layers) to the day's balance row, creating it from the previous day's balance if needed.
+
+	:param deltas: List of dicts with item_code, charge_type, qty and charges.
+	:param posting_date: (Optional) Day of the change, defaults to today.
+	"""
+	posting_date = getdate(posting_date or nowdate())
+
+	merged = {}
+	for delta in deltas:
+		key = (delta["item_code"], delta["charge_type"])
+		balance = merged.setdefault(key, {"qty": 0, "charges": 0})
+		balance["qty"] += flt(delta["qty"])
+		balance["charges"] += flt(delta["charges"])
+
+	for (item_code, charge_type), delta in merged.items():
+		if not (delta["qty"] or delta["charges"]):
+			continue
+
+		previous = get_balance_row(item_code, charge_type, posting_date, before=True)
+		frappe.db.sql(
+			"""
+			insert into `tabCharge Allocation Balance`
+				(name, creation, modified, modified_by, owner, docstatus, idx,
+				item_code, charge_type, posting_date, qty_change, charges_change, balance_qty, balance_charges)
+			values (%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0, 0,
+				%(item_code)s, %(charge_type)s, %(posting_date)s, %(qty)s, %(charges)s, %(balance_qty)s, %(balance_charges)s)
+			on duplicate key update
+				qty_change = qty_change + values(qty_change),
+				charges_change = charges_change + values(charges_change),
+				balance_qty = balance_qty + values(qty_change),
+				balance_charges = balance_charges + values(charges_change),
+				modified = values(modified),
+				modified_by = values(modified_by)
+			""",
+			{
+				"name": frappe.generate_hash(length=10),
+				"now": now(),
+				"user": frappe.session.user,
+				"item_code": item_code,
+				"charge_type": charge_type,
+				"posting_date": posting_date,
+				"qty": delta["qty"],
+				"charges": delta["charges"],
+				"balance_qty": flt(previous.balance_qty if previous else 0) + delta["qty"],
+				"balance_charges": flt(previous.balance_charges if previous else 0) + delta["charges"]
+			}
+		)
+		# Backdated changes carry over to the balances of the following days
+		frappe.db.sql(
+			"""
+			update `tabCharge Allocation Balance`
+			set balance_qty = balance_qty + %s, balance_charges = balance_charges + %s
+			where item_code = %s and charge_type = %s and posting_date > %s
+			""",
+			(delta["qty"], delta["charges"], item_code, charge_type, posting_date)
+		)
+
+
+def get_balance_row(item_code, charge_type, posting_date=None, before=False):
+	"""
+	Latest balance row of the item on or before (or strictly before) the date.
+	"""
+	operator = "<" if before else "<="
+	rows = frappe.get_all(
+		"Charge Allocation Balance",
+		filters={
+			"item_code": item_code,
+			"charge_type": charge_type,
+			"posting_date": [operator, getdate(posting_date or nowdate())]
+		},
+		fields=["posting_date", "balance_qty", "balance_charges"],
+		order_by="posting_date desc",
+		limit=1
+	)
+	return rows[0] if rows else None
+
+
+@frappe.whitelist()
+def get_charge_allocation_balance(item_code, charge_type="Import Charges", posting_date=None):
+	"""
+	Unallocated qty and charges of an item at the end of a day, read from one balance row.
+
+	:param item_code: Item code.
+	:param charge_type: (Optional) 'Import Charges' or 'Assessment Variance'.
+	:param posting_date: (Optional) Date of the balance, defaults to today.
+	:return: dict with qty and charges.
+	"""
+	frappe.has_permission("Charge Allocation Balance", "read", throw=True)
+	row = get_balance_row(item_code, charge_type, posting_date)
+	return {
+		"qty": flt(row.balance_qty) if row else 0,
+		"charges": flt(row.balance_charges) if row else 0
+	}
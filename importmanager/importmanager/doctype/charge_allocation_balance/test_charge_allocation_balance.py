@@ -0,0 +1,105 @@
+# Copyright (c) 2026, SpotLedger and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, flt, getdate, nowdate
+from importmanager.importmanager.doctype.charge_allocation_balance.charge_allocation_balance import (
+	get_charge_allocation_balance,
+	update_charge_allocation_balance
+)
+
+TEST_ITEM = "_Test Charge Allocation Balance Item"
+CHARGE_TYPE = "Import Charges"
+
+
+class TestChargeAllocationBalance(FrappeTestCase):
+	def setUp(self):
+		self.today = getdate(nowdate())
+
+	def tearDown(self):
+		frappe.db.delete("Charge Allocation Balance", {"item_code": TEST_ITEM})
+
+	def post(self, qty, charges, posting_date):
+		update_charge_allocation_balance(
+			[{"item_code": TEST_ITEM, "charge_type": CHARGE_TYPE, "qty": qty, "charges": charges}],
+			posting_date
+		)
+
+	def get_rows(self):
+		return frappe.get_all(
+			"Charge Allocation Balance",
+			filters={"item_code": TEST_ITEM, "charge_type": CHARGE_TYPE},
+			fields=["posting_date", "qty_change", "charges_change", "balance_qty", "balance_charges"],
+			order_by="posting_date asc"
+		)
+
+	def assertRow(self, row, posting_date, qty_change, charges_change, balance_qty, balance_charges):
+		self.assertEqual(getdate(row.posting_date), posting_date)
+		self.assertEqual(
+			(flt(row.qty_change), flt(row.charges_change), flt(row.balance_qty), flt(row.balance_charges)),
+			(qty_change, charges_change, balance_qty, balance_charges)
+		)
+
+	def test_first_change_inserts_the_day_row(self):
+		self.post(10, 100, self.today)
+
+		rows = self.get_rows()
+		self.assertEqual(len(rows), 1)
+		self.assertRow(rows[0], self.today, 10, 100, 10, 100)
+
+	def test_changes_on_the_same_day_increment_the_row(self):
+		self.post(10, 100, self.today)
+		self.post(-4, -40, self.today)
+
+		rows = self.get_rows()
+		self.assertEqual(len(rows), 1)
+		self.assertRow(rows[0], self.today, 6, 60, 6, 60)
+
+	def test_deltas_of_one_call_are_merged(self):
+		update_charge_allocation_balance(
+			[
+				{"item_code": TEST_ITEM, "charge_type": CHARGE_TYPE, "qty": 3, "charges": 30},
+				{"item_code": TEST_ITEM, "charge_type": CHARGE_TYPE, "qty": 2, "charges": 20}
+			],
+			self.today
+		)
+
+		rows = self.get_rows()
+		self.assertEqual(len(rows), 1)
+		self.assertRow(rows[0], self.today, 5, 50, 5, 50)
+
+	def test_new_day_opens_from_the_previous_balance(self):
+		yesterday = add_days(self.today, -1)
+		self.post(10, 100, yesterday)
+		self.post(5, 20, self.today)
+
+		rows = self.get_rows()
+		self.assertRow(rows[0], yesterday, 10, 100, 10, 100)
+		self.assertRow(rows[1], self.today, 5, 20, 15, 120)
+
+	def test_backdated_change_carries_over_to_later_days(self):
+		self.post(10, 100, self.today)
+		self.post(4, 40, add_days(self.today, -5))
+		self.post(1, 5, add_days(self.today, -2))
+
+		rows = self.get_rows()
+		self.assertEqual(len(rows), 3)
+		self.assertRow(rows[0], add_days(self.today, -5), 4, 40, 4, 40)
+		self.assertRow(rows[1], add_days(self.today, -2), 1, 5, 5, 45)
+		self.assertRow(rows[2], self.today, 10, 100, 15, 145)
+
+	def test_balance_as_of_date(self):
+		self.post(4, 40, add_days(self.today, -5))
+		self.post(10, 100, self.today)
+
+		# Before the first change, on a day without a row, and on a day with one
+		self.assertEqual(
+			get_charge_allocation_balance(TEST_ITEM, CHARGE_TYPE, add_days(self.today, -6)),
+			{"qty": 0, "charges": 0}
+		)
+		self.assertEqual(
+			get_charge_allocation_balance(TEST_ITEM, CHARGE_TYPE, add_days(self.today, -1)),
+			{"qty": 4, "charges": 40}
+		)
+		self.assertEqual(get_charge_allocation_balance(TEST_ITEM, CHARGE_TYPE), {"qty": 14, "charges": 140})
@@ -1,11 +1,60 @@
 # Copyright (c) 2024, SpotLedger and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, flt
+from importmanager.importmanager.doctype.charge_allocation_balance.charge_allocation_balance import (
+	update_charge_allocation_balance
+)
 
 
 class ChargeAllocationLedger(Document):
-	pass
+	def validate(self):
+		self.set_is_open()
 
-	
+	def after_insert(self):
+		# A new layer adds to the unallocated balance, later changes of the layers
+		# are posted by update_layer_balances
+		if self.entry_type == "Addition" and not cint(self.is_cancelled):
+			update_charge_allocation_balance(
+				[{
+					"item_code": self.item_code,
+					"charge_type": self.charge_type,
+					"qty": self.remaining_qty,
+					"charges": self.remaining_charges
+				}],
+				self.posting_date
+			)
+
+	def set_is_open(self):
+		"""
+		Open layers are the Addition entries that still have quantity to allocate,
+		FIFO allocation only reads these (see get_open_layers).
+		"""
+		self.is_open = get_is_open(self.entry_type, self.is_cancelled, self.remaining_qty)
+
+
+def get_is_open(entry_type, is_cancelled, remaining_qty):
+	return cint(entry_type == "Addition" and not cint(is_cancelled) and flt(remaining_qty) > 0)
+
+
+def on_doctype_update():
+	# FIFO lookup of open layers: is_open + item_code + charge_type, oldest first
+	frappe.db.add_index(
+		"Charge Allocation Ledger",
+		["is_open", "item_code", "charge_type", "posting_datetime"],
+		index_name="open_layers_index"
+	)
+	# Allocations/returns of an item, latest first
+	frappe.db.add_index(
+		"Charge Allocation Ledger",
+		["item_code", "charge_type", "entry_type", "posting_datetime"],
+		index_name="item_charge_entries_index"
+	)
+	# Entries of a reference document, e.g. allocations of a returned or cancelled invoice
+	frappe.db.add_index(
+		"Charge Allocation Ledger",
+		["reference_doc_name", "reference_doc"],
+		index_name="reference_doc_index"
+	)
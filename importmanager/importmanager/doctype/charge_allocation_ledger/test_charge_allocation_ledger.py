@@ -1,9 +1,158 @@
 # Copyright (c) 2024, SpotLedger and Contributors
 # See license.txt
 
-# import frappe
+import threading
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+from importmanager.importmanager.controllers.charge_allocation_controller import (
+	cancel_allocation,
+	create_charge_allocation_entry
+)
+
+TEST_ITEM = "_Test Charge Allocation Item"
+
+# (qty, charges) of the Addition layers, oldest first
+TEST_LAYERS = ((10, 100), (5, 75), (20, 50))
 
 
 class TestChargeAllocationLedger(FrappeTestCase):
-	pass
+	def setUp(self):
+		if not frappe.db.exists("Item", TEST_ITEM):
+			frappe.get_doc({
+				"doctype": "Item",
+				"item_code": TEST_ITEM,
+				"item_group": "All Item Groups",
+				"stock_uom": "Nos",
+				"is_stock_item": 1
+			}).insert()
+
+		for qty, charges in TEST_LAYERS:
+			create_charge_allocation_entry(
+				"Addition", "Import Charges", TEST_ITEM, qty, charges, "ImportDoc", "_Test ImportDoc"
+			)
+		# The workers use their own connections, so the layers must be committed
+		frappe.db.commit()
+
+	def tearDown(self):
+		entries = frappe.get_all("Charge Allocation Ledger", filters={"item_code": TEST_ITEM}, pluck="name")
+		if entries:
+			frappe.db.delete("Charge Allocation Source", {"parent": ["in", entries]})
+			frappe.db.delete("Charge Allocation Ledger", {"name": ["in", entries]})
+		frappe.db.delete("Charge Allocation Balance", {"item_code": TEST_ITEM})
+		frappe.db.commit()
+
+	def test_parallel_allocations_conserve_layers(self):
+		"""
+		Allocations submitted at the same time from separate connections go through
+		get_open_layers(for_update=True) and update_layer_balances: together they must consume
+		exactly what they recorded, and no layer may be consumed twice.
+		"""
+		site = frappe.local.site
+		workers, allocations_per_worker = 6, 5
+		errors = []
+
+		def submitter(worker):
+			frappe.init(site=site)
+			frappe.connect()
+			try:
+				for i in range(allocations_per_worker):
+					create_charge_allocation_entry(
+						"Allocation", "Import Charges", TEST_ITEM, 1, 0, "Sales Invoice", f"_Test SINV-{worker}-{i}"
+					)
+					frappe.db.commit()
+			except Exception as e:
+				frappe.db.rollback()
+				errors.append(e)
+			finally:
+				frappe.destroy()
+
+		threads = [threading.Thread(target=submitter, args=(worker,)) for worker in range(workers)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(errors, [])
+
+		layers = frappe.get_all(
+			"Charge Allocation Ledger",
+			filters={"item_code": TEST_ITEM, "entry_type": "Addition"},
+			fields=["remaining_qty", "remaining_charges", "is_open"]
+		)
+		allocations = frappe.get_all(
+			"Charge Allocation Ledger",
+			filters={"item_code": TEST_ITEM, "entry_type": "Allocation"},
+			fields=["qty", "charges"]
+		)
+
+		total_qty = sum(qty for qty, _ in TEST_LAYERS)
+		total_charges = sum(charges for _, charges in TEST_LAYERS)
+		allocated_qty = sum(flt(allocation.qty) for allocation in allocations)
+		allocated_charges = sum(flt(allocation.charges) for allocation in allocations)
+
+		self.assertEqual(len(allocations), workers * allocations_per_worker)
+		self.assertEqual(allocated_qty, workers * allocations_per_worker)
+		self.assertEqual(sum(flt(layer.remaining_qty) for layer in layers) + allocated_qty, total_qty)
+		self.assertAlmostEqual(
+			sum(flt(layer.remaining_charges) for layer in layers) + allocated_charges, total_charges, places=4
+		)
+		for layer in layers:
+			self.assertGreaterEqual(flt(layer.remaining_qty), 0)
+			self.assertEqual(layer.is_open, int(flt(layer.remaining_qty) > 0))
+
+	def get_layer_balances(self):
+		return {
+			layer.name: (flt(layer.remaining_qty), flt(layer.remaining_charges, 6))
+			for layer in frappe.get_all(
+				"Charge Allocation Ledger",
+				filters={"item_code": TEST_ITEM, "entry_type": "Addition"},
+				fields=["name", "remaining_qty", "remaining_charges"]
+			)
+		}
+
+	def get_returned_qty(self):
+		return frappe.get_all(
+			"Charge Allocation Source",
+			filters={"parent": ["in", frappe.get_all(
+				"Charge Allocation Ledger",
+				filters={"item_code": TEST_ITEM, "entry_type": "Allocation"},
+				pluck="name"
+			)]},
+			fields=["name", "returned_qty"],
+			order_by="name"
+		)
+
+	def test_cancelled_return_is_taken_back_from_the_layers(self):
+		create_charge_allocation_entry("Allocation", "Import Charges", TEST_ITEM, 12, 0, "Sales Invoice", "_Test SINV-A")
+		after_allocation = self.get_layer_balances()
+		returned_before = self.get_returned_qty()
+
+		create_charge_allocation_entry("Return", "Import Charges", TEST_ITEM, -5, 0, "Sales Invoice", "_Test SINV-A-RET")
+		self.assertNotEqual(self.get_layer_balances(), after_allocation)
+
+		cancel_allocation("_Test SINV-A-RET")
+
+		self.assertEqual(self.get_layer_balances(), after_allocation)
+		self.assertEqual(self.get_returned_qty(), returned_before)
+		self.assertEqual(
+			frappe.db.get_value(
+				"Charge Allocation Ledger", {"reference_doc_name": "_Test SINV-A-RET", "entry_type": "Return"}, "is_cancelled"
+			),
+			1
+		)
+
+		# The returned rows can be returned again
+		create_charge_allocation_entry("Return", "Import Charges", TEST_ITEM, -5, 0, "Sales Invoice", "_Test SINV-A-RET2")
+
+	def test_return_cancel_fails_once_its_qty_is_allocated_again(self):
+		create_charge_allocation_entry("Allocation", "Import Charges", TEST_ITEM, 12, 0, "Sales Invoice", "_Test SINV-B")
+		create_charge_allocation_entry("Return", "Import Charges", TEST_ITEM, -5, 0, "Sales Invoice", "_Test SINV-B-RET")
+		# Everything left, including the returned qty, goes to another invoice
+		remaining_qty = sum(qty for qty, _ in self.get_layer_balances().values())
+		create_charge_allocation_entry(
+			"Allocation", "Import Charges", TEST_ITEM, remaining_qty, 0, "Sales Invoice", "_Test SINV-C"
+		)
+
+		self.assertRaises(frappe.ValidationError, cancel_allocation, "_Test SINV-B-RET")
@@ -1,4 +1,29 @@
 frappe.ui.form.on("ImportDoc", {
+    setup: function(frm) {
+        // Status of the background recompute queued by linked voucher submit/cancel
+        frappe.realtime.on("import_doc_recompute", function(data) {
+            if (data.import_doc !== frm.doc.name) {
+                return;
+            }
+            if (data.status === "Completed") {
+                frm.reload_doc();
+                frappe.show_alert({
+                    message: __("Import data updated"),
+                    indicator: 'green'
+                });
+            } else if (data.status === "Failed") {
+                frappe.show_alert({
+                    message: __("Import data update failed: {0}", [data.message]),
+                    indicator: 'red'
+                });
+            } else {
+                frappe.show_alert({
+                    message: __("Import data update {0}", [__(data.status)]),
+                    indicator: 'blue'
+                });
+            }
+        });
+    },
     refresh: function(frm) {
         // Add Update Import Data button only for saved documents
         if (!frm.is_new()) {
@@ -48,5 +73,21 @@ frappe.ui.form.on("ImportDoc", {
                 );
             }).addClass('btn-primary');
         }
+        // Revised charges of a locked document are posted to the invoices in the background
+        if (frm.doc.status === "Locked") {
+            frm.add_custom_button(__("Repost Import Charges"), function() {
+                frappe.confirm(
+                    'This will post the increase in import charges to the Sales Invoices of this shipment. Continue?',
+                    function() {
+                        frappe.call({
+                            method: "importmanager.importmanager.controllers.charge_allocation_controller.enqueue_import_doc_charges_repost",
+                            args: {
+                                import_doc_name: frm.doc.name
+                            }
+                        });
+                    }
+                );
+            });
+        }
     }
 });
\ No newline at end of file
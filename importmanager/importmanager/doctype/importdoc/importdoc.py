@@ -3,6 +3,7 @@
 
 import frappe
 from frappe.model.document import Document
+from importmanager.import_naming_utils import get_next_name
 from importmanager.import_utils import update_data_in_import_doc
 from importmanager.importmanager.controllers.charge_allocation_controller import create_charge_allocation_entry
 from erpnext.accounts.utils import get_fiscal_year
@@ -32,7 +33,7 @@ class ImportDoc(Document):
 			
 			abbr = frappe.get_cached_doc("Company",self.company).abbr
 			# Create the import doc name with proper format including current year
-			self.name = f"{abbr}-IMD-{fiscal_year}-{po_number}"
+			self.name = get_next_name("ImportDoc", f"{abbr}-IMD-{fiscal_year}-{po_number}")
 		else:
 			frappe.throw("Please select a Linked Purchase Order")
 
@@ -5,6 +5,7 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
+from importmanager.import_utils import clear_tariff_tax_rates_cache
 
 
 class CustomItemTaxTemplate(Document):
@@ -29,6 +30,18 @@ class CustomItemTaxTemplate(Document):
     def validate(self):
         self.validate_tax_accounts()
 
+    def on_update(self):
+        self.clear_tariff_cache()
+
+    def on_trash(self):
+        self.clear_tariff_cache()
+
+    def clear_tariff_cache(self):
+        """Tariff rates used by LCV assessment are cached by tariff number and country of origin"""
+        clear_tariff_tax_rates_cache()
+        # Again once committed, in case another request cached the old rates meanwhile
+        frappe.db.after_commit.add(clear_tariff_tax_rates_cache)
+
     def autoname(self):
         if self.company and self.title:
             abbr = frappe.get_cached_value("Company", self.company, "abbr")
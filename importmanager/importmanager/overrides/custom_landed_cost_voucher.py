@@ -6,15 +6,33 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 from frappe.model.meta import get_field_precision
+from frappe.query_builder import Criterion
 from frappe.query_builder.custom import ConstantColumn
-from frappe.utils import flt,datetime
-from importmanager.import_utils import calculate_import_assessment,create_import_taxes_jv,create_consolidated_import_taxes_jv
+from frappe.utils import flt,datetime,get_datetime
+from importmanager.import_account_utils import get_import_accounts
+from importmanager.import_naming_utils import get_next_name
+from importmanager.import_utils import IMPORT_TAX_LEGS,bulk_set_values,calculate_import_assessment,create_import_taxes_jv,create_consolidated_import_taxes_jv
 
 import erpnext
+from erpnext.controllers.stock_controller import (
+	create_repost_item_valuation_entry,
+	future_sle_exists,
+	repost_required_for_queue,
+)
 from erpnext.controllers.taxes_and_totals import init_landed_taxes_and_totals
 from erpnext.stock.doctype.serial_no.serial_no import get_serial_nos
 from erpnext.accounts.utils import get_fiscal_year as erp_get_fiscal_year
 
+# Default holding the time generated JVs started to carry custom_landed_cost_voucher
+JV_LCV_LINK_CUTOFF_KEY = "importmanager_jv_lcv_link_cutoff"
+
+# Title prefixes of the JVs generated on submit, see create_consolidated_import_taxes_jv
+ASSESSMENT_VARIANCE_JV_TITLE = "Assessment Variance Transfer - GD-"
+IMPORT_TAXES_JV_TITLE = "Consolidated Import Taxes - GD-"
+
+# Serial nos per UPDATE when setting their purchase rate
+SERIAL_NO_UPDATE_CHUNK_SIZE = 1000
+
 
 class CustomLandedCostVoucher(Document):
 	# begin: auto-generated types
@@ -91,21 +109,7 @@ class CustomLandedCostVoucher(Document):
 
 				base_name = f"ALP-LCV-{fiscal_year_name}-{import_doc.gd_no}"
 
-				# Get all names that match the pattern
-				existing = frappe.db.get_all(
-					"Landed Cost Voucher",
-					filters={"name": ["like", f"{base_name}%"]},
-					fields=["name"]
-				)
-				existing_names = {d.name for d in existing}
-				# Find the next available suffix
-				if base_name not in existing_names:
-					self.name = base_name
-				else:
-					i = 1
-					while f"{base_name}-{i}" in existing_names:
-						i += 1
-					self.name = f"{base_name}-{i}"
+				self.name = get_next_name("Landed Cost Voucher", base_name)
 	
 
 	def validate_country_of_rigin(self):
@@ -172,11 +176,11 @@ class CustomLandedCostVoucher(Document):
 		if not self.company:
 			frappe.throw("Company is required")
 			
-		company_doc = frappe.get_doc("Company", self.company)
+		import_accounts = get_import_accounts(self.company, validate=False)
 		#following account is deprecated on customers request
-		unallocated_import_charges_account = company_doc.custom_unallocated_import_charges_account
-		#customs_duty_account = company_doc.custom_customs_duty_account
-		assessment_variance_account = company_doc.custom_default_import_assessment_charge_account
+		unallocated_import_charges_account = import_accounts.unallocated_import_charges_account
+		#customs_duty_account = import_accounts.customs_duty_account
+		assessment_variance_account = import_accounts.default_import_assessment_charge_account
 		
 		# start from here
 		if not unallocated_import_charges_account:
@@ -366,7 +370,7 @@ class CustomLandedCostVoucher(Document):
 		self.validate_applicable_charges_for_item()
 		try:
 			#create_import_taxes_jv(self.name)
-			create_consolidated_import_taxes_jv(self.name)
+			create_consolidated_import_taxes_jv(self)
 			self.update_landed_cost()
 		except Exception:
 			frappe.db.rollback()
@@ -375,19 +379,86 @@ class CustomLandedCostVoucher(Document):
 			
 
 	def cancel_all_linked_jvs(self):
-		linked_jv = frappe.get_list("Journal Entry",filters={'custom_import_document':self.custom_import_document,'docstatus':1,'is_system_generated':1},fields=['name'],pluck='name')
+		"""
+		Cancel the system generated JVs of this LCV, found by their custom_landed_cost_voucher.
+		JVs of other LCVs on the same ImportDoc are left alone.
+		"""
+		filters = {'custom_landed_cost_voucher':self.name,'docstatus':1,'is_system_generated':1}
+		linked_jv = frappe.get_all("Journal Entry",filters=filters,pluck='name')
+		if not linked_jv and self.custom_import_document and self.is_before_jv_link():
+			# JVs posted before the back-reference existed and not linked by the backfill patch
+			linked_jv = self.get_legacy_jvs()
 		for item in linked_jv:
 			frappe.get_doc("Journal Entry",item).cancel()
 
 
+	def get_legacy_jvs(self):
+		"""
+		Unlinked system generated JVs of the ImportDoc that this LCV generated on submit: posted on
+		its posting date, with the title and (up to rounding) the total of one of its JVs.
+		At most one JV of each title is returned, so LCVs with the same taxes don't take each other's JV.
+		"""
+		totals = self.get_generated_jv_totals()
+		if not totals:
+			return []
+
+		jvs = frappe.get_all(
+			"Journal Entry",
+			filters={
+				'custom_import_document':self.custom_import_document,
+				'custom_landed_cost_voucher':['is','not set'],
+				'posting_date':self.posting_date,
+				'docstatus':1,
+				'is_system_generated':1
+			},
+			fields=['name','title','total_debit'],
+			order_by='creation asc'
+		)
+		# JV legs are rounded to whole amounts
+		tolerance = max(len(self.get("items")), 1)
+		legacy_jvs = {}
+		for jv in jvs:
+			for title, total in totals.items():
+				if (
+					title not in legacy_jvs
+					and (jv.title or "").startswith(title)
+					and abs(flt(jv.total_debit) - total) <= tolerance
+				):
+					legacy_jvs[title] = jv.name
+		return list(legacy_jvs.values())
+
+	def get_generated_jv_totals(self):
+		"""
+		Total of each JV create_consolidated_import_taxes_jv makes for this LCV, by title prefix.
+		"""
+		items = self.get("items")
+		totals = {
+			ASSESSMENT_VARIANCE_JV_TITLE: sum(max(flt(d.custom_base_assessment_difference), 0) for d in items),
+			IMPORT_TAXES_JV_TITLE: sum(max(flt(d.get(leg[0])), 0) for d in items for leg in IMPORT_TAX_LEGS)
+		}
+		return {title: total for title, total in totals.items() if total > 0}
+
+	def is_before_jv_link(self):
+		"""
+		Whether the LCV was created before generated JVs got custom_landed_cost_voucher
+		(cutoff recorded by the patch adding it; sites installed later have no legacy JVs).
+		"""
+		cutoff = frappe.db.get_default(JV_LCV_LINK_CUTOFF_KEY)
+		return bool(cutoff) and get_datetime(self.creation) < get_datetime(cutoff)
+
 	def on_cancel(self):
 		self.update_landed_cost()
 		self.cancel_all_linked_jvs()
 		
 
 	def update_landed_cost(self):
+		# Each receipt is loaded once and used for both passes
+		receipts = []
+		loaded_values = {}
 		for d in self.get("purchase_receipts"):
 			doc = frappe.get_doc(d.receipt_document_type, d.receipt_document)
+			receipts.append(doc)
+			loaded_values.update({item.name: get_db_values(item) for item in doc.get("items")})
 			# check if there are {qty} assets created and linked to this receipt document
 			if self.docstatus != 2:
 				self.validate_asset_qty_and_status(d.receipt_document_type, doc)
@@ -398,17 +469,15 @@ class CustomLandedCostVoucher(Document):
 			# set valuation amount in pr item
 			doc.update_valuation_rate(reset_outgoing_rate=False)
 
-			# db_update will update and save landed_cost_voucher_amount and voucher_amount in PR
-			for item in doc.get("items"):
-				item.db_update()
-
 			# asset rate will be updated while creating asset gl entries from PI or PY
 
-			# update latest valuation rate in serial no
-			self.update_rate_in_serial_no_for_non_asset_items(doc)
+		# update latest valuation rate in serial no
+		self.update_rate_in_serial_no_for_non_asset_items(receipts)
 
-		for d in self.get("purchase_receipts"):
-			doc = frappe.get_doc(d.receipt_document_type, d.receipt_document)
+		# save landed_cost_voucher_amount and valuation of all receipt items, one update per item doctype
+		self.update_receipt_item_valuation(receipts, loaded_values)
+
+		for doc in receipts:
 			# update stock & gl entries for cancelled state of PR
 			doc.docstatus = 2
 			doc.update_stock_ledger(allow_negative_stock=True, via_landed_cost_voucher=True)
@@ -418,11 +487,90 @@ class CustomLandedCostVoucher(Document):
 			doc.docstatus = 1
 			doc.make_bundle_using_old_serial_batch_fields(via_landed_cost_voucher=True)
 			doc.update_stock_ledger(allow_negative_stock=True, via_landed_cost_voucher=True)
-			if d.receipt_document_type == "Purchase Receipt":
+			if doc.doctype == "Purchase Receipt":
 				doc.make_gl_entries(via_landed_cost_voucher=True)
 			else:
 				doc.make_gl_entries()
-			doc.repost_future_sle_and_gle(via_landed_cost_voucher=True)
+
+		self.repost_future_sle_and_gle_for_receipts(receipts)
+
+	def update_receipt_item_valuation(self, receipts, loaded_values):
+		"""
+		Write the item columns changed by set_landed_cost_voucher_amount and update_valuation_rate,
+		for the items of all receipts at once instead of a db_update per item.
+
+		:param loaded_values: Column values of each item as loaded, by item name.
+		"""
+		values_by_doctype = {}
+		changed_fields = {}
+		for doc in receipts:
+			for item in doc.get("items"):
+				values = get_db_values(item)
+				loaded = loaded_values.get(item.name, {})
+				changed_fields.setdefault(item.doctype, set()).update(
+					field for field, value in values.items() if loaded.get(field) != value
+				)
+				values_by_doctype.setdefault(item.doctype, {})[item.name] = values
+
+		for doctype, values_by_name in values_by_doctype.items():
+			bulk_set_values(doctype, values_by_name, sorted(changed_fields[doctype]), update_modified=False)
+
+	def repost_future_sle_and_gle_for_receipts(self, receipts):
+		"""
+		Queue the future repost of all receipts together. With item based reposting (the default)
+		that is one Repost Item Valuation per item and warehouse, from its earliest posting among
+		the receipts, instead of one repost per receipt.
+		"""
+		receipts = [
+			doc for doc in receipts
+			if future_sle_exists(get_repost_args(doc)) or repost_required_for_queue(doc)
+		]
+		if not receipts:
+			return
+
+		if not frappe.db.get_single_value("Stock Reposting Settings", "item_based_reposting"):
+			for doc in receipts:
+				create_repost_item_valuation_entry(get_repost_args(doc))
+			return
+
+		names_by_doctype = {}
+		for doc in receipts:
+			names_by_doctype.setdefault(doc.doctype, []).append(doc.name)
+
+		sle = frappe.qb.DocType("Stock Ledger Entry")
+		receipt_conditions = [
+			(sle.voucher_type == doctype) & (sle.voucher_no.isin(names))
+			for doctype, names in names_by_doctype.items()
+		]
+		stock_ledger_entries = (
+			frappe.qb.from_(sle)
+			.select(sle.item_code, sle.warehouse, sle.posting_date, sle.posting_time, sle.voucher_type, sle.voucher_no)
+			.where(
+				Criterion.any(receipt_conditions)
+				& (sle.is_cancelled == 0)
+			)
+			.orderby(sle.posting_date)
+			.orderby(sle.posting_time)
+			.orderby(sle.creation)
+		).run(as_dict=True)
+
+		# the first entry of each item and warehouse is its earliest
+		earliest_entries = {}
+		for entry in stock_ledger_entries:
+			earliest_entries.setdefault((entry.item_code, entry.warehouse), entry)
+
+		for entry in earliest_entries.values():
+			create_repost_item_valuation_entry({
+				"based_on": "Item and Warehouse",
+				"item_code": entry.item_code,
+				"warehouse": entry.warehouse,
+				"posting_date": entry.posting_date,
+				"posting_time": entry.posting_time,
+				"voucher_type": entry.voucher_type,
+				"voucher_no": entry.voucher_no,
+				"company": self.company,
+				"via_landed_cost_voucher": 1
+			})
 
 	def validate_asset_qty_and_status(self, receipt_document_type, receipt_document):
 		for item in self.get("items"):
@@ -452,17 +600,40 @@ class CustomLandedCostVoucher(Document):
 								).format(item.receipt_document_type, item.receipt_document, item.item_code)
 							)
 
-	def update_rate_in_serial_no_for_non_asset_items(self, receipt_document):
-		for item in receipt_document.get("items"):
-			if not item.is_fixed_asset and item.serial_no:
-				serial_nos = get_serial_nos(item.serial_no)
-				if serial_nos:
-					frappe.db.sql(
-						"update `tabSerial No` set purchase_rate=%s where name in ({})".format(
-							", ".join(["%s"] * len(serial_nos))
-						),
-						tuple([item.valuation_rate, *serial_nos]),
-					)
+	def update_rate_in_serial_no_for_non_asset_items(self, receipt_documents):
+		"""
+		Set the purchase rate of the serial nos of all receipts, in chunked CASE updates
+		instead of one update per item.
+		"""
+		rates_by_serial_no = {}
+		for receipt_document in receipt_documents:
+			for item in receipt_document.get("items"):
+				if not item.is_fixed_asset and item.serial_no:
+					for serial_no in get_serial_nos(item.serial_no):
+						rates_by_serial_no[serial_no] = {"purchase_rate": item.valuation_rate}
+
+		bulk_set_values(
+			"Serial No",
+			rates_by_serial_no,
+			["purchase_rate"],
+			update_modified=False,
+			chunk_size=SERIAL_NO_UPDATE_CHUNK_SIZE
+		)
+
+
+def get_db_values(item):
+	return item.get_valid_dict(convert_dates_to_str=True, ignore_nulls=False)
+
+
+def get_repost_args(receipt_document):
+	return frappe._dict({
+		"posting_date": receipt_document.posting_date,
+		"posting_time": receipt_document.posting_time,
+		"voucher_type": receipt_document.doctype,
+		"voucher_no": receipt_document.name,
+		"company": receipt_document.company,
+		"via_landed_cost_voucher": 1
+	})
 
 
 def get_pr_items(purchase_receipt):
@@ -0,0 +1,40 @@
+import frappe
+from frappe.utils import flt, now, nowdate
+
+
+def execute():
+	"""
+	Open the Charge Allocation Balance with today's unallocated balance of every item.
+	Earlier days have no history, point-in-time balances start from this date.
+	"""
+	frappe.db.delete("Charge Allocation Balance")
+
+	balances = frappe.db.sql(
+		"""
+		select item_code, charge_type, sum(remaining_qty) as qty, sum(remaining_charges) as charges
+		from `tabCharge Allocation Ledger`
+		where entry_type = 'Addition' and is_cancelled = 0
+		group by item_code, charge_type
+		""",
+		as_dict=True
+	)
+
+	timestamp = now()
+	values = [
+		(
+			frappe.generate_hash(length=10), timestamp, timestamp, "Administrator", "Administrator",
+			balance.item_code, balance.charge_type, nowdate(),
+			flt(balance.qty), flt(balance.charges), flt(balance.qty), flt(balance.charges)
+		)
+		for balance in balances
+		if balance.charge_type and (flt(balance.qty) or flt(balance.charges))
+	]
+	frappe.db.bulk_insert(
+		"Charge Allocation Balance",
+		fields=[
+			"name", "creation", "modified", "modified_by", "owner",
+			"item_code", "charge_type", "posting_date",
+			"qty_change", "charges_change", "balance_qty", "balance_charges"
+		],
+		values=values
+	)
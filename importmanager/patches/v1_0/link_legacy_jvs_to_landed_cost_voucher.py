@@ -0,0 +1,27 @@
+import frappe
+
+from importmanager.importmanager.overrides.custom_landed_cost_voucher import JV_LCV_LINK_CUTOFF_KEY
+
+
+def execute():
+	"""
+	Set custom_landed_cost_voucher on the JVs generated before it existed, matched to their LCV
+	by ImportDoc, posting date, title and total. A JV matching more than one LCV is left unlinked,
+	those LCVs still find it with get_legacy_jvs on cancel.
+	"""
+	if not frappe.db.get_default(JV_LCV_LINK_CUTOFF_KEY):
+		return
+
+	lcvs_by_jv = {}
+	for name in frappe.get_all(
+		"Landed Cost Voucher", filters={"docstatus": 1, "custom_import_document": ["is", "set"]}, pluck="name"
+	):
+		lcv = frappe.get_doc("Landed Cost Voucher", name)
+		if not lcv.is_before_jv_link():
+			continue
+		for jv in lcv.get_legacy_jvs():
+			lcvs_by_jv.setdefault(jv, []).append(lcv.name)
+
+	for jv, lcvs in lcvs_by_jv.items():
+		if len(lcvs) == 1:
+			frappe.db.set_value("Journal Entry", jv, "custom_landed_cost_voucher", lcvs[0], update_modified=False)
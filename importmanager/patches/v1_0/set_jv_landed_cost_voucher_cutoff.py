@@ -0,0 +1,13 @@
+import frappe
+from frappe.utils import now
+
+from importmanager.importmanager.overrides.custom_landed_cost_voucher import JV_LCV_LINK_CUTOFF_KEY
+
+
+def execute():
+	"""
+	Record when generated JVs started to link their Landed Cost Voucher. Only LCVs created
+	before this fall back to cancelling the unlinked JVs of their ImportDoc.
+	"""
+	if not frappe.db.get_default(JV_LCV_LINK_CUTOFF_KEY):
+		frappe.db.set_default(JV_LCV_LINK_CUTOFF_KEY, now())
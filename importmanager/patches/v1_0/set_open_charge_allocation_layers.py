@@ -0,0 +1,11 @@
+import frappe
+
+
+def execute():
+	"""Flag the existing unexhausted Addition entries as open layers."""
+	frappe.db.sql(
+		"""
+		update `tabCharge Allocation Ledger`
+		set is_open = if(entry_type = 'Addition' and is_cancelled = 0 and remaining_qty > 0, 1, 0)
+		"""
+	)
@@ -0,0 +1,87 @@
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, now, nowdate
+from importmanager.import_utils import create_journal_voucher
+from importmanager.importmanager.overrides.custom_landed_cost_voucher import (
+    IMPORT_TAXES_JV_TITLE,
+    JV_LCV_LINK_CUTOFF_KEY
+)
+from importmanager.patches.v1_0 import link_legacy_jvs_to_landed_cost_voucher
+
+test_dependencies = ["Account", "Supplier"]
+
+TEST_COMPANY = "_Test Company"
+TEST_IMPORT_DOC = "_Test ImportDoc Legacy JV"
+
+
+class TestLegacyJVCancellation(FrappeTestCase):
+    def setUp(self):
+        frappe.db.set_default(JV_LCV_LINK_CUTOFF_KEY, now())
+        if not frappe.db.exists("ImportDoc", TEST_IMPORT_DOC):
+            # Named directly, the ImportDoc autoname needs a Purchase Order
+            frappe.get_doc({
+                "doctype": "ImportDoc",
+                "name": TEST_IMPORT_DOC,
+                "date": nowdate(),
+                "supplier": "_Test Supplier",
+                "company": TEST_COMPANY,
+                "gd_no": "LEGACY"
+            }).db_insert()
+
+        # Two legacy LCVs on one ImportDoc, each with the taxes JV it generated before the link existed
+        self.lcvs = [self.get_legacy_lcv(100), self.get_legacy_lcv(250)]
+        self.jvs = [self.make_legacy_jv(100), self.make_legacy_jv(250)]
+
+    def get_legacy_lcv(self, sales_tax):
+        lcv = frappe.get_doc({
+            "doctype": "Landed Cost Voucher",
+            "company": TEST_COMPANY,
+            "posting_date": nowdate(),
+            "custom_import_document": TEST_IMPORT_DOC,
+            "items": [{"custom_stamnt": sales_tax}]
+        })
+        lcv.name = frappe.generate_hash(length=10)
+        lcv.creation = add_days(now(), -1)
+        return lcv
+
+    def make_legacy_jv(self, amount):
+        create_journal_voucher(
+            f"{IMPORT_TAXES_JV_TITLE}LEGACY",
+            nowdate(),
+            [
+                {"account": "_Test Bank - _TC", "debit": amount, "credit": 0},
+                {"account": "_Test Cash - _TC", "debit": 0, "credit": amount}
+            ],
+            import_document=TEST_IMPORT_DOC,
+            company=TEST_COMPANY
+        )
+        return frappe.get_all(
+            "Journal Entry",
+            filters={"custom_import_document": TEST_IMPORT_DOC, "total_debit": amount, "docstatus": 1},
+            pluck="name"
+        )[0]
+
+    def test_legacy_jvs_are_matched_to_their_lcv(self):
+        self.assertEqual(self.lcvs[0].get_legacy_jvs(), [self.jvs[0]])
+        self.assertEqual(self.lcvs[1].get_legacy_jvs(), [self.jvs[1]])
+
+    def test_cancel_leaves_the_jv_of_the_other_lcv(self):
+        self.lcvs[0].cancel_all_linked_jvs()
+
+        self.assertEqual(frappe.db.get_value("Journal Entry", self.jvs[0], "docstatus"), 2)
+        self.assertEqual(frappe.db.get_value("Journal Entry", self.jvs[1], "docstatus"), 1)
+
+    def test_backfill_links_legacy_jvs(self):
+        # The patch loads the LCVs from the database
+        for lcv in self.lcvs:
+            lcv.docstatus = 1
+            lcv.db_insert()
+            for item in lcv.items:
+                item.name = frappe.generate_hash(length=10)
+                item.parent, item.parenttype, item.parentfield = lcv.name, lcv.doctype, "items"
+                item.db_insert()
+
+        link_legacy_jvs_to_landed_cost_voucher.execute()
+
+        for lcv, jv in zip(self.lcvs, self.jvs):
+            self.assertEqual(frappe.db.get_value("Journal Entry", jv, "custom_landed_cost_voucher"), lcv.name)
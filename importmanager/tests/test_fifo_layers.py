@@ -0,0 +1,147 @@
+import random
+import unittest
+from importmanager.importmanager.controllers.fifo_layers import (
+    get_layer_deltas,
+    merge_layer_deltas,
+    plan_fifo_consumption,
+    plan_return
+)
+
+
+def make_layers():
+    return [
+        {"name": "CAL-1", "remaining_qty": 10, "remaining_charges": 100},
+        {"name": "CAL-2", "remaining_qty": 5, "remaining_charges": 75},
+        {"name": "CAL-3", "remaining_qty": 20, "remaining_charges": 50}
+    ]
+
+
+class TestFifoLayers(unittest.TestCase):
+
+    def test_consumes_oldest_layer_first(self):
+        consumptions, allocated_qty, allocated_charges = plan_fifo_consumption(make_layers(), 4)
+        self.assertEqual(consumptions, [{"source_entry": "CAL-1", "allocated_qty": 4, "allocated_charges": 40}])
+        self.assertEqual((allocated_qty, allocated_charges), (4, 40))
+
+    def test_spans_layers_pro_rata(self):
+        consumptions, allocated_qty, allocated_charges = plan_fifo_consumption(make_layers(), 17)
+        self.assertEqual([c["source_entry"] for c in consumptions], ["CAL-1", "CAL-2", "CAL-3"])
+        self.assertEqual([c["allocated_qty"] for c in consumptions], [10, 5, 2])
+        self.assertEqual(allocated_qty, 17)
+        self.assertAlmostEqual(allocated_charges, 100 + 75 + 5)
+
+    def test_partial_when_layers_run_out(self):
+        consumptions, allocated_qty, allocated_charges = plan_fifo_consumption(make_layers(), 50)
+        self.assertEqual(allocated_qty, 35)
+        self.assertAlmostEqual(allocated_charges, 225)
+
+    def test_skips_exhausted_layers(self):
+        layers = make_layers()
+        layers[0]["remaining_qty"] = 0
+        consumptions, _, _ = plan_fifo_consumption(layers, 1)
+        self.assertEqual(consumptions[0]["source_entry"], "CAL-2")
+
+    def test_layer_deltas(self):
+        consumptions, _, _ = plan_fifo_consumption(make_layers(), 12)
+        self.assertEqual(get_layer_deltas(consumptions), [
+            {"source_entry": "CAL-1", "qty": -10, "charges": -100},
+            {"source_entry": "CAL-2", "qty": -2, "charges": -30}
+        ])
+
+    def test_repeated_consumption_conserves_charges(self):
+        # Many allocations applied one after the other, as update_layer_balances applies their deltas.
+        # Concurrency through the database is covered by TestChargeAllocationLedger.
+        rng = random.Random(13)
+        layers = {layer["name"]: layer for layer in make_layers() + [
+            {"name": f"CAL-{i}", "remaining_qty": rng.randint(1, 50), "remaining_charges": rng.uniform(10, 500)}
+            for i in range(4, 40)
+        ]}
+        total_qty = sum(layer["remaining_qty"] for layer in layers.values())
+        total_charges = sum(layer["remaining_charges"] for layer in layers.values())
+
+        allocated_qty = 0
+        allocated_charges = 0
+        for _ in range(800):
+            open_layers = [dict(layer) for layer in layers.values() if layer["remaining_qty"] > 0]
+            qty = rng.randint(1, 5)
+            consumptions, plan_qty, plan_charges = plan_fifo_consumption(open_layers, qty)
+            if plan_qty < qty:
+                continue
+            for delta in merge_layer_deltas(get_layer_deltas(consumptions)):
+                layers[delta["source_entry"]]["remaining_qty"] += delta["qty"]
+                layers[delta["source_entry"]]["remaining_charges"] += delta["charges"]
+            allocated_qty += plan_qty
+            allocated_charges += plan_charges
+
+        remaining_qty = sum(layer["remaining_qty"] for layer in layers.values())
+        remaining_charges = sum(layer["remaining_charges"] for layer in layers.values())
+
+        self.assertEqual(remaining_qty + allocated_qty, total_qty)
+        self.assertAlmostEqual(remaining_charges + allocated_charges, total_charges, places=6)
+        for layer in layers.values():
+            self.assertGreaterEqual(layer["remaining_qty"], 0)
+            self.assertGreaterEqual(layer["remaining_charges"], -1e-6)
+
+    def test_return_restores_each_source_at_its_rate(self):
+        sources = [
+            {"name": "row-2", "source_entry": "CAL-2", "allocated_qty": 5, "allocated_charges": 75, "returned_qty": 0},
+            {"name": "row-1", "source_entry": "CAL-1", "allocated_qty": 10, "allocated_charges": 100, "returned_qty": 0}
+        ]
+        restorations, returned_qty, returned_charges = plan_return(sources, 7)
+        self.assertEqual(restorations, [
+            {"source_row": "row-2", "source_entry": "CAL-2", "returned_qty": 5, "returned_charges": 75},
+            {"source_row": "row-1", "source_entry": "CAL-1", "returned_qty": 2, "returned_charges": 20}
+        ])
+        self.assertEqual((returned_qty, returned_charges), (7, 95))
+
+    def test_return_skips_already_returned_quantity(self):
+        sources = [
+            {"name": "row-1", "source_entry": "CAL-1", "allocated_qty": 10, "allocated_charges": 100, "returned_qty": 8},
+            {"name": "row-2", "source_entry": "CAL-2", "allocated_qty": 4, "allocated_charges": 60, "returned_qty": 4},
+            {"name": "row-3", "source_entry": "CAL-3", "allocated_qty": 4, "allocated_charges": 10, "returned_qty": 0}
+        ]
+        restorations, returned_qty, returned_charges = plan_return(sources, 3)
+        self.assertEqual([r["source_row"] for r in restorations], ["row-1", "row-3"])
+        self.assertEqual([r["returned_qty"] for r in restorations], [2, 1])
+        self.assertAlmostEqual(returned_charges, 20 + 2.5)
+
+    def test_return_reads_lazily(self):
+        read = []
+
+        def sources():
+            for i in range(1, 100):
+                read.append(i)
+                yield {"name": f"row-{i}", "source_entry": f"CAL-{i}", "allocated_qty": 1, "allocated_charges": 1, "returned_qty": 0}
+
+        plan_return(sources(), 3)
+        self.assertEqual(read, [1, 2, 3])
+
+    def test_allocate_then_return_restores_layers(self):
+        layers = make_layers()
+        consumptions, _, allocated_charges = plan_fifo_consumption(layers, 12)
+        sources = [
+            {"name": f"row-{i}", "source_entry": c["source_entry"], "allocated_qty": c["allocated_qty"],
+             "allocated_charges": c["allocated_charges"], "returned_qty": 0}
+            for i, c in enumerate(consumptions)
+        ]
+        restorations, returned_qty, returned_charges = plan_return(sources, 12)
+        self.assertEqual(returned_qty, 12)
+        self.assertAlmostEqual(returned_charges, allocated_charges)
+
+        deltas = merge_layer_deltas(get_layer_deltas(consumptions) + [
+            {"source_entry": r["source_entry"], "qty": r["returned_qty"], "charges": r["returned_charges"]}
+            for r in restorations
+        ])
+        for delta in deltas:
+            self.assertEqual(delta["qty"], 0)
+            self.assertAlmostEqual(delta["charges"], 0)
+
+    def test_merge_layer_deltas(self):
+        self.assertEqual(merge_layer_deltas([
+            {"source_entry": "CAL-1", "qty": -2, "charges": -20},
+            {"source_entry": "CAL-2", "qty": 1, "charges": 15},
+            {"source_entry": "CAL-1", "qty": 3, "charges": 30}
+        ]), [
+            {"source_entry": "CAL-1", "qty": 1, "charges": 10},
+            {"source_entry": "CAL-2", "qty": 1, "charges": 15}
+        ])
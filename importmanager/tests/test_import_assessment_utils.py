@@ -0,0 +1,134 @@
+import unittest
+from importmanager.import_assessment_utils import (
+    assess_duties,
+    assess_items,
+    assess_totals,
+    assess_values,
+    get_fixed_tax_amount
+)
+
+TAX_RATES = {
+    'CD': 20,
+    'ACD': 2,
+    'Sales Tax': 18,
+    'AST': 3,
+    'IT': 5.5,
+    'fixed_taxes': {
+        'CD': {'custom_fixed_tax_amount': 10, 'custom_fixed_tax_basis': 'Per Unit', 'custom_fixed_tax_uom': 'KG'}
+    }
+}
+
+
+def make_columns(**overrides):
+    columns = {
+        'custom_assessed_value_per_unit': [12.5, 4],
+        'qty': [100, 250],
+        'custom_insurance': [10, 0],
+        'custom_exchange_rate': [280.5, 280.5],
+        'custom_quantity_unit_type': ['KG', 'PCS'],
+        'custom_no_of_units': [100, 250],
+        'custom_fixed_surcharge_ait': [0, 500],
+        'amount': [350000, 280000],
+        'tax_rates': [TAX_RATES, TAX_RATES],
+        'custom_cd': [1, 2],
+        'custom_acd': [3, 4],
+        'custom_ast': [5, 6],
+        'custom_stamnt': [7, 8],
+        'custom_it': [9, 10],
+        'custom_total_duties_and_taxes': [0, 0],
+        'custom_base_assessment_difference': [0, 0],
+        'applicable_charges': [0, 0]
+    }
+    columns.update(overrides)
+    return columns
+
+
+class TestImportAssessmentUtils(unittest.TestCase):
+
+    def test_assess_values(self):
+        values = assess_values([12.5], [100], [10], [280.5])
+        self.assertEqual(values['custom_cfr_value'], [1250])
+        self.assertEqual(values['custom_landing_charges__1'], [12.6])
+        self.assertEqual(values['custom_assessed_value'], [1272.6])
+        self.assertEqual(values['custom_base_assessed_value'], [round(1272.6 * 280.5)])
+
+    def test_assess_duties_cascade(self):
+        duties = assess_duties([100000], [TAX_RATES], ['PCS'], [50], [1000])
+        # CD 20% + ACD 2% on assessed value
+        self.assertEqual(duties['custom_cd'], [20000])
+        self.assertEqual(duties['custom_acd'], [2000])
+        # Sales tax base: 122000
+        self.assertEqual(duties['custom_stamnt'], [21960])
+        self.assertEqual(duties['custom_ast'], [3660])
+        # IT base: 122000 + 21960 + 3660 + 1000
+        self.assertEqual(duties['custom_it'], [round(0.055 * 148620)])
+
+    def test_fixed_tax_only_in_matching_uom(self):
+        self.assertEqual(get_fixed_tax_amount(TAX_RATES, 'CD', 'KG', 100), 1000)
+        self.assertEqual(get_fixed_tax_amount(TAX_RATES, 'CD', 'PCS', 100), 0)
+        self.assertEqual(get_fixed_tax_amount(TAX_RATES, 'ACD', 'KG', 100), 0)
+        self.assertEqual(get_fixed_tax_amount({'fixed_taxes': {'CD': 0}}, 'CD', 'KG', 100), 0)
+
+        duties = assess_duties([100000], [TAX_RATES], ['KG'], [100], [0])
+        self.assertEqual(duties['custom_cd'], [21000])
+
+    def test_builtin_rounding_is_kept(self):
+        # round() rounds half to even, 12.5% of 100 is 12.5 -> 12
+        duties = assess_duties([100], [{'CD': 12.5}], ['PCS'], [0], [0])
+        self.assertEqual(duties['custom_cd'], [12])
+
+    def test_assess_totals(self):
+        duties = {'custom_cd': [10], 'custom_acd': [2], 'custom_ast': [3], 'custom_stamnt': [4], 'custom_it': [5]}
+
+        totals = assess_totals(duties, [1000], [900], "Custom Assessed Value")
+        self.assertEqual(totals['custom_total_duties_and_taxes'], [24])
+        self.assertEqual(totals['custom_base_assessment_difference'], [100])
+        self.assertEqual(totals['applicable_charges'], [112])
+
+        totals = assess_totals(duties, [1000], [900], "IAS2")
+        self.assertEqual(totals['custom_base_assessment_difference'], [0])
+        self.assertEqual(totals['applicable_charges'], [12])
+
+    def test_assess_items_matches_step_by_step(self):
+        columns = make_columns()
+        result = assess_items(columns, "Custom Assessed Value")
+
+        values = assess_values(columns['custom_assessed_value_per_unit'], columns['qty'],
+                               columns['custom_insurance'], columns['custom_exchange_rate'])
+        duties = assess_duties(values['custom_base_assessed_value'], columns['tax_rates'],
+                               columns['custom_quantity_unit_type'], columns['custom_no_of_units'],
+                               columns['custom_fixed_surcharge_ait'])
+        totals = assess_totals(duties, values['custom_base_assessed_value'], columns['amount'], "Custom Assessed Value")
+
+        for column, expected in {**values, **duties, **totals}.items():
+            self.assertEqual(result[column], expected, column)
+
+    def test_items_without_tariff_keep_duties(self):
+        columns = make_columns(tax_rates=[None, TAX_RATES])
+        result = assess_items(columns, "Custom Assessed Value")
+
+        self.assertEqual(result['custom_cd'][0], 1)
+        self.assertEqual(result['custom_it'][0], 9)
+        self.assertEqual(result['applicable_charges'][0], 0)
+        # Assessed value is computed for every item
+        self.assertEqual(result['custom_cfr_value'][0], 1250)
+        self.assertNotEqual(result['custom_cd'][1], 2)
+
+    def test_manual_data_entry_keeps_duties(self):
+        columns = make_columns()
+        result = assess_items(columns, "Custom Assessed Value", manual_data_entry=True)
+
+        self.assertEqual(result['custom_cd'], [1, 2])
+        self.assertEqual(result['custom_stamnt'], [7, 8])
+        self.assertEqual(result['custom_total_duties_and_taxes'], [25, 30])
+        self.assertEqual(
+            result['applicable_charges'],
+            [result['custom_base_assessment_difference'][i] + columns['custom_cd'][i] + columns['custom_acd'][i] for i in range(2)]
+        )
+
+    def test_batch_is_row_independent(self):
+        columns = make_columns()
+        batch = assess_items(columns, "Custom Assessed Value")
+        single = assess_items({key: values[1:] for key, values in columns.items()}, "Custom Assessed Value")
+        for column, values in single.items():
+            self.assertEqual(batch[column][1:], values, column)
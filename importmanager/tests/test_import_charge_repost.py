@@ -0,0 +1,190 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt, nowdate
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from importmanager.importmanager.controllers.charge_allocation_controller import (
+    apply_charge_allocation_plan,
+    cancel_allocation,
+    create_charge_allocation_entry,
+    create_import_charge_revisions,
+    get_pending_charge_adjustments,
+    plan_charge_allocation,
+    repost_import_doc_charges
+)
+
+test_dependencies = ["Account", "Cost Center", "Customer", "Warehouse"]
+
+CONTROLLER = "importmanager.importmanager.controllers.charge_allocation_controller"
+TEST_ITEM = "_Test Import Charge Repost Item"
+TEST_IMPORT_DOC = "_Test ImportDoc Charge Repost"
+
+# Layer of 10 units at 10 each, revised to 15 each
+LAYER_QTY, LAYER_CHARGES, REVISED_CHARGES = 10, 100, 150
+
+
+class TestImportChargeRepost(FrappeTestCase):
+    def setUp(self):
+        if not frappe.db.exists("Item", TEST_ITEM):
+            frappe.get_doc({
+                "doctype": "Item",
+                "item_code": TEST_ITEM,
+                "item_group": "All Item Groups",
+                "stock_uom": "Nos",
+                "is_stock_item": 0
+            }).insert()
+
+        # Named directly, the ImportDoc autoname needs a Purchase Order
+        import_doc = frappe.get_doc({
+            "doctype": "ImportDoc",
+            "name": TEST_IMPORT_DOC,
+            "date": nowdate(),
+            "supplier": "_Test Supplier",
+            "company": "_Test Company"
+        })
+        import_doc.db_insert()
+        frappe.get_doc({
+            "doctype": "Import Items",
+            "name": frappe.generate_hash(length=10),
+            "parent": TEST_IMPORT_DOC,
+            "parenttype": "ImportDoc",
+            "parentfield": "items",
+            "item_code": TEST_ITEM,
+            "item_name": TEST_ITEM,
+            "qty": LAYER_QTY,
+            "allocated_charges_ex_cd": LAYER_CHARGES
+        }).db_insert()
+
+        create_charge_allocation_entry(
+            "Addition", "Import Charges", TEST_ITEM, LAYER_QTY, LAYER_CHARGES, "ImportDoc", TEST_IMPORT_DOC
+        )
+        self.layer = frappe.db.get_value(
+            "Charge Allocation Ledger", {"item_code": TEST_ITEM, "entry_type": "Addition"}, "name"
+        )
+
+        # Two invoices sold before the revision
+        self.invoices = [
+            create_sales_invoice(item_code=TEST_ITEM, qty=qty, rate=100, do_not_submit=True).name
+            for qty in (4, 3)
+        ]
+        for invoice, qty in zip(self.invoices, (4, 3)):
+            create_charge_allocation_entry("Allocation", "Import Charges", TEST_ITEM, qty, 0, "Sales Invoice", invoice)
+
+        # The GL legs need the Company's import accounts, GL posting is not under test here
+        for target in ("get_charge_allocation_gl_legs", "make_charge_allocation_gl_entries"):
+            patcher = patch(f"{CONTROLLER}.{target}", return_value=[])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        entries = frappe.get_all("Charge Allocation Ledger", filters={"item_code": TEST_ITEM}, pluck="name")
+        if entries:
+            frappe.db.delete("Charge Allocation Source", {"parent": ["in", entries]})
+            frappe.db.delete("Charge Allocation Ledger", {"name": ["in", entries]})
+        frappe.db.delete("Charge Allocation Balance", {"item_code": TEST_ITEM})
+        for invoice in self.invoices:
+            frappe.delete_doc("Sales Invoice", invoice, force=True)
+        frappe.db.delete("Import Items", {"parent": TEST_IMPORT_DOC})
+        frappe.db.delete("ImportDoc", {"name": TEST_IMPORT_DOC})
+        frappe.db.commit()
+
+    def revise_charges(self, charges=REVISED_CHARGES):
+        frappe.db.set_value("Import Items", {"parent": TEST_IMPORT_DOC}, "allocated_charges_ex_cd", charges)
+        create_import_charge_revisions(frappe.get_doc("ImportDoc", TEST_IMPORT_DOC))
+
+    def get_layer(self):
+        return frappe.db.get_value(
+            "Charge Allocation Ledger", self.layer, ["remaining_qty", "remaining_charges"], as_dict=True
+        )
+
+    def test_revision_records_the_increase_once(self):
+        self.revise_charges()
+        self.revise_charges()
+
+        revisions = frappe.get_all(
+            "Charge Allocation Ledger",
+            filters={"item_code": TEST_ITEM, "entry_type": "Addition", "adjustment_for": self.layer},
+            fields=["qty", "charges"]
+        )
+        self.assertEqual(len(revisions), 1)
+        self.assertAlmostEqual(flt(revisions[0].charges), REVISED_CHARGES - LAYER_CHARGES)
+        self.assertEqual(flt(revisions[0].qty), 0)
+
+        # The 3 unsold units carry the revised rate
+        layer = self.get_layer()
+        self.assertEqual(flt(layer.remaining_qty), 3)
+        self.assertAlmostEqual(flt(layer.remaining_charges), 3 * 15)
+
+    def test_pending_adjustments_cover_allocations_before_the_revision(self):
+        self.revise_charges()
+        # Sold at the revised rate, not adjusted
+        create_charge_allocation_entry("Allocation", "Import Charges", TEST_ITEM, 1, 0, "Sales Invoice", "_Test SINV-LATER")
+
+        adjustments = {
+            adjustment.sales_invoice: adjustment for adjustment in get_pending_charge_adjustments(TEST_IMPORT_DOC)
+        }
+        self.assertEqual(set(adjustments), set(self.invoices))
+        for invoice, qty in zip(self.invoices, (4, 3)):
+            self.assertEqual(adjustments[invoice].qty, qty)
+            self.assertAlmostEqual(adjustments[invoice].charges, qty * 5)
+            self.assertEqual(adjustments[invoice].layer, self.layer)
+
+    def test_repost_adjusts_each_invoice_once(self):
+        self.revise_charges()
+        repost_import_doc_charges(TEST_IMPORT_DOC)
+        repost_import_doc_charges(TEST_IMPORT_DOC)
+
+        for invoice, qty in zip(self.invoices, (4, 3)):
+            adjustments = frappe.get_all(
+                "Charge Allocation Ledger",
+                filters={"reference_doc_name": invoice, "entry_type": "Allocation", "adjustment_for": ["is", "set"]},
+                fields=["name", "qty", "charges"]
+            )
+            self.assertEqual(len(adjustments), 1)
+            self.assertAlmostEqual(flt(adjustments[0].charges), qty * 5)
+            self.assertEqual(
+                frappe.get_all(
+                    "Charge Allocation Source",
+                    filters={"parent": adjustments[0].name},
+                    fields=["source_entry", "allocated_qty"]
+                ),
+                [{"source_entry": self.layer, "allocated_qty": qty}]
+            )
+            self.assertAlmostEqual(
+                flt(frappe.db.get_value("Sales Invoice Item", {"parent": invoice}, "custom_allocated_charges")),
+                qty * 5
+            )
+        self.assertEqual(get_pending_charge_adjustments(TEST_IMPORT_DOC), [])
+
+    def test_return_gives_back_the_revision_charges(self):
+        """
+        Allocate, repost the revised charges, then return the first invoice: the return
+        takes back the original and the revision charges of its units.
+        """
+        self.revise_charges()
+        repost_import_doc_charges(TEST_IMPORT_DOC)
+
+        plan = plan_charge_allocation(
+            TEST_ITEM, -4, "Import Charges", "Return", for_update=True, return_against=self.invoices[0]
+        )
+        self.assertAlmostEqual(plan.charges, -4 * 15)
+        apply_charge_allocation_plan(plan, "Sales Invoice", "_Test SINV-RET")
+
+        layer = self.get_layer()
+        self.assertEqual(flt(layer.remaining_qty), 7)
+        self.assertAlmostEqual(flt(layer.remaining_charges), 7 * 15)
+
+        # Cancelling the return takes the units and both charges back
+        cancel_allocation("_Test SINV-RET")
+        layer = self.get_layer()
+        self.assertEqual(flt(layer.remaining_qty), 3)
+        self.assertAlmostEqual(flt(layer.remaining_charges), 3 * 15)
+        self.assertEqual(
+            frappe.get_all(
+                "Charge Allocation Source",
+                filters={"source_entry": self.layer, "returned_qty": [">", 0]},
+                pluck="name"
+            ),
+            []
+        )
@@ -0,0 +1,58 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from importmanager.import_utils import create_journal_voucher, get_journal_voucher_by_idempotency_key
+
+test_dependencies = ["Account"]
+
+TEST_COMPANY = "_Test Company"
+TEST_ACCOUNTS = ("_Test Bank - _TC", "_Test Cash - _TC")
+
+
+def get_test_legs(amount=100):
+    return [
+        {"account": TEST_ACCOUNTS[0], "debit": amount, "credit": 0},
+        {"account": TEST_ACCOUNTS[1], "debit": 0, "credit": amount}
+    ]
+
+
+class TestCreateJournalVoucher(FrappeTestCase):
+    def get_entries_with_key(self, idempotency_key):
+        return frappe.get_all("Journal Entry", filters={"custom_idempotency_key": idempotency_key}, pluck="name")
+
+    def test_duplicate_key_returns_the_posted_entry(self):
+        """
+        A run that misses the entry in its pre-check (posted by another run after it started)
+        hits the unique key on insert and returns the entry that is there.
+        """
+        idempotency_key = "_Test JV Key:duplicate"
+        first = create_journal_voucher("_Test JV", None, get_test_legs(), company=TEST_COMPANY,
+                                       idempotency_key=idempotency_key)
+
+        with patch(
+            "importmanager.import_utils.get_journal_voucher_by_idempotency_key",
+            side_effect=[None, get_journal_voucher_by_idempotency_key(idempotency_key)]
+        ) as lookup:
+            second = create_journal_voucher("_Test JV", None, get_test_legs(), company=TEST_COMPANY,
+                                            idempotency_key=idempotency_key)
+
+        self.assertEqual(second, first)
+        self.assertEqual(lookup.call_args.kwargs, {"for_update": True})
+        self.assertEqual(len(self.get_entries_with_key(idempotency_key)), 1)
+
+    def test_duplicate_key_without_entry_raises(self):
+        """
+        If the entry behind the unique violation can't be read, the error is raised
+        instead of returning nothing.
+        """
+        idempotency_key = "_Test JV Key:unreadable"
+        create_journal_voucher("_Test JV", None, get_test_legs(), company=TEST_COMPANY,
+                               idempotency_key=idempotency_key)
+
+        with patch("importmanager.import_utils.get_journal_voucher_by_idempotency_key", return_value=None):
+            with self.assertRaises(frappe.UniqueValidationError):
+                create_journal_voucher("_Test JV", None, get_test_legs(), company=TEST_COMPANY,
+                                       idempotency_key=idempotency_key)
+
+        self.assertEqual(len(self.get_entries_with_key(idempotency_key)), 1)